@@ -9,51 +9,455 @@ __version__ = '2020.07'
 import sys
 import math
 import serial
-import serial.tools.list_ports
 import time
-import pdb
 import logging
-import ntplib, socket
+import socket
 import datetime as dt
+import codecs
+import hashlib
+import json
+import csv
+import bisect
+import collections
+import select
+import threading
+import contextlib
 from pathlib import Path
 
 TimeOutLimitSecsFluke1586A = 0.5       # max time (in seconds) to wait for response from Fluke unit
 TimeBetweenCommandsSecs = 0.1   # min time (in seconds) between commands to Fluke
+IdleTimeoutSecs = 0.1           # unterminated responses are complete after this long (in seconds) without new data
+ResponseBufferSize = 4096       # initial size (in bytes) of the receive buffer, grows as needed
+DownloadChunkSize = 64*1024     # max size (in bytes) of chunks written to disk during downloads
+StallTimeoutSecs = 5.0          # max pause (in seconds) tolerated within a response of known size
+CatalogBatchSize = 16           # number of queries combined in one request when listing scan files
+MaxBatchLength = 250            # max length (in characters) of a compound command sent in one write
+BaudRates = [115200, 57600, 38400, 19200, 9600, 4800, 2400, 1200]   # serial baud rates supported by the Fluke 1586A
+BaudSwitchDelaySecs = 0.1       # time (in seconds) for the instrument to switch baud rate
+NtpServer = 'europe.pool.ntp.org'
+NtpTimeoutSecs = 2.0            # max time (in seconds) to wait for the NTP server
+DriftMinSpanSecs = 600          # min time span (in seconds) of the samples used to estimate clock drift
 
-# Commands sent to Fluke1586A
-Fluke1586A_RS232_out_commands = {
-    'SYST:DATE':   {'format': '{0:4d},{1:02d},{2:02d}'},          # "DATE YYYY,MM,DD"
-    'SYST:TIME':   {'format': '{0:02d},{1:02d},{2:02d}'},         # "TIME hh,mm,ss" 
-    }
-    
-# Responses received from Fluke1586A
-Fluke1586A_RS232_in_commands = {
-    '*idn?':      {'converter': None}, # Standard instrument identification string
-    'SYST:DATE?': {'converter': [int, int, int]}, #
-    'SYST:TIME?': {'converter': [int, int, int]}, #
-    }
-    
-Fluke1586A_RS232_commands = {}
-Fluke1586A_RS232_commands.update(Fluke1586A_RS232_out_commands)
-Fluke1586A_RS232_commands.update(Fluke1586A_RS232_in_commands)
+
+class ScpiCommand(object):
+    """A command of the Fluke 1586A: the request template and the reply parser.
+
+    args are the formats of the arguments (e.g. ['{:d}', '"{}"']); trailing
+    arguments may be left out. The request templates for all numbers of
+    arguments are built once, so a request costs a single str.format().
+    parser converts the reply (bytes); without a parser the reply is
+    returned unchanged.
+    """
+    __slots__ = ['header', 'parser', '_templates']
+
+    def __init__(self, header, args=(), parser=None):
+        self.header = header
+        self.parser = parser
+        self._templates = [header+(' '+','.join(args[:n]) if n else '')+'\r' for n in range(len(args)+1)]
+
+    def request(self, *arguments):
+        """The command string, including the terminating carriage return."""
+        return self._templates[len(arguments)].format(*arguments)
+
+    def parse(self, reply):
+        return reply if self.parser is None else self.parser(reply)
+
+
+def _parse_text(reply):
+    return reply.decode().strip()
+
+
+def _parse_int(reply):
+    return int(reply.strip())
+
+
+def _parse_ints(reply):
+    return [int(field) for field in reply.split(b',')]
+
+
+def _parse_fields(*names):
+    """Parser of a reply with comma separated fields into a dict."""
+    def parse(reply):
+        return dict(zip(names, reply.decode().strip().split(',')))
+    return parse
+
+
+ReadingTable = collections.namedtuple('ReadingTable', ['index', 'time', 'values'])
+
+
+def parse_reading_table(reply):
+    """Decode a list of readings (LOG:AUT:VAL? reply, one reading per line)
+    into NumPy arrays in one pass: the reading numbers, the time stamps
+    (datetime64[ms]) and a 2D float array of the other numeric fields, the
+    measured values. Empty fields are NaN.
+
+    Columns are classified over all readings: a column is numeric if all
+    its non-empty fields are numbers, the time column is the first other
+    column whose first non-empty field looks like a date. Other columns
+    are left out. A first column of whole numbers in front of the time
+    column holds the reading numbers (index), not a measurement; index and
+    time are None if the readings have none. Lines with fewer fields than
+    the longest line are padded with empty fields."""
+    import numpy as np     # imported on first use, keeps start-up fast
+    lines = [line for line in _normalize_newlines(reply.decode()).split('\n') if line.strip()]
+    if len(lines) == 0:
+        return ReadingTable(None, None, np.empty((0, 0)))
+    counts = [line.count(',') for line in lines]
+    width = max(counts)+1
+    if min(counts)+1 == width:
+        table = np.array(','.join(lines).split(','), dtype=str).reshape(len(lines), width)
+    else:
+        # lines with different numbers of fields, pad them
+        rows = [line.split(',') for line in lines]
+        table = np.array([row+['']*(width-len(row)) for row in rows], dtype=str)
+    table = np.char.strip(table)
+
+    numeric, values, time_col = [], [], None
+    for id in range(width):
+        column = table[:, id]
+        filled = column[column != '']
+        if len(filled) == 0:
+            continue
+        try:
+            values.append(np.where(column == '', 'nan', column).astype(float))
+            numeric.append(id)
+        except ValueError:
+            if time_col is None and _row_time(str(filled[0])) is not None:
+                time_col = id
+    index = None
+    if (time_col is not None and numeric and numeric[0] == 0 < time_col and
+            np.all(values[0] == np.round(values[0]))):
+        index = values.pop(0).astype('int64')
+    values = np.stack(values, axis=1) if values else np.empty((len(lines), 0))
+    time = None
+    if time_col is not None:
+        try:
+            time = np.char.replace(table[:, time_col], ' ', 'T').astype('datetime64[ms]')
+        except ValueError:
+            pass    # not ISO 8601
+    return ReadingTable(index, time, values)
+
+
+# Commands of the Fluke 1586A, by header
+Fluke1586A_RS232_commands = {cmd.header: cmd for cmd in [
+    ScpiCommand('*idn?',              parser=_parse_text),                       # Standard instrument identification string
+    ScpiCommand('SYST:VERS?',         parser=_parse_text),
+    ScpiCommand('SYST:DATE?',         parser=_parse_ints),                       # YYYY,MM,DD
+    ScpiCommand('SYST:TIME?',         parser=_parse_ints),                       # hh,mm,ss
+    ScpiCommand('SYST:DATE',          ['{:4d}', '{:02d}', '{:02d}']),            # "DATE YYYY,MM,DD"
+    ScpiCommand('SYST:TIME',          ['{:02d}', '{:02d}', '{:02d}']),           # "TIME hh,mm,ss"
+    ScpiCommand('SYST:COMM:SER:BAUD', ['{:d}']),                                 # "BAUD rate"
+    ScpiCommand('MEM:LOG:NFIL?',      parser=_parse_int),                        # number of scan files
+    ScpiCommand('MEM:LOG:NAME?',      ['{:d}'], parser=_parse_text),             # name of scan file n
+    ScpiCommand('MEM:LOG:PROP?',      ['"{}"'], parser=_parse_fields('size', 'time', 'user')),
+    ScpiCommand('MEM:LOG:READ?',      ['"{}"', '{:d}']),                         # scan data (from row n), streamed
+    ScpiCommand('MEM:LOG:READ:CONF?', ['"{}"']),                                 # channel setup, streamed
+    ScpiCommand('LOG:AUT:LAB',        ['{:d}']),                                 # select data slot
+    ScpiCommand('LOG:AUT:VAL?',       ['{}'], parser=parse_reading_table),       # readings from id
+    ScpiCommand('INIT'),
+    ScpiCommand('ABOR'),
+    ]}
+_commands_upper = {header.upper(): cmd for header, cmd in Fluke1586A_RS232_commands.items()}
+
+
+def _command_spec(command):
+    """The ScpiCommand of a command header (any case), or None."""
+    return Fluke1586A_RS232_commands.get(command) or _commands_upper.get(command.upper())
     
 
-def get_internet_time_offset():
+def get_internet_time_offset(server=NtpServer, port='ntp', timeout=NtpTimeoutSecs):
     """Get internet time and calculate system time offset in seconds."""
+    import ntplib   # imported on first use, keeps start-up fast
     c = ntplib.NTPClient()
-    response = c.request('europe.pool.ntp.org', version=3)
+    response = c.request(server, version=3, port=port, timeout=timeout)
     return response.offset
     
     
+def format_command(command, arguments=None):
+    """Format a command string, including the terminating carriage return.
+    Arguments are formatted with the template of the command in
+    Fluke1586A_RS232_commands. Commands not in the registry are sent as
+    given, with the arguments separated by commas."""
+    if arguments is not None and not isinstance(arguments, (list, tuple)):
+        arguments = [arguments]
+    spec = _command_spec(command)
+    if spec is not None:
+        return spec.request(*(arguments or []))
+    if arguments:
+        command += ' '+','.join(str(arg) for arg in arguments)
+    return command+'\r'  # ASCII 13 carriage return
+
+
+def _normalize_newlines(text):
+    """Convert instrument line endings ('\\r\\r', '\\r\\n' or '\\r') to '\\n'."""
+    return text.replace('\r\r', '\r').replace('\r\n', '\n').replace('\r', '\n')
+
+
+class NewlineNormalizer(object):
+    """Incrementally decode a response received in chunks and normalize its
+    line endings (see _normalize_newlines), also when a line break is split
+    across two chunks. Leading and trailing whitespace is dropped."""
+    def __init__(self):
+        self.decoder = codecs.getincrementaldecoder('utf-8')()
+        self.pending = ''      # trailing whitespace, held back until more data arrives
+        self.started = False
+
+    def feed(self, chunk):
+        text = self.pending + self.decoder.decode(chunk)
+        if not self.started:
+            text = text.lstrip()
+            self.started = len(text) > 0
+        body = text.rstrip()
+        self.pending = text[len(body):]
+        return _normalize_newlines(body)
+
+    def close(self):
+        return '\n' if self.started else ''
+
+
+def _print_progress(received, size, elapsed):
+    """Print progress of a bulk transfer on a single, continuously updated line."""
+    rate = received/elapsed if elapsed > 0 else 0.
+    if size:
+        eta = (size-received)/rate if rate > 0 else float('nan')
+        print('\r  {0:d} of {1:d} bytes ({2:.0f}%), {3:.1f} bytes/s, ETA {4:.0f} s   '.format(
+              received, size, 100.*received/size, rate, eta), end='', flush=True)
+    else:
+        print('\r  {0:d} bytes, {1:.1f} bytes/s   '.format(received, rate), end='', flush=True)
+
+
+def _is_query(command):
+    return '?' in command.split(' ', 1)[0]
+
+
+def _convert_reply(command, reply):
+    """Parse a reply with the parser of the command in Fluke1586A_RS232_commands.
+    Replies of commands without a parser are returned unchanged (as bytes)."""
+    spec = _command_spec(command.split(None, 1)[0])
+    if spec is None:
+        return reply
+    return spec.parse(reply)
+
+
+def _file_size(props):
+    """Size in bytes from the MEM:LOG:PROP? reply, or None if not available."""
+    try:
+        return int(props['size'])
+    except (KeyError, ValueError):
+        return None
+
+
+def _scan_file_summary(p):
+    """Size, SHA-1 checksum, number of lines and last line of a downloaded
+    file, computed in chunks so that memory use does not depend on file size."""
+    sha1 = hashlib.sha1()
+    nbytes = 0
+    nlines = 0
+    tail = b''
+    with p.open('rb') as fh:
+        while True:
+            chunk = fh.read(DownloadChunkSize)
+            if not chunk:
+                break
+            sha1.update(chunk)
+            nbytes += len(chunk)
+            nlines += chunk.count(b'\n')
+            tail = (tail+chunk)[-4096:]
+    last_line = tail.rstrip(b'\n').rsplit(b'\n', 1)[-1].decode()
+    return nbytes, sha1.hexdigest(), nlines, last_line
+
+
+def _header_lines(p):
+    """Number of lines up to and including the column header (the first
+    line with a time column) in a downloaded data file."""
+    with p.open() as fh:
+        for id, line in enumerate(fh):
+            if 'time' in line.lower():
+                return id+1
+            if id > 100:
+                break
+    return 0
+
+
+def _row_time(line):
+    """Time stamp of a data row (the first field that looks like a date), or None."""
+    for field in line.split(','):
+        field = field.strip().strip('"')
+        if len(field) >= 10 and field[:1].isdigit() and ('-' in field or '/' in field):
+            return field
+    return None
+
+
+class ScanCatalog(object):
+    """The scan files in instrument memory, sorted by name.
+
+    Iterating gives one dict per file with the keys 'name', 'size', 'time',
+    'user' and 'slot'; catalog[name] looks up a file by name.
+    """
+    def __init__(self, nfiles, files):
+        self.nfiles = nfiles
+        self.files = sorted(files, key=lambda f: f['name'])
+        self.fetched = dt.datetime.now()
+        self._by_name = {f['name']: f for f in self.files}
+
+    def __len__(self):
+        return len(self.files)
+
+    def __iter__(self):
+        return iter(self.files)
+
+    def __getitem__(self, name):
+        return self._by_name[name]
+
+    def __contains__(self, name):
+        return name in self._by_name
+
+    def names(self):
+        return [f['name'] for f in self.files]
+
+
+def _command_key(CmdString):
+    """Metrics key and number of commands of a command string. The key is the
+    command header without arguments; a compound command (see send_batch) is
+    keyed 'batch ' plus its distinct headers, so batches of any size share
+    one entry, e.g. 'batch MEM:LOG:PROP?'."""
+    headers = [c.strip().split(' ', 1)[0] for c in CmdString.strip().split(';:')]
+    if len(headers) == 1:
+        return headers[0], 1
+    return 'batch ' + ';:'.join(sorted(set(headers), key=headers.index)), len(headers)
+
+
+class Fluke1586AMetrics(object):
+    """Per-command counters and latency histograms of the serial traffic.
+
+    For every command (keyed by its header, e.g. 'MEM:LOG:READ?', or
+    'batch ' plus the headers of a compound command) the number of calls,
+    of commands sent (more than the calls for batches), bytes out and in,
+    timeouts (no reply) and truncated replies are counted. Latencies are measured from the start of the
+    write: 'write' until the command is written, 'first_byte' and
+    'last_byte' until the first and last byte of the reply arrived.
+    """
+    LatencyBins = [0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1., 2., 5., 10., 30., 60.]   # upper bin edges (s)
+    Latencies = ['write', 'first_byte', 'last_byte']
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.commands = {}
+            self.started = time.time()
+
+    def _new_entry(self):
+        entry = {'count': 0, 'commands': 0, 'bytes_out': 0, 'bytes_in': 0, 'timeouts': 0, 'truncated': 0}
+        for name in self.Latencies:
+            entry[name] = {'count': 0, 'total': 0., 'min': None, 'max': None,
+                           'histogram': [0]*(len(self.LatencyBins)+1)}
+        return entry
+
+    def record(self, command, write, first_byte=None, last_byte=None,
+               bytes_out=0, bytes_in=0, timeout=False, truncated=False, commands=1):
+        with self.lock:
+            entry = self.commands.get(command)
+            if entry is None:
+                entry = self.commands[command] = self._new_entry()
+            entry['count'] += 1
+            entry['commands'] += commands
+            entry['bytes_out'] += bytes_out
+            entry['bytes_in'] += bytes_in
+            entry['timeouts'] += int(timeout)
+            entry['truncated'] += int(truncated)
+            for name, value in zip(self.Latencies, [write, first_byte, last_byte]):
+                if value is None:
+                    continue
+                lat = entry[name]
+                lat['count'] += 1
+                lat['total'] += value
+                lat['min'] = value if lat['min'] is None else min(lat['min'], value)
+                lat['max'] = value if lat['max'] is None else max(lat['max'], value)
+                lat['histogram'][bisect.bisect_left(self.LatencyBins, value)] += 1
+
+    def to_dict(self):
+        """Return a copy of all metrics, with the mean of each latency added."""
+        with self.lock:
+            commands = json.loads(json.dumps(self.commands))
+        for entry in commands.values():
+            for name in self.Latencies:
+                lat = entry[name]
+                lat['mean'] = lat['total']/lat['count'] if lat['count'] else None
+        return {'started': dt.datetime.fromtimestamp(self.started).isoformat(),
+                'latency_bins': self.LatencyBins, 'commands': commands}
+
+    def to_json(self, p=None):
+        """Return the metrics as a JSON string, and write it to the file p if given."""
+        text = json.dumps(self.to_dict(), indent=2)
+        if p is not None:
+            Path(p).write_text(text)
+        return text
+
+    def to_csv(self, p):
+        """Write one line per command with counters and latency statistics
+        (without the histograms) to the csv file p."""
+        metrics = self.to_dict()['commands']
+        fields = ['command', 'count', 'commands', 'bytes_out', 'bytes_in', 'timeouts', 'truncated']
+        for name in self.Latencies:
+            fields += ['{0}_{1}'.format(name, stat) for stat in ['mean', 'min', 'max']]
+        with Path(p).open('w', newline='') as fh:
+            writer = csv.writer(fh)
+            writer.writerow(fields)
+            for command in sorted(metrics):
+                entry = metrics[command]
+                row = [command]+[entry[f] for f in fields[1:7]]
+                for name in self.Latencies:
+                    row += [entry[name][stat] for stat in ['mean', 'min', 'max']]
+                writer.writerow(row)
+
+
+class TruncatedResponse(serial.SerialException):
+    pass
+
+
+_sessions = {}      # com_port -> Fluke1586A, see Fluke1586A.session()
+_sessions_lock = threading.Lock()
+
+
 class Fluke1586A(object):
     def __init__(self, com_port, nickname='', baudrate=9600, bytesize=serial.EIGHTBITS,
                  stopbits=serial.STOPBITS_ONE, parity=serial.PARITY_NONE,
                  dsrdtr=False, rtscts=False, xonxoff=False,
                  timeout=TimeOutLimitSecsFluke1586A,
-                 nChannels=2, debug=False):
+                 nChannels=2, debug=False, verbose=True, download_dir='./downloads',
+                 bulk_baudrate='auto'):
+        """com_port is a serial port name or a pyserial URL. For an Ethernet
+        connection use 'socket://<host>:<port>': the baud rate settings are
+        then ignored and the TCP connection is kept open (and reopened if it
+        drops) for the lifetime of the object.
+
+        bulk_baudrate is the max baud rate negotiated for bulk transfers
+        (downloads) on a serial line, see bulk_transfer(). 'auto' tries the
+        highest rate in BaudRates, None keeps baudrate throughout.
+        """
         self.debug = debug
+        self.verbose = verbose      # print progress and results to the console
         self.com_port = com_port
         self.nickname = nickname
+        self.download_dir = Path(download_dir)
+        self.timeout = timeout
+        self._rxbuf = bytearray(ResponseBufferSize)
+        self._idn = None
+        self._catalog = None
+        self.metrics = None     # Fluke1586AMetrics, see enable_metrics()
+        self._pending = None
+        self.tcp = com_port.lower().startswith('socket://')
+        self.bulk_baudrate = None if self.tcp else bulk_baudrate
+        self._bulk = False
+        self.lock = threading.RLock()   # held by threads sharing the port, see ClockMonitor
+
+        # The port timeout only limits each blocking read, the timeout for a
+        # complete response is handled in get_response(). It is set once here
+        # so the port never has to be reconfigured between commands.
+        timeout = min(timeout, IdleTimeoutSecs)
         try:
             self.serial = serial.serial_for_url(com_port, baudrate,
                     bytesize=bytesize, stopbits=stopbits, parity=parity,
@@ -67,11 +471,110 @@ class Fluke1586A(object):
                     dsrdtr=dsrdtr, rtscts=rtscts, xonxoff=xonxoff,
                     timeout=timeout)
         
-        self.serial.set_buffer_size(rx_size = 1024*1024)
+        if hasattr(self.serial, 'set_buffer_size'):
+            # only available on Windows
+            self.serial.set_buffer_size(rx_size = 1024*1024)
+        self._configure_socket()
+
+    @classmethod
+    def session(cls, com_port, **kwargs):
+        """Return the open Fluke1586A on com_port, opening it on first use.
+        Sessions are shared, so repeated operations on the same instrument
+        (e.g. a TCP connection) reuse one connection instead of reconnecting."""
+        with _sessions_lock:
+            fluke = _sessions.get(com_port)
+            if fluke is None or not fluke.serial.is_open:
+                fluke = _sessions[com_port] = cls(com_port, **kwargs)
+            return fluke
+
+    def _configure_socket(self):
+        """Set up the TCP connection of a socket:// port: disable Nagle's
+        algorithm, so short commands are sent at once instead of being held
+        back waiting for more data, and enable keep-alive probes."""
+        self._socket = getattr(self.serial, '_socket', None) if self.tcp else None
+        if self._socket is not None:
+            self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self._socket.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+
+    def reconnect(self):
+        """Close and reopen the port (e.g. after a dropped TCP connection)."""
+        logging.info('Reconnecting to {0} ({1})'.format(self.com_port, self.nickname))
+        try:
+            self.serial.close()
+        except Exception:
+            pass
+        self.serial.open()
+        self._configure_socket()
+
+    def _switch_baudrate(self, rate):
+        """Send SYST:COMM:SER:BAUD rate at the current port rate, then switch
+        the port to rate and check that the instrument answers."""
+        self.send_message('SYST:COMM:SER:BAUD', [rate], get_response=False)
+        self.serial.flush()     # the command must leave at the current rate
+        time.sleep(BaudSwitchDelaySecs)
+        self.serial.baudrate = rate
+        self.serial.reset_input_buffer()
+        resp, cmd = self.send_message('*idn?')
+        return len(resp) > 0 and (not self._idn or _convert_reply('*idn?', resp) == self._idn)
+
+    def set_baudrate(self, rate):
+        """Switch instrument and port to the baud rate rate and check that the
+        instrument answers at the new rate. Returns True on success.
+
+        If it does not answer, the instrument has probably switched anyway,
+        so it is told to go back to the previous rate (sent at the new rate)
+        and the port is set back. Raises serial.SerialException if the
+        instrument then does not answer at the previous rate either.
+        """
+        old = self.serial.baudrate
+        if rate == old:
+            return True
+        if self._switch_baudrate(rate):
+            logging.info('Baud rate {0:d} -> {1:d}   ({2}@{3})'.format(old, rate, self.nickname, self.com_port))
+            return True
+        logging.info('No response at {0:d} baud, back to {1:d}   ({2}@{3})'.format(rate, old, self.nickname, self.com_port))
+        if self._switch_baudrate(old):
+            return False
+        raise serial.SerialException('No response from {0} at {1:d} or {2:d} baud'.format(self.com_port, rate, old))
+
+    def negotiate_baudrate(self, max_rate='auto'):
+        """Switch to the highest rate in BaudRates (not above max_rate) at which
+        the instrument answers. Returns the baud rate in use."""
+        current = self.serial.baudrate
+        for rate in BaudRates:
+            if rate <= current or (max_rate != 'auto' and rate > max_rate):
+                continue
+            if self.set_baudrate(rate):
+                return rate
+        return current
+
+    @contextlib.contextmanager
+    def bulk_transfer(self):
+        """Context for bulk transfers: on a serial line the baud rate is raised
+        to the highest rate both sides support (see bulk_baudrate) and
+        restored on exit. Does nothing on TCP connections, when nested, or
+        with bulk_baudrate=None."""
+        if self.bulk_baudrate is None or self._bulk:
+            yield
+            return
+        self._bulk = True
+        rate = old = self.serial.baudrate
+        try:
+            self.instrument_id()    # to recognize the instrument at the new rate
+            rate = self.negotiate_baudrate(self.bulk_baudrate)
+            yield
+        finally:
+            self._bulk = False
+            if rate != old and not self.set_baudrate(old):
+                logging.info('Could not restore baud rate {0:d}   ({1}@{2})'.format(old, self.nickname, self.com_port))
                     
     def __del__(self):
         self.close()
         
+    def _print(self, *args, **kwargs):
+        if self.verbose:
+            print(*args, **kwargs)
+
     def close(self):
         try:
             self.serial.close()
@@ -81,13 +584,9 @@ class Fluke1586A(object):
 
     def initialize(self):
         resp = dict()
-        cmd = dict()
 
-        resp['id'],cmd['id'] = self.get_version()
-        resp['F_date'],cmd['F_date'] = self.get_date()
-        
         t1 = dt.datetime.now()
-        resp['F_time'],cmd['F_time'] = self.get_time()
+        resp['id'], resp['F_date'], resp['F_time'] = self.send_batch(['SYST:VERS?', 'SYST:DATE?', 'SYST:TIME?'], convert=False)
         t2 = dt.datetime.now()
         resp['PC_time'] = str(t1+(t2-t1)/2)
         
@@ -95,22 +594,29 @@ class Fluke1586A(object):
     
     def send_message(self, command, arguments=None, get_response=True):
         # Updated for Fluke1586A
-        CmdString = command
-        if arguments is not None:
-            #raise NotImplementedError('Sending arguments to Fluke1586A is not handled at the moment')
-            try:
-                CmdString += ' '+Fluke1586A_RS232_out_commands[command]['format'].format(*arguments)
-            except:
-                CmdString += ' '+Fluke1586A_RS232_out_commands[command]['format'].format(arguments)
-            #get_response = False
-            
-        CmdString += '\r'  # ASCII 13 carriage return
+        CmdString = format_command(command, arguments)
         # First flush any unread input
-        self.serial.flushInput()
+        try:
+            self.serial.flushInput()
+        except (serial.SerialException, OSError):
+            if not self.tcp:
+                raise
+            self.reconnect()    # the TCP connection was dropped
 
-        # Now write the command
-        self.serial.write('\r'.encode())
-        self.serial.write(CmdString.encode())
+        # Now write the command, preceded by a carriage return to clear any
+        # partial command in the instrument input buffer
+        if self.metrics is not None:
+            self._record_reply()    # a previous command whose reply was not read
+            t0 = time.perf_counter()
+        try:
+            self.serial.write(('\r'+CmdString).encode())
+        except (serial.SerialException, OSError):
+            if not self.tcp:
+                raise
+            self.reconnect()
+            self.serial.write(('\r'+CmdString).encode())
+        if self.metrics is not None:
+            self._pending = _command_key(CmdString)+(t0, time.perf_counter(), len(CmdString)+1)
 
         if self.debug:
             print("Command:  " + CmdString)
@@ -128,31 +634,280 @@ class Fluke1586A(object):
             
         return reply, CmdString
 
-    def get_response(self, timeout=TimeOutLimitSecsFluke1586A, terminated=True):
-        d = self.serial.getSettingsDict()
-        d['timeout'] = timeout
-        self.serial.applySettingsDict(d)
+    def query(self, command, *arguments):
+        """Send a query of the command registry (Fluke1586A_RS232_commands)
+        and return its parsed reply."""
+        resp, cmd = self.send_message(command, list(arguments) if arguments else None)
+        return _convert_reply(command, resp)
+
+    def write(self, command, *arguments):
+        """Send a command that has no reply."""
+        resp, cmd = self.send_message(command, list(arguments) if arguments else None, get_response=False)
+        return cmd
+
+    def send_batch(self, commands, convert=True):
+        """Send a list of commands (queries and setters) as compound SCPI
+        commands, 'cmd1;:cmd2;...', using as few round trips as possible.
+
+        Each command is a command string or a (command, arguments) tuple as
+        for send_message(). Commands are joined up to MaxBatchLength
+        characters per write. The replies of the queries in a write are
+        split on ';'. If convert is True, the replies are parsed by the
+        parsers of the commands in Fluke1586A_RS232_commands.
+
+        Returns a list with one entry per command: the (converted) reply of
+        a query, or None for a setter. If the instrument does not answer a
+        compound query as expected, its queries are sent one at a time.
+        """
+        cmds = []
+        for command in commands:
+            if isinstance(command, str):
+                command, arguments = command, None
+            else:
+                command, arguments = command
+            cmds.append((command, format_command(command, arguments)[:-1]))
+
+        # Group the commands into compound commands of limited length
+        groups = [[]]
+        length = 0
+        for id, (command, CmdString) in enumerate(cmds):
+            if groups[-1] and length+len(CmdString)+2 > MaxBatchLength:
+                groups.append([])
+                length = 0
+            groups[-1].append(id)
+            length += len(CmdString)+2
+
+        replies = [None]*len(cmds)
+        for group in groups:
+            queries = [id for id in group if _is_query(cmds[id][0])]
+            resp, cmd = self.send_message(';:'.join([cmds[id][1] for id in group]), get_response=len(queries) > 0)
+            if len(queries) == 0:
+                continue
+            fields = resp.split(b';')
+            if len(fields) != len(queries):
+                logging.info('Compound query not answered as expected, sending queries one by one   ({0}@{1})'.format(self.nickname, self.com_port))
+                fields = [self.send_message(cmds[id][1])[0] for id in queries]
+            for id, reply in zip(queries, fields):
+                reply = reply.strip()
+                replies[id] = _convert_reply(cmds[id][0], reply) if convert else reply
+        return replies
+
+    def prepare_commands(self, commands):
+        """Flush the input and encode commands (as for send_batch, setters
+        only) into one compound command, to be sent later by fire_commands
+        with as little work as possible at the moment of sending."""
+        try:
+            self.serial.flushInput()
+        except (serial.SerialException, OSError):
+            if not self.tcp:
+                raise
+            self.reconnect()
+        if self.metrics is not None:
+            self._record_reply()    # a previous command whose reply was not read
+        cmds = []
+        for command in commands:
+            command, arguments = (command, None) if isinstance(command, str) else command
+            cmds.append(format_command(command, arguments)[:-1])
+        return ('\r'+';:'.join(cmds)+'\r').encode()
+
+    def fire_commands(self, data):
+        """Write data from prepare_commands and wait until it has been sent.
+        Returns the PC times (time.time()) before and after the write."""
+        t_start = time.time()
+        self.serial.write(data)
+        self.serial.flush()
+        t_end = time.time()
+        logging.info('fire_commands: {0}   ({1}@{2})'.format(data.decode().strip(), self.nickname, self.com_port))
+        return t_start, t_end
+
+    def transmit_time(self, nbytes):
+        """Time in seconds to send nbytes at the baud rate of the serial line
+        (10 bits per byte), 0 on a TCP connection."""
+        if self.tcp:
+            return 0.
+        return nbytes*10./self.serial.baudrate
+
+    def enable_metrics(self, metrics=None):
+        """Start collecting per-command metrics in metrics (a new
+        Fluke1586AMetrics by default; one object may be shared by several
+        instruments). Returns the metrics object."""
+        self.metrics = Fluke1586AMetrics() if metrics is None else metrics
+        self._pending = None
+        return self.metrics
+
+    def disable_metrics(self):
+        self.metrics = None
+        self._pending = None
 
-        resp = self.serial.read(1)  # this will block execution until reply or timeout
+    def _record_reply(self, nbytes=None, t_first=None, t_last=None, truncated=False):
+        """Record the metrics of the last command sent, once its reply has been
+        read (nbytes=None: the reply was not read)."""
+        if self._pending is None:
+            return
+        command, ncommands, t0, t_write, bytes_out = self._pending
+        self._pending = None
+        self.metrics.record(command, write=t_write-t0,
+                            first_byte=None if t_first is None else t_first-t0,
+                            last_byte=None if t_last is None else t_last-t0,
+                            bytes_out=bytes_out, bytes_in=nbytes or 0,
+                            timeout=(nbytes == 0), truncated=truncated, commands=ncommands)
+
+    def _read_available(self, mv, deadline):
+        """Read the bytes waiting on the port into the memoryview mv.
+
+        Blocks in the serial driver (at most IdleTimeoutSecs per read) until
+        at least one byte arrives or the deadline has passed, so no CPU time
+        is spent while waiting. Returns the number of bytes read.
+
+        On a TCP connection everything that has arrived (up to len(mv)) is
+        received in one call; pyserial's in_waiting cannot tell how much
+        that is and would make bulk transfers go byte by byte.
+        """
+        if self._socket is not None:
+            while True:
+                ready, _, _ = select.select([self._socket], [], [], max(0., min(IdleTimeoutSecs, deadline-time.time())))
+                if ready:
+                    k = self._socket.recv_into(mv, len(mv))
+                    if k == 0:
+                        raise serial.SerialException('Connection to {0} closed by the instrument'.format(self.com_port))
+                    return k
+                if time.time() >= deadline:
+                    return 0
+        while True:
+            n = min(len(mv), max(1, self.serial.in_waiting))
+            k = self.serial.readinto(mv[:n])
+            if k > 0 or time.time() >= deadline:
+                return k
 
-        tstart= time.time()
-        timeout = time.time() + 0.1
+    def get_response(self, timeout=None, terminated=True):
+        """Read a response from the instrument.
+
+        The first byte is awaited for up to timeout seconds (default: the
+        timeout given when opening the port). Terminated responses are
+        returned as soon as the '\\r' terminator arrives, otherwise the
+        response is complete when no data has arrived for IdleTimeoutSecs.
+        """
+        if timeout is None:
+            timeout = self.timeout
+
+        buf = self._rxbuf
+        pos = 0
+        deadline = time.time() + timeout
+        tstart = time.time()
         pend = ''
+        metrics = self.metrics is not None
+        t_first = t_last = None
         while True:
-            if self.serial.inWaiting() > 0:
-                resp += self.serial.read(self.serial.inWaiting())
-                timeout = time.time() + 0.1
-            if len(resp)>0 and terminated and resp[-1]==13:
+            if pos == len(buf):
+                buf.extend(bytes(len(buf)))   # double the buffer, amortized linear growth
+            with memoryview(buf) as mv:
+                k = self._read_available(mv[pos:], deadline)
+            if k == 0:
                 break
-            if time.time() > timeout:
+            if metrics:
+                t_last = time.perf_counter()
+                if t_first is None:
+                    t_first = t_last
+            pos += k
+            if terminated and buf.find(b'\r', pos-k, pos) >= 0:
                 break
+            deadline = time.time() + IdleTimeoutSecs
             if time.time()-tstart > 3:
                 tstart = time.time()
-                print('*', end='', flush=True)
+                self._print('*', end='', flush=True)
                 pend = '\n'
-                
-        print('', end=pend)
-        return resp.strip()
+
+        self._print('', end=pend)
+        if metrics:
+            self._record_reply(pos, t_first, t_last)
+        return bytes(buf[:pos]).strip()
+
+    def _read_block_length(self, deadline):
+        """Read the rest of a SCPI definite-length block header ('#' already
+        consumed) and return the length of the block, or None for an
+        indefinite-length block ('#0')."""
+        header = bytearray()
+        ndigits = None
+        while ndigits is None or len(header) < ndigits+1:
+            with memoryview(bytearray(1)) as mv:
+                if self._read_available(mv, deadline) == 0:
+                    raise TruncatedResponse('Incomplete block header: #{0}'.format(header.decode()))
+                header += mv
+            if ndigits is None:
+                ndigits = int(header[:1])
+        if ndigits == 0:
+            return None
+        return int(header[1:])
+
+    def iter_response(self, timeout=None, chunk_size=DownloadChunkSize, size=None, progress=None):
+        """Yield an unterminated response in chunks of at most chunk_size bytes
+        as they arrive, so that large replies never have to be held in memory.
+
+        Chunks are handed on when the buffer is full, at least once per second
+        on a slow line, and when the response is complete.
+
+        If the size of the response in bytes is given, or the response starts
+        with a SCPI definite-length block header ('#<n><length>'), reading
+        stops the moment the last byte has arrived and pauses of up to
+        StallTimeoutSecs are tolerated. A response that ends short of its
+        size raises TruncatedResponse. Otherwise the response is complete when
+        no data has arrived for IdleTimeoutSecs.
+
+        progress is called as progress(received, size) for every chunk.
+        """
+        if timeout is None:
+            timeout = self.timeout
+
+        buf = bytearray(chunk_size)
+        received = 0
+        tyield = time.time()
+        metrics = self.metrics is not None
+        with memoryview(buf) as mv:
+            pos = self._read_available(mv[:1], time.time() + timeout)
+            if pos == 0:
+                if metrics:
+                    self._record_reply(0, truncated=bool(size))
+                if size:
+                    raise TruncatedResponse('No response, expected {0:d} bytes'.format(size))
+                return
+            if metrics:
+                t_first = t_last = time.perf_counter()
+            block = size is None and mv[0] == ord('#')
+            if block:
+                size = self._read_block_length(time.time() + StallTimeoutSecs)
+                pos = 0
+            remaining = None if size is None else size - pos
+
+            while True:
+                if remaining == 0:
+                    if block or self.serial.in_waiting == 0:
+                        break
+                    # The reply is longer than announced, do not truncate it
+                    logging.info('Response exceeds {0:d} bytes, reading until idle   ({1}@{2})'.format(size, self.nickname, self.com_port))
+                    remaining = None
+                    size = None
+                idle = IdleTimeoutSecs if remaining is None else StallTimeoutSecs
+                n = len(mv)-pos if remaining is None else min(len(mv)-pos, remaining)
+                k = self._read_available(mv[pos:pos+n], time.time() + idle)
+                if metrics and k > 0:
+                    t_last = time.perf_counter()
+                pos += k
+                if remaining is not None:
+                    remaining -= k
+                if pos == len(mv) or (pos > 0 and (k == 0 or remaining == 0 or time.time()-tyield > 1)):
+                    received += pos
+                    if progress is not None:
+                        progress(received, size)
+                    yield bytes(mv[:pos])
+                    pos = 0
+                    tyield = time.time()
+                if k == 0:
+                    break
+
+        if metrics:
+            self._record_reply(received, t_first, t_last, truncated=bool(remaining))
+        if remaining:
+            raise TruncatedResponse('Response ended after {0:d} of {1:d} bytes'.format(received, size))
 
     def get_identification(self):
         cmd = '*idn?'
@@ -194,90 +949,441 @@ class Fluke1586A(object):
         logging.info('set_time: {0}   ({1}@{2}:{3})'.format(resp, self.nickname, self.com_port, cmd))
         return resp, cmd
         
-    def get_offset(self):
-        #fserial = self.get_serial()
-        fdate, cmd = self.get_date()
-        
-        t1 = dt.datetime.now()
-        ftime, cmd = self.get_time()
-        t2 = dt.datetime.now()
-        com_delay = (t2-t1)
-        pc_datetime = t1+com_delay/2
-        
-        fdate = [int(s) for s in fdate.decode().split(',')]
-        ftime = [int(s) for s in ftime.decode().split(',')]
-        
-        f_datetime = dt.datetime(*fdate, *ftime)
+    def probe_offset(self, samples=1):
+        """Measure the offset of the instrument clock relative to the PC clock.
+
+        Date and time are queried in a single round trip, samples times. The
+        sample with the shortest round trip is the least affected by delays
+        on the line and is the one used. Returns the offset and the round
+        trip of that sample (datetime.timedelta).
+        """
+        best = None
+        for id in range(samples):
+            t1 = dt.datetime.now()
+            fdate, ftime = self.send_batch(['SYST:DATE?', 'SYST:TIME?'])
+            t2 = dt.datetime.now()
+            com_delay = (t2-t1)
+            if best is None or com_delay < best[2]:
+                best = (dt.datetime(*fdate, *ftime), t1+com_delay/2, com_delay)
+        f_datetime, pc_datetime, com_delay = best
+        return f_datetime-pc_datetime, com_delay
+
+    def get_offset(self, samples=1):
+        offset, com_delay = self.probe_offset(samples)
+        pc_datetime = dt.datetime.now()
+        f_datetime = pc_datetime+offset
         
-        print('Current PC date & time:           {0}'.format(pc_datetime.strftime(r'%Y-%m-%d %H:%M:%S')))
-        print('Current instrument date & time:   {0}'.format(f_datetime.strftime(r'%Y-%m-%d %H:%M:%S')))
-        offset = f_datetime-pc_datetime
-        print('Instrument offset:                {0:.1f} s'.format(offset.total_seconds()))
-        print('Total comm delay:                 {0:.2f} s'.format(com_delay.total_seconds()))
+        self._print('Current PC date & time:           {0}'.format(pc_datetime.strftime(r'%Y-%m-%d %H:%M:%S')))
+        self._print('Current instrument date & time:   {0}'.format(f_datetime.strftime(r'%Y-%m-%d %H:%M:%S')))
+        self._print('Instrument offset:                {0:.1f} s'.format(offset.total_seconds()))
+        self._print('Total comm delay:                 {0:.2f} s'.format(com_delay.total_seconds()))
         
         
         return offset
         
     def sync_datetime(self):
-        self.get_offset()
-        self.set_date()
-        self.set_time()
-        print('')
-        print('Instrument date and time set to match PC date and time.')
-        print('')
-        self.get_offset()
+        """Set instrument date and time to PC date and time.
+        Returns the instrument offsets before and after synchronization."""
+        before = self.get_offset()
+        t1 = dt.datetime.now()
+        commands = [('SYST:DATE', [t1.year, t1.month, t1.day]),
+                    ('SYST:TIME', [t1.hour, t1.minute, math.ceil(t1.second+t1.microsecond/1e6)])]   # Ceil is used to round seconds up, under assumption that there will be a small delay in transmission.
+        self.send_batch(commands)
+        logging.info('sync_datetime: {0}   ({1}@{2})'.format(commands, self.nickname, self.com_port))
+        self._print('')
+        self._print('Instrument date and time set to match PC date and time.')
+        self._print('')
+        after = self.get_offset()
+        return before, after
     
-    def get_values(self, slot, id):
+    def select_slot(self, slot):
+        """Select the data slot that read_values() reads from."""
         if not isinstance(slot, int):
             raise ValueError('The data slot must be an integer value!')
-        self.send_message('LOG:AUT:LAB {0:d}'.format(slot), get_response=False)
-        resp, cmd = self.send_message('LOG:AUT:VAL? {0}'.format(id), get_response=False)
+        self.write('LOG:AUT:LAB', slot)
+
+    def read_values(self, id):
+        """Read the values of the selected slot, starting at reading id."""
+        self.write('LOG:AUT:VAL?', id)
         resp = self.get_response(terminated=False)
         return resp
+
+    def read_value_table(self, id):
+        """Read the values of the selected slot, starting at reading id, as a
+        ReadingTable of NumPy arrays (see parse_reading_table)."""
+        return parse_reading_table(self.read_values(id))
+
+    def get_values(self, slot, id):
+        self.select_slot(slot)
+        return self.read_values(id)
         
     
-    def download_data(self, name=None):
-        #raise NotImplementedError('Data download is not yet implemented for 1586A, use USB export...!')
-        
-        print('Retrieving data from scan file {0}.  '.format(name), end='', flush=True)
-        self.send_message('MEM:LOG:READ? "{0}"'.format(name), get_response=False)
-        resp = self.get_response(terminated=False)
-        print('Complete.')
-        
-        data = resp.decode().replace('\r\r','\r').splitlines()
-        Path('./downloads/{0}'.format(name)).mkdir(parents=True, exist_ok=True)
-        p = Path('./downloads/{0}/{0}_data.csv'.format(name))
-        print('Storing data to: {0}'.format(str(p)))
-        with p.open(mode='w') as fh:
-                for line in data:
-                    fh.write(line+'\n')
-        
-        print('Retrieving setup info from scan file {0}.  '.format(name), end='', flush=True)
-        self.send_message('MEM:LOG:READ:CONF? "{0}"'.format(name), get_response=False)
-        resp = self.get_response(terminated=False)
-        print('Complete.')
-        
-        conf = resp.decode().replace('\r\r','\r').splitlines()
-        p = Path('./downloads/{0}/{0}_conf.csv'.format(name))
-        print('Storing data to: {0}'.format(str(p)))
-        with p.open(mode='w') as fh:
-                for line in conf:
-                    fh.write(line+'\n')        
+    def store_response(self, p, timeout=None, size=None):
+        """Stream an unterminated response to the file p, chunk by chunk.
+
+        Line endings are normalized on the fly ('\\r\\r' and '\\r' become
+        '\\n'), also when a line break is split across two chunks. Leading and
+        trailing whitespace is dropped, as in get_response(). If size is
+        given, the response is read as exactly size bytes (see iter_response).
+
+        Progress, transfer rate and (for known sizes) the estimated time to
+        completion are printed while the response arrives.
+
+        Returns the number of bytes received and the transfer rate in bytes/sec.
+        """
+        normalizer = NewlineNormalizer()
+        tstart = time.time()
+        stats = {'received': 0, 'printed': tstart}
+
+        def progress(received, total):
+            stats['received'] = received
+            if self.verbose and time.time()-stats['printed'] > 1:
+                stats['printed'] = time.time()
+                _print_progress(received, total, time.time()-tstart)
+
+        try:
+            with p.open(mode='w', newline='') as fh:
+                for chunk in self.iter_response(timeout=timeout, size=size, progress=progress):
+                    fh.write(normalizer.feed(chunk))
+                fh.write(normalizer.close())
+        finally:
+            if stats['printed'] != tstart:
+                self._print('')
+        elapsed = time.time()-tstart
+        rate = stats['received']/elapsed if elapsed > 0 else 0.
+        return stats['received'], rate
+
+    def get_catalog(self, refresh=False):
+        """Return the ScanCatalog of scan files in instrument memory.
+
+        The catalog is cached. It is only updated when the number of files
+        (MEM:LOG:NFIL?) has changed, and then only files not seen before have
+        their properties fetched. Names and properties are fetched with
+        CatalogBatchSize queries per round trip (see send_batch). Use refresh=True to fetch
+        all entries again, e.g. to update the size of a file being written.
+        """
+        try:
+            nfiles = self.query('MEM:LOG:NFIL?')
+        except ValueError:
+            nfiles = 0
+
+        if self._catalog is not None and not refresh and self._catalog.nfiles == nfiles:
+            return self._catalog
+
+        known = {} if (self._catalog is None or refresh) else {f['name']: f for f in self._catalog}
+
+        names = []
+        for start in range(1, nfiles+1, CatalogBatchSize):
+            slots = range(start, min(start+CatalogBatchSize, nfiles+1))
+            names.extend(self.send_batch([('MEM:LOG:NAME?', [slot]) for slot in slots]))
+            self._print('*', end='', flush=True)
+
+        new = [name for name in names if name not in known]
+        for start in range(0, len(new), CatalogBatchSize):
+            batch = new[start:start+CatalogBatchSize]
+            replies = self.send_batch([('MEM:LOG:PROP?', [name]) for name in batch])
+            for name, info in zip(batch, replies):
+                known[name] = info
+                known[name]['name'] = name
+            self._print('*', end='', flush=True)
+
+        files = []
+        for slot, name in enumerate(names, 1):
+            info = dict(known[name])
+            info['slot'] = slot
+            files.append(info)
+
+        self._catalog = ScanCatalog(nfiles, files)
+        return self._catalog
+
+    def get_scan_file_info(self, name):
+        """Fetch the current properties of the scan file name (e.g. the size of
+        a file that is still being written) and update the cached catalog."""
+        info = self.query('MEM:LOG:PROP?', name)
+        info['name'] = name
+        if self._catalog is not None and name in self._catalog:
+            self._catalog[name].update(info)
+            info = dict(self._catalog[name])
+        return info
+
+    def list_scan_files(self, refresh=False):
+        """Return a list of the scan files in instrument memory, sorted by name.
+        Each entry is a dict with the keys 'name', 'size', 'time', 'user' and 'slot'."""
+        return list(self.get_catalog(refresh=refresh))
+
+    def download_all(self, incremental=False, archive=None):
+        """Download all scan files in instrument memory. Returns the list of files."""
+        files = self.list_scan_files(refresh=True)   # current sizes
+        with self.bulk_transfer():
+            for info in files:
+                self.download_data(info['name'], size=_file_size(info), incremental=incremental, archive=archive)
+        return files
+
+    def _download(self, command, arguments, p, title, size=None):
+        """Send command and stream the reply to the file p."""
+        self._print('Retrieving {0}.  '.format(title), end='', flush=True)
+        self.send_message(command, arguments, get_response=False)
+        nbytes, rate = self.store_response(p, size=size)
+        self._print('Complete. ({0:d} bytes, {1:.1f} bytes/s)'.format(nbytes, rate))
+        self._print('Stored data to: {0}'.format(str(p)))
+        logging.info('download_data: {0} bytes at {1:.1f} bytes/s   ({2}@{3}:{4})'.format(nbytes, rate, self.nickname, self.com_port, p))
+        return nbytes
+
+    def instrument_id(self):
+        """Identification string of the instrument (queried once, then cached)."""
+        if not self._idn:
+            resp, cmd = self.get_identification()
+            self._idn = _convert_reply(cmd, resp)
+        return self._idn
+
+    def _download_tail(self, name, p, state):
+        """Fetch the rows of scan file name that are not yet in the local
+        file p, starting with the last known row, and append them to p.
+
+        Returns False if the local file or the instrument data no longer
+        match the download state, in which case a full download is needed.
+        """
+        if state['rows'] < 1 or not p.exists() or _scan_file_summary(p) != (state['bytes'], state['sha1'], state['lines'], state['last_line']):
+            logging.info('download_data: local file changed, full download   ({0}@{1}:{2})'.format(self.nickname, self.com_port, p))
+            return False
+
+        p_tail = p.with_name(p.name+'.part')
+        try:
+            self._download('MEM:LOG:READ?', [name, state['rows']], p_tail,
+                           'new data from scan file {0} (from row {1:d})'.format(name, state['rows']))
+            with p_tail.open() as fh_tail:
+                first = fh_tail.readline().rstrip('\n')
+                if first != state['last_line']:
+                    logging.info('download_data: data does not match download state, full download   ({0}@{1}:{2})'.format(self.nickname, self.com_port, p))
+                    return False
+                with p.open('a', newline='') as fh:
+                    while True:
+                        chunk = fh_tail.read(DownloadChunkSize)
+                        if not chunk:
+                            break
+                        fh.write(chunk)
+        finally:
+            if p_tail.exists():
+                p_tail.unlink()
+        return True
+
+    def download_data(self, name=None, size=None, incremental=False, archive=None):
+        """Download the scan file name and its setup info to
+        <download_dir>/<name>/<name>_data.csv and <download_dir>/<name>/<name>_conf.csv
+
+        The replies are written to disk as they arrive, so memory use does
+        not depend on the size of the scan file. If the size of the scan file
+        is known (from MEM:LOG:PROP?), the data transfer completes as soon as
+        the last byte has arrived and a short transfer raises TruncatedResponse.
+        On a serial line the files are transferred at the bulk baud rate, see
+        bulk_transfer().
+
+        With incremental=True only the rows added since the last download
+        are transferred and appended to the data file. The download state
+        (row count, size, checksum and last row of the local file) is kept
+        per instrument in <name>_state.json. If the local file or the first
+        row returned by the instrument does not match the state, the whole
+        file is downloaded again.
+
+        If archive (a ScanArchive or its root directory, see
+        pyfluke1586A_archive) is given, the rows not yet in the archive are
+        appended to it.
+        """
+        (self.download_dir / name).mkdir(parents=True, exist_ok=True)
+        p_data = self.download_dir / name / '{0}_data.csv'.format(name)
+        p_conf = self.download_dir / name / '{0}_conf.csv'.format(name)
+        p_state = self.download_dir / name / '{0}_state.json'.format(name)
+
+        done = False
+        with self.bulk_transfer():
+            if incremental:
+                states = json.loads(p_state.read_text()) if p_state.exists() else {}
+                state = states.get(self.instrument_id())
+                if state is not None:
+                    done = self._download_tail(name, p_data, state)
+            if not done:
+                self._download('MEM:LOG:READ?', [name], p_data, 'data from scan file {0}'.format(name), size=size)
+            self._download('MEM:LOG:READ:CONF?', [name], p_conf, 'setup info from scan file {0}'.format(name))
+
+        if incremental:
+            nbytes, sha1, nlines, last_line = _scan_file_summary(p_data)
+            states[self.instrument_id()] = {'rows': nlines-_header_lines(p_data), 'lines': nlines,
+                                            'bytes': nbytes, 'sha1': sha1, 'last_line': last_line,
+                                            'last_time': _row_time(last_line),
+                                            'updated': dt.datetime.now().isoformat()}
+            p_state.write_text(json.dumps(states, indent=2))
+
+        if archive is not None:
+            from pyfluke1586A_archive import ScanArchive
+            if not isinstance(archive, ScanArchive):
+                archive = ScanArchive(archive)
+            nrows = archive.append_download(self.instrument_id(), self.download_dir / name, name)
+            logging.info('download_data: {0:d} rows archived   ({1}@{2}:{3})'.format(nrows, self.nickname, self.com_port, archive.root))
 
     def initiate_scan(self):
        cmd = 'INIT'
-       resp,cmd = self.send_message(cmd)
+       resp,cmd = self.send_message(cmd, get_response=False)    # no reply
        logging.info('INIT: {0}   ({1}@{2}:{3})'.format(resp, self.nickname, self.com_port, cmd))
        return resp, cmd
     
     def abort_scan(self):
        cmd = 'ABOR'
-       resp,cmd = self.send_message(cmd)
+       resp,cmd = self.send_message(cmd, get_response=False)    # no reply
        logging.info('ABOR: {0}   ({1}@{2}:{3})'.format(resp, self.nickname, self.com_port, cmd))
        return resp, cmd
 
 
 
+OffsetSample = collections.namedtuple('OffsetSample', ['offset', 'delay', 'time'])
+
+
+class ClockMonitor(object):
+    """Background thread that keeps the clock offsets up to date.
+
+    The PC offset to internet time (get_internet_time_offset) and the
+    instrument offset to the PC clock (Fluke1586A.probe_offset, with the
+    shortest of several round trips) are sampled when their cached value
+    is older than pc_ttl and instrument_ttl seconds. Readers get the cached
+    OffsetSample (offset in seconds, round trip in seconds, time.time() of
+    the sample) at once, or None if no sample has succeeded yet.
+
+    The instrument is only probed when its lock is free, so the monitor
+    never waits for (or interferes with) a download in another thread.
+    drift_rate() estimates the drift of the instrument clock (s/day) from
+    the recent samples. With auto_sync=True, the instrument clock is
+    synchronized when its offset exceeds drift_threshold seconds.
+    """
+    def __init__(self, fluke=None, interval=10., pc_ttl=600., instrument_ttl=60., samples=5,
+                 drift_threshold=1.0, auto_sync=False, ntp_server=NtpServer, ntp_port='ntp',
+                 history=100):
+        self.fluke = fluke
+        self.interval = interval
+        self.pc_ttl = pc_ttl
+        self.instrument_ttl = instrument_ttl
+        self.samples = samples
+        self.drift_threshold = drift_threshold
+        self.auto_sync = auto_sync
+        self.ntp_server = ntp_server
+        self.ntp_port = ntp_port
+        self.pc = None              # OffsetSample of the PC clock
+        self.instrument = None      # OffsetSample of the instrument clock
+        self.pc_error = None
+        self.instrument_error = None
+        self.history = collections.deque(maxlen=history)   # (time, instrument offset) since the last sync
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='ClockMonitor', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def set_fluke(self, fluke):
+        """Monitor another instrument (e.g. after changing port)."""
+        with self._lock:
+            self.fluke = fluke
+            self.instrument = None
+            self.instrument_error = None
+            self.history.clear()
+        self.refresh()
+
+    def refresh(self, pc=False, instrument=True):
+        """Expire the cached values, so they are sampled again right away."""
+        with self._lock:
+            if pc:
+                self.pc = None
+            if instrument:
+                self.instrument = None
+        self._wake.set()
+
+    def _expired(self, sample, ttl):
+        return sample is None or time.time()-sample.time > ttl
+
+    def _sample_pc(self):
+        try:
+            tstart = time.time()
+            offset = get_internet_time_offset(self.ntp_server, port=self.ntp_port)
+            self.pc = OffsetSample(offset, time.time()-tstart, time.time())
+            self.pc_error = None
+        except Exception as e:
+            self.pc_error = e
+            logging.info('ClockMonitor: no internet time from {0}: {1}'.format(self.ntp_server, e))
+
+    def _sample_instrument(self, fluke):
+        if not fluke.lock.acquire(blocking=False):
+            return      # port busy, try again later
+        try:
+            fluke.instrument_id()
+            offset, delay = fluke.probe_offset(self.samples)
+            sample = OffsetSample(offset.total_seconds(), delay.total_seconds(), time.time())
+            with self._lock:
+                if fluke is self.fluke:
+                    self.instrument = sample
+                    self.history.append((sample.time, sample.offset))
+            self.instrument_error = None
+        except Exception as e:
+            self.instrument_error = e
+            logging.info('ClockMonitor: no offset from instrument   ({0}@{1}): {2}'.format(fluke.nickname, fluke.com_port, e))
+        finally:
+            fluke.lock.release()
+
+    def _run(self):
+        while not self._stop.is_set():
+            if self._expired(self.pc, self.pc_ttl):
+                self._sample_pc()
+            fluke = self.fluke
+            if fluke is not None and self._expired(self.instrument, self.instrument_ttl):
+                self._sample_instrument(fluke)
+                if self.auto_sync:
+                    self.sync_if_needed()
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def drift_rate(self):
+        """Drift of the instrument clock relative to the PC clock in seconds
+        per day (least squares fit of the recent samples), or None while the
+        samples span less than DriftMinSpanSecs (the instrument clock only
+        reports whole seconds)."""
+        with self._lock:
+            history = list(self.history)
+        if len(history) < 2 or history[-1][0]-history[0][0] < DriftMinSpanSecs:
+            return None
+        tm = sum(t for t, o in history)/len(history)
+        om = sum(o for t, o in history)/len(history)
+        stt = sum((t-tm)**2 for t, o in history)
+        return 86400*sum((t-tm)*(o-om) for t, o in history)/stt
+
+    def sync_if_needed(self, threshold=None):
+        """Synchronize the instrument clock if the cached offset exceeds
+        threshold (default: drift_threshold) seconds. Returns True if synced."""
+        threshold = self.drift_threshold if threshold is None else threshold
+        sample, fluke = self.instrument, self.fluke
+        if sample is None or fluke is None or abs(sample.offset) <= threshold:
+            return False
+        with fluke.lock:
+            fluke.sync_datetime()
+        with self._lock:
+            self.history.clear()
+        self.refresh()
+        return True
+
+
 def check_Fluke_time(com='COM1'):
     # make sure we start afresh with logging...
     # Remove all handlers associated with the root logger object.
@@ -305,8 +1411,10 @@ def check_Fluke_time(com='COM1'):
 
 
 myFluke = None
+monitor = None      # ClockMonitor, keeps the offsets shown in the menu up to date
 
 def list_com_ports():
+    import serial.tools.list_ports
     ports = serial.tools.list_ports.comports()
     for id, port in enumerate(ports):
         print('{0})  {1}:\t{2}'.format(id, port.device, port.description))
@@ -318,16 +1426,29 @@ def select_com():
     print('List of available COM ports:')
     print('')
     ports = list_com_ports()
+    print('or enter socket://<host>:<port> to connect over Ethernet')
+    print('')
+    choice = input('Choose COM port: ').strip()
+    if '://' in choice:
+        try:
+            myFluke.close()
+        except:
+            pass
+        myFluke = Fluke1586A(choice)
+        monitor.set_fluke(myFluke)
+        return choice
     try:
-        choice = int(input('Choose COM port: '))
+        choice = int(choice)
     except ValueError:
         print('Invalid input!')
-    if choice <= len(ports):
+        return None
+    if choice < len(ports):
         try:
             myFluke.close()
         except:
             pass
         myFluke = Fluke1586A( ports[choice].device)
+        monitor.set_fluke(myFluke)
         return ports[choice].device
     else:
         print('Invalid input!')
@@ -338,57 +1459,58 @@ def identify():
     print('Instrument identification: {0}'.format(resp.decode()))
 
 def check_PC_offset():
-    try:
-        offset = get_internet_time_offset()
-    except socket.gaierror:
-        print('Could not reach internet time server!')
+    # The offset is sampled in the background by the monitor, so the menu
+    # never waits for the time server
+    sample = monitor.pc
+    print('')
+    if sample is None:
+        if monitor.pc_error is not None:
+            print('Could not reach internet time server!')
+        else:
+            print('PC offset to internet time not measured yet')
         return
         
+    offset = sample.offset
     if offset>=0:
         direction='behind'
     else:
         direction='ahead of'
-    print('')
-    print('PC time is {0:.2f} sec {1} internet time'.format(abs(offset), direction))
+    print('PC time is {0:.2f} sec {1} internet time  (measured {2:.0f} s ago)'.format(abs(offset), direction, time.time()-sample.time))
+
+def show_instrument_status():
+    sample = monitor.instrument
+    if sample is not None:
+        print('Instrument identification: {0}'.format(myFluke._idn))
+        drift = monitor.drift_rate()
+        print('Instrument offset: {0:.1f} s  (measured {1:.0f} s ago{2})'.format(
+            sample.offset, time.time()-sample.time,
+            '' if drift is None else ', drift {0:.2f} s/day'.format(drift)))
+    elif monitor.instrument_error is not None:
+        print('NO RESPONSE FROM INSTRUMENT ON PORT {0}'.format(myFluke.com_port))
+    else:
+        print('Waiting for instrument...')
     
 def check_fluke_offset():
-    myFluke.get_offset()
+    myFluke.get_offset(samples=5)
     
 def sync_fluke_time():
     myFluke.sync_datetime()
+    monitor.refresh()
     
 def download_data(): 
     data = {}
     
     print('')
     print('Retrieving information from instrument...  ', end='', flush=True)
-    resp, cmd = myFluke.send_message('MEM:LOG:NFIL?')
-    
-    nslots = resp.decode().strip() 
-    try:
-        nslots = int(nslots)
-    except:
-        nslots = 0
+    files = myFluke.list_scan_files()
+    print('')
+    print('{0} datasets found.'.format(len(files)))
 
-    print('{0} datasets found.'.format(nslots))     
-    
-    if nslots == 0:
+    if len(files) == 0:
         return
-    
-    for slot in range(1,nslots+1):
-        resp, cmd = myFluke.send_message('MEM:LOG:NAME? {0}'.format(slot))
-        name = resp.decode().strip()     
-        resp, cmd = myFluke.send_message('MEM:LOG:PROP? "{0}"'.format(name))
-        data[slot] = dict(zip(['size', 'time', 'user'],resp.decode().strip().split(',')))
-        data[slot]['name'] = name
-        data[slot]['slot'] = slot
-        print('*', end='', flush=True)
-
-    # Get a list of indices into data, sorted by the filename of the dataset
-    # and reorder the keys so the slots are listed sorted after the filename/date
-    old_data = data.copy()
-    id_list = sorted(data, key=lambda k: data[k]['name'])
-    data = {k:old_data[slot] for k,slot in enumerate(id_list)}
+
+    # List the datasets sorted by filename, numbered from 1 (0 is EXIT)
+    data = {k:info for k,info in enumerate(files, 1)}
     
     while True:
         print('')
@@ -418,10 +1540,10 @@ def download_data():
                     continue
         
         if not load_all:
-            myFluke.download_data(data[choice]['name'])
+            info = myFluke.get_scan_file_info(data[choice]['name'])   # current size
+            myFluke.download_data(info['name'], size=_file_size(info))
         else:
-            for slot in data.keys():
-                myFluke.download_data(data[slot]['name'])
+            myFluke.download_all()
                 
     return data
 
@@ -432,6 +1554,7 @@ def abort_scan():
     myFluke.abort_scan()    
         
 def mydebug():
+    import pdb
     pdb.set_trace()
            
 def clear_data():        
@@ -463,14 +1586,21 @@ if __name__=='__main__':
     except:
         pass
         
+    # Port (e.g. COM3, /dev/ttyUSB0 or socket://192.168.1.10:3490) and
+    # optional baud rate on the command line
+    com_port = sys.argv[1] if len(sys.argv) > 1 else 'COM3'
+    baudrate = int(sys.argv[2]) if len(sys.argv) > 2 else 9600
+    monitor = ClockMonitor()
     try:
-        myFluke = Fluke1586A('COM3')
+        myFluke = Fluke1586A(com_port, baudrate=baudrate)
     except serial.SerialException:
         #list_com_ports()
         #print('Could not open COM port! Aborting...')
         #sys.exit()
         select_com()
     
+    monitor.set_fluke(myFluke)
+    monitor.start()
     result = None
     
     while True:
@@ -478,12 +1608,7 @@ if __name__=='__main__':
         print('')
         check_PC_offset()
         print('Instrument COM port: {0}'.format(myFluke.com_port))
-        resp, cmd = myFluke.get_identification()
-        resp = resp.decode().strip()
-        if len(resp)>0:
-            print('Instrument identification: {0}'.format(resp))
-        else:
-            print('NO RESPONSE FROM INSTRUMENT ON PORT {0}'.format(myFluke.com_port))
+        show_instrument_status()
         print('')
         print('')
         print('Menu options:')
@@ -502,7 +1627,8 @@ if __name__=='__main__':
         
         action = options.get(choice)['action']
         try:
-            result = action()
+            with myFluke.lock:
+                result = action()
         except LoopBreak:
             break
         except serial.SerialException:
@@ -513,5 +1639,6 @@ if __name__=='__main__':
         print('')
         input('Press any key to continue...')
     
+    monitor.stop()
     myFluke.close()
             
@@ -0,0 +1,383 @@
+#!/usr/bin/env python
+# Python 3.X
+
+"""Append-only archive of downloaded scan data.
+
+Each scan file of each instrument is stored as compressed column chunks,
+one file per column and chunk, next to a small JSON manifest:
+
+    <root>/<instrument>/<scan name>/manifest.json
+    <root>/<instrument>/<scan name>/time/000000.zz
+    <root>/<instrument>/<scan name>/101/000000.zz
+    ...
+
+The manifest holds the instrument identification, the scan name, the
+channel setup (from the conf file) and, per chunk, the number of rows and
+the time range. New rows are written as new chunk files; while the last
+chunk has fewer than ArchiveChunkRows rows it is merged with the new rows
+into a new chunk, so small appends do not pile up small chunks. The
+manifest is replaced before the merged chunk is removed, so an interrupted
+append leaves the archive as it was. Reading a channel only decompresses
+the chunks of that channel that overlap the requested time range.
+
+Per instrument, index.json maps every archived scan file to the time
+range of each of its chunks. It is updated on every append, so a time
+range query over all scan files of an instrument only opens the chunks
+that overlap the range, and within them binary searches the time stamps:
+
+    archive = ScanArchive('./archive')
+    fluke.download_data('SCAN1', archive=archive)
+    scan = archive.read_scan(fluke.instrument_id(), 'SCAN1', channels=['101'])
+    data = archive.read(fluke.instrument_id(), ['101'], '2020-07-07T02:00', '2020-07-07T03:00')
+
+Every append also updates min/max/mean levels of 1 min, 1 h and 1 day
+per scan file (see pyfluke1586A_pyramid.py), from which overview() returns
+long time ranges at the resolution needed for a plot:
+
+    ov = archive.overview(fluke.instrument_id(), ['101'], '2020-01-01', '2021-01-01', points=1000)
+"""
+
+import re
+import json
+import zlib
+import shutil
+from pathlib import Path
+
+import numpy as np
+
+from pyfluke1586A_data import ScanData, load_scan_rows
+from pyfluke1586A_pyramid import (pyramid_dir, can_update, update_pyramid, build_pyramid, read_level,
+                                  merge_bins, make_overview, scan_overview, choose_level)
+
+ArchiveChunkRows = 64*1024      # max number of rows per chunk
+ArchiveCompressLevel = 6        # zlib compression level of the chunks
+
+
+def _safe_name(name):
+    """Directory name for an instrument id or scan name."""
+    return re.sub(r'[^A-Za-z0-9_.-]+', '_', name).strip('_') or '_'
+
+
+class ScanArchive(object):
+    def __init__(self, root):
+        self.root = Path(root)
+
+    def _dir(self, instrument, name):
+        return self.root / _safe_name(instrument) / _safe_name(name)
+
+    def manifest(self, instrument, name):
+        """The manifest of a scan file, or None if it is not in the archive."""
+        p = self._dir(instrument, name) / 'manifest.json'
+        if not p.exists():
+            return None
+        return json.loads(p.read_text())
+
+    def _write_json(self, p, obj):
+        p_tmp = p.with_name(p.name+'.tmp')
+        p_tmp.write_text(json.dumps(obj, indent=2))
+        p_tmp.replace(p)
+
+    def _write_manifest(self, instrument, name, manifest):
+        self._write_json(self._dir(instrument, name) / 'manifest.json', manifest)
+        self._update_index(instrument, manifest)
+
+    def index(self, instrument):
+        """The time range index of an instrument: a dict with, per scan file,
+        its time range and the time range of each chunk."""
+        p = self.root / _safe_name(instrument) / 'index.json'
+        if not p.exists():
+            return self.rebuild_index(instrument)
+        return json.loads(p.read_text())
+
+    def _update_index(self, instrument, manifest):
+        p = self.root / _safe_name(instrument) / 'index.json'
+        index = json.loads(p.read_text()) if p.exists() else {'instrument': instrument, 'scans': {}}
+        chunks = manifest['chunks']
+        index['scans'][manifest['scan']] = {
+            'rows': manifest['rows'], 'channels': list(manifest['channels']),
+            'start': min(c['start'] for c in chunks) if chunks else None,
+            'end': max(c['end'] for c in chunks) if chunks else None,
+            'chunks': [[c['id'], c['start'], c['end']] for c in chunks]}
+        self._write_json(p, index)
+        return index
+
+    def rebuild_index(self, instrument):
+        """Rebuild the index of an instrument from the manifests."""
+        p = self.root / _safe_name(instrument) / 'index.json'
+        if p.exists():
+            p.unlink()
+        index = {'instrument': instrument, 'scans': {}}
+        for inst, name in self.scans(instrument):
+            index = self._update_index(instrument, self.manifest(inst, name))
+        return index
+
+    def scans(self, instrument=None):
+        """List of (instrument, scan name) in the archive, read from the manifests."""
+        pattern = '{0}/*/manifest.json'.format(_safe_name(instrument) if instrument else '*')
+        result = []
+        for p in sorted(self.root.glob(pattern)):
+            manifest = json.loads(p.read_text())
+            result.append((manifest['instrument'], manifest['scan']))
+        return result
+
+    def append(self, instrument, name, data, first_row=0):
+        """Append the rows of data (a ScanData, the scan file as downloaded
+        from row first_row on) that follow the archived rows of scan file
+        name. Returns the number of rows appended.
+
+        New rows are found by position, or by scan number if data has a scan
+        column, not by time: the instrument clock may have been set back
+        during the scan (a clock sync, a change from daylight saving time),
+        so time stamps need not increase. Such rows are archived as they
+        are; the time range of each chunk is the min and max of its times.
+        """
+        directory = self._dir(instrument, name)
+        manifest = self.manifest(instrument, name)
+        if manifest is None:
+            manifest = {'instrument': instrument, 'scan': name, 'rows': 0,
+                        'channels': {ch: {'name': data.names.get(ch, ch), 'unit': data.units.get(ch, '')}
+                                     for ch in data.channels},
+                        'columns': {'time': 'datetime64[ms]'}, 'chunks': []}
+            if data.scan is not None:
+                manifest['columns']['scan'] = 'int64'
+            for ch in data.channels:
+                manifest['columns'][ch] = 'float64'
+        elif set(data.channels) != set(manifest['channels']):
+            raise ValueError('Channels of {0} differ from the archived channels'.format(name))
+
+        # Only rows after the last archived row are appended
+        if data.scan is not None and manifest.get('last_scan') is not None:
+            first = int(np.searchsorted(data.scan, manifest['last_scan'], side='right'))
+        else:
+            first = manifest['rows']-first_row
+            if first < 0:
+                raise ValueError('Rows of {0} before row {1} are not archived'.format(name, first_row))
+        nrows = len(data.time)-first
+        if nrows <= 0:
+            return 0
+        rows_before = manifest['rows']
+
+        columns = {'time': data.time, 'scan': data.scan}
+        columns.update(data.values)
+        columns = {column: np.asarray(columns[column][first:], dtype=dtype)
+                   for column, dtype in manifest['columns'].items()}
+        chunk_id = max([c['id'] for c in manifest['chunks']], default=-1)+1
+        merged = None
+        if manifest['chunks'] and manifest['chunks'][-1]['rows'] < ArchiveChunkRows:
+            # The last chunk and the new rows are written as a new chunk
+            merged = manifest['chunks'].pop()
+            for column, dtype in manifest['columns'].items():
+                columns[column] = np.concatenate([self._read_column(directory, column, dtype, merged['id']),
+                                                  columns[column]])
+        for start in range(0, len(columns['time']), ArchiveChunkRows):
+            stop = min(start+ArchiveChunkRows, len(columns['time']))
+            for column, dtype in manifest['columns'].items():
+                p = directory / _safe_name(column) / '{0:06d}.zz'.format(chunk_id)
+                p.parent.mkdir(parents=True, exist_ok=True)
+                values = np.ascontiguousarray(columns[column][start:stop])
+                p.write_bytes(zlib.compress(values.tobytes(), ArchiveCompressLevel))
+            manifest['chunks'].append({'id': chunk_id, 'rows': stop-start,
+                                       'start': str(columns['time'][start:stop].min()),
+                                       'end': str(columns['time'][start:stop].max())})
+            chunk_id += 1
+        manifest['rows'] += nrows
+        if data.scan is not None:
+            manifest['last_scan'] = int(data.scan[-1])
+        state = manifest.get('pyramid')
+        if (state is not None or rows_before == 0) and can_update(state, data.time[first:]):
+            manifest['pyramid'] = update_pyramid(pyramid_dir(directory, state), state, data.time[first:],
+                                                 {ch: data[ch][first:] for ch in manifest['channels']})
+            self._write_manifest(instrument, name, manifest)
+        else:
+            # The clock was set back, or the scan file was archived before
+            # the levels were added
+            self._rebuild_pyramid(instrument, name, manifest)
+        if merged is not None:
+            for column in manifest['columns']:
+                (directory / _safe_name(column) / '{0:06d}.zz'.format(merged['id'])).unlink()
+        return nrows
+
+    def _rebuild_pyramid(self, instrument, name, manifest):
+        """Build the levels of all archived rows in a new directory, write
+        the manifest and remove the old levels."""
+        directory = self._dir(instrument, name)
+        old = manifest.get('pyramid')
+        columns = ['time']+list(manifest['channels'])
+        parts = {column: [self._read_column(directory, column, manifest['columns'][column], chunk['id'])
+                          for chunk in manifest['chunks']] for column in columns}
+        arrays = {column: np.concatenate(parts[column]) if parts[column] else
+                  np.empty(0, dtype=manifest['columns'][column]) for column in columns}
+        manifest['pyramid'] = build_pyramid(directory, (old or {}).get('generation', 0)+1, arrays['time'],
+                                            {ch: arrays[ch] for ch in manifest['channels']})
+        self._write_manifest(instrument, name, manifest)
+        if pyramid_dir(directory, old) != pyramid_dir(directory, manifest['pyramid']):
+            shutil.rmtree(pyramid_dir(directory, old), ignore_errors=True)
+        return manifest['pyramid']
+
+    def rebuild_pyramid(self, instrument, name):
+        """Rebuild the min/max/mean levels of a scan file from its chunks."""
+        manifest = self.manifest(instrument, name)
+        if manifest is None:
+            raise KeyError('{0} of {1} is not in the archive'.format(name, instrument))
+        return self._rebuild_pyramid(instrument, name, manifest)
+
+    def append_download(self, instrument, directory, name=None):
+        """Append a scan file downloaded by Fluke1586A.download_data (the
+        csv files in directory) to the archive.
+
+        The position in the data file up to which rows were read is kept in
+        the manifest, and only the rest of the file is parsed (see
+        load_scan_rows), so appending after an incremental download does
+        not parse the whole file again."""
+        directory = Path(directory)
+        name = directory.name if name is None else name
+        manifest = self.manifest(instrument, name)
+        mark = None if manifest is None else manifest.get('download')
+        data, first_row, new_mark = load_scan_rows(directory, name, mark)
+        if data is None:
+            return 0
+        nrows = self.append(instrument, name, data, first_row)
+        manifest = self.manifest(instrument, name)
+        if new_mark != manifest.get('download'):
+            manifest['download'] = new_mark
+            self._write_json(self._dir(instrument, name) / 'manifest.json', manifest)
+        return nrows
+
+    def _read_column(self, directory, column, dtype, chunk_id):
+        p = directory / _safe_name(column) / '{0:06d}.zz'.format(chunk_id)
+        return np.frombuffer(zlib.decompress(p.read_bytes()), dtype=dtype)
+
+    def read_scan(self, instrument, name, channels=None, start=None, end=None):
+        """Read channels (default: all) of a scan file as a ScanData object,
+        optionally only the rows with start <= time < end."""
+        manifest = self.manifest(instrument, name)
+        if manifest is None:
+            raise KeyError('{0} of {1} is not in the archive'.format(name, instrument))
+        directory = self._dir(instrument, name)
+        channels = list(manifest['channels']) if channels is None else [str(ch) for ch in channels]
+        start = None if start is None else np.datetime64(start, 'ms')
+        end = None if end is None else np.datetime64(end, 'ms')
+
+        columns = ['time']+(['scan'] if 'scan' in manifest['columns'] else [])+channels
+        parts = {column: [] for column in columns}
+        for chunk in manifest['chunks']:
+            if not _overlaps(chunk['start'], chunk['end'], start, end):
+                continue
+            time = self._read_column(directory, 'time', manifest['columns']['time'], chunk['id'])
+            if np.all(time[1:] >= time[:-1]):
+                lo = 0 if start is None else int(np.searchsorted(time, start, side='left'))
+                hi = len(time) if end is None else int(np.searchsorted(time, end, side='left'))
+                rows = slice(lo, hi)
+            else:
+                # the clock was set back within the chunk
+                rows = np.ones(len(time), dtype=bool)
+                if start is not None:
+                    rows &= time >= start
+                if end is not None:
+                    rows &= time < end
+            parts['time'].append(time[rows])
+            for column in columns[1:]:
+                parts[column].append(self._read_column(directory, column, manifest['columns'][column], chunk['id'])[rows])
+
+        arrays = {column: np.concatenate(parts[column]) if parts[column] else
+                  np.empty(0, dtype=manifest['columns'][column]) for column in columns}
+        return ScanData(arrays['time'], {ch: arrays[ch] for ch in channels}, channels=channels,
+                        scan=arrays.get('scan'),
+                        names={ch: manifest['channels'][ch]['name'] for ch in channels},
+                        units={ch: manifest['channels'][ch]['unit'] for ch in channels})
+
+    def read(self, instrument, channels=None, start=None, end=None):
+        """Read channels (default: all) of all archived scan files of an
+        instrument with start <= time < end, as one ScanData sorted by time.
+
+        Only the scan files and chunks that overlap the range (according to
+        the index) are opened. Channels missing from a scan file are NaN in
+        its rows.
+        """
+        index = self.index(instrument)
+        start = None if start is None else np.datetime64(start, 'ms')
+        end = None if end is None else np.datetime64(end, 'ms')
+        if channels is None:
+            channels = sorted(set(ch for entry in index['scans'].values() for ch in entry['channels']))
+        channels = [str(ch) for ch in channels]
+
+        times, values = [], {ch: [] for ch in channels}
+        names, units = {ch: ch for ch in channels}, {ch: '' for ch in channels}
+        for name, entry in sorted(index['scans'].items()):
+            if entry['start'] is None or not _overlaps(entry['start'], entry['end'], start, end):
+                continue
+            present = [ch for ch in channels if ch in entry['channels']]
+            data = self.read_scan(instrument, name, present, start, end)
+            times.append(data.time)
+            for ch in channels:
+                if ch in present:
+                    values[ch].append(data[ch])
+                    names[ch], units[ch] = data.names[ch], data.units[ch]
+                else:
+                    values[ch].append(np.full(len(data), np.nan))
+
+        if not times:
+            return ScanData(np.empty(0, dtype='datetime64[ms]'), {ch: np.empty(0) for ch in channels},
+                            channels=channels, names=names, units=units)
+        time = np.concatenate(times)
+        order = np.argsort(time, kind='stable')
+        return ScanData(time[order], {ch: np.concatenate(values[ch])[order] for ch in channels},
+                        channels=channels, names=names, units=units)
+
+
+    def overview_scan(self, instrument, name, channels=None, start=None, end=None, points=1000):
+        """Min, max and mean of channels (default: all) of a scan file with
+        start <= time < end, as an Overview (see pyfluke1586A_pyramid.py) of
+        the coarsest level with at least points bins in the range. Short
+        ranges are returned at full resolution."""
+        manifest = self.manifest(instrument, name)
+        if manifest is None:
+            raise KeyError('{0} of {1} is not in the archive'.format(name, instrument))
+        channels = list(manifest['channels']) if channels is None else [str(ch) for ch in channels]
+        if not manifest['chunks']:
+            return scan_overview(self.read_scan(instrument, name, channels))
+        level = choose_level(min(c['start'] for c in manifest['chunks']) if start is None else start,
+                             max(c['end'] for c in manifest['chunks']) if end is None else end, points)
+        if level == 0:
+            return scan_overview(self.read_scan(instrument, name, channels, start, end))
+        if 'pyramid' not in manifest:
+            manifest['pyramid'] = self.rebuild_pyramid(instrument, name)
+        time, columns = read_level(pyramid_dir(self._dir(instrument, name), manifest['pyramid']),
+                                   manifest['pyramid'], level, channels, start, end)
+        return make_overview(level, time, columns, channels)
+
+    def overview(self, instrument, channels=None, start=None, end=None, points=1000):
+        """Like overview_scan, over all archived scan files of an instrument
+        (like read). Bins of different scan files with the same time are
+        combined."""
+        index = self.index(instrument)
+        if channels is None:
+            channels = sorted(set(ch for entry in index['scans'].values() for ch in entry['channels']))
+        channels = [str(ch) for ch in channels]
+        ranges = [(entry['start'], entry['end']) for entry in index['scans'].values() if entry['start'] is not None]
+        if not ranges:
+            return scan_overview(self.read(instrument, channels, start, end))
+        level = choose_level(min(r[0] for r in ranges) if start is None else start,
+                             max(r[1] for r in ranges) if end is None else end, points)
+        if level == 0:
+            return scan_overview(self.read(instrument, channels, start, end))
+
+        parts = []
+        for name, entry in sorted(index['scans'].items()):
+            if entry['start'] is None or not _overlaps(entry['start'], entry['end'],
+                                                       None if start is None else np.datetime64(start, 'ms'),
+                                                       None if end is None else np.datetime64(end, 'ms')):
+                continue
+            manifest = self.manifest(instrument, name)
+            state = manifest.get('pyramid') or self.rebuild_pyramid(instrument, name)
+            present = [ch for ch in channels if ch in entry['channels']]
+            parts.append(read_level(pyramid_dir(self._dir(instrument, name), state), state, level, present, start, end))
+        time, columns = merge_bins(parts, channels)
+        return make_overview(level, time, columns, channels)
+
+
+def _overlaps(chunk_start, chunk_end, start, end):
+    """True if the time range [chunk_start, chunk_end] (iso strings) overlaps
+    start <= time < end (datetime64 or None)."""
+    return not ((start is not None and np.datetime64(chunk_end, 'ms') < start) or
+                (end is not None and np.datetime64(chunk_start, 'ms') >= end))
@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+# Python 3.X
+
+# Serial ports require pyserial-asyncio:
+# pip install pyserial-asyncio
+
+"""asyncio driver for the Fluke 1586A Super-DAQ.
+
+AsyncFluke1586A offers the same operations as Fluke1586A, but all serial
+I/O is done on an asyncio transport, so a single event loop can drive many
+instruments concurrently:
+
+    async def main():
+        async with AsyncFluke1586A('socket://192.168.1.10:3490') as fluke:
+            resp, cmd = await fluke.get_identification()
+
+    asyncio.run(main())
+
+socket:// URLs are handled directly by asyncio; serial ports are opened
+through pyserial-asyncio.
+"""
+
+import math
+import time
+import socket
+import asyncio
+import logging
+import datetime as dt
+from pathlib import Path
+from urllib.parse import urlsplit
+
+from pyfluke1586A import (TimeOutLimitSecsFluke1586A, IdleTimeoutSecs, StallTimeoutSecs,
+                          DownloadChunkSize, TruncatedResponse, NewlineNormalizer,
+                          format_command, _convert_reply, _is_query)
+
+try:
+    import serial_asyncio
+except ImportError:
+    serial_asyncio = None
+
+
+class _ReceiveProtocol(asyncio.Protocol):
+    """Collects data from the transport in a buffer that the driver consumes.
+
+    Reading from the transport is paused while more than high_water bytes
+    are waiting, so memory stays bounded however fast the instrument sends.
+    """
+    def __init__(self, high_water=4*DownloadChunkSize):
+        self.buffer = bytearray()
+        self.high_water = high_water
+        self.transport = None
+        self.paused = False
+        self.closed = False
+        self._event = asyncio.Event()
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.buffer += data
+        self._event.set()
+        if len(self.buffer) > self.high_water and not self.paused:
+            self.transport.pause_reading()
+            self.paused = True
+
+    def connection_lost(self, exc):
+        self.closed = True
+        self._event.set()
+
+    def consume(self, n=None):
+        """Remove and return the first n bytes (default: all) of the buffer."""
+        if n is None:
+            n = len(self.buffer)
+        data = bytes(self.buffer[:n])
+        del self.buffer[:n]
+        if self.paused and len(self.buffer) <= self.high_water//2:
+            self.transport.resume_reading()
+            self.paused = False
+        return data
+
+    async def wait_for_data(self, nbytes, timeout):
+        """Wait until the buffer holds more than nbytes bytes.
+        Returns False if the timeout expires first."""
+        deadline = time.monotonic() + timeout
+        while len(self.buffer) <= nbytes:
+            if self.closed:
+                return False
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            self._event.clear()
+            try:
+                await asyncio.wait_for(self._event.wait(), remaining)
+            except asyncio.TimeoutError:
+                return len(self.buffer) > nbytes
+        return True
+
+
+class AsyncFluke1586A(object):
+    def __init__(self, com_port, nickname='', baudrate=9600,
+                 timeout=TimeOutLimitSecsFluke1586A, debug=False, download_dir='./downloads'):
+        self.debug = debug
+        self.com_port = com_port
+        self.nickname = nickname
+        self.download_dir = Path(download_dir)
+        self.baudrate = baudrate
+        self.timeout = timeout
+        self.transport = None
+        self.protocol = None
+
+    async def __aenter__(self):
+        await self.open()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.close()
+
+    async def open(self):
+        loop = asyncio.get_running_loop()
+        url = urlsplit(self.com_port)
+        if url.scheme == 'socket':
+            self.transport, self.protocol = await loop.create_connection(
+                _ReceiveProtocol, url.hostname, url.port)
+            sock = self.transport.get_extra_info('socket')
+            if sock is not None:
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        else:
+            if serial_asyncio is None:
+                raise ImportError('pyserial-asyncio is required to open {0} asynchronously'.format(self.com_port))
+            self.transport, self.protocol = await serial_asyncio.create_serial_connection(
+                loop, _ReceiveProtocol, self.com_port, baudrate=self.baudrate)
+        logging.info('Port {0} opened asynchronously ({1})'.format(self.com_port, self.nickname))
+
+    def close(self):
+        if self.transport is not None:
+            self.transport.close()
+            self.transport = None
+            logging.info('Port {0} closed ({1})'.format(self.com_port, self.nickname))
+
+    async def send_message(self, command, arguments=None, get_response=True):
+        CmdString = format_command(command, arguments)
+
+        # First flush any unread input
+        self.protocol.consume()
+
+        # Now write the command
+        self.transport.write(('\r'+CmdString).encode())
+
+        if self.debug:
+            print("Command:  " + CmdString)
+
+        reply = None
+        if get_response:
+            reply = await self.get_response()
+            if self.debug:
+                print("Response: " + reply.decode())
+
+        return reply, CmdString
+
+    async def get_response(self, timeout=None, terminated=True):
+        """Read a response from the instrument, see Fluke1586A.get_response()."""
+        if timeout is None:
+            timeout = self.timeout
+
+        p = self.protocol
+        if not await p.wait_for_data(0, timeout):
+            return b''
+        while True:
+            if terminated and b'\r' in p.buffer:
+                break
+            if not await p.wait_for_data(len(p.buffer), IdleTimeoutSecs):
+                break
+        return p.consume().strip()
+
+    async def iter_response(self, timeout=None, chunk_size=DownloadChunkSize, size=None):
+        """Asynchronously yield an unterminated response in chunks of at most
+        chunk_size bytes, see Fluke1586A.iter_response()."""
+        if timeout is None:
+            timeout = self.timeout
+
+        p = self.protocol
+        if not await p.wait_for_data(0, timeout):
+            if size:
+                raise TruncatedResponse('No response, expected {0:d} bytes'.format(size))
+            return
+
+        block = size is None and p.buffer[0] == ord('#')
+        if block:
+            # SCPI definite-length block header: #<n><length>
+            if not await p.wait_for_data(1, StallTimeoutSecs):
+                raise TruncatedResponse('Incomplete block header')
+            ndigits = int(p.buffer[1:2])
+            if not await p.wait_for_data(1+ndigits, StallTimeoutSecs):
+                raise TruncatedResponse('Incomplete block header')
+            size = int(p.buffer[2:2+ndigits]) if ndigits > 0 else None
+            p.consume(2+ndigits)
+
+        received = 0
+        remaining = size
+        while True:
+            if remaining == 0:
+                if block or len(p.buffer) == 0:
+                    break
+                # The reply is longer than announced, do not truncate it
+                logging.info('Response exceeds {0:d} bytes, reading until idle   ({1}@{2})'.format(size, self.nickname, self.com_port))
+                remaining = None
+                size = None
+            n = chunk_size if remaining is None else min(chunk_size, remaining)
+            if len(p.buffer) < n:
+                idle = IdleTimeoutSecs if remaining is None else StallTimeoutSecs
+                if not await p.wait_for_data(len(p.buffer), idle):
+                    if len(p.buffer) == 0:
+                        break
+            chunk = p.consume(min(n, len(p.buffer)))
+            received += len(chunk)
+            if remaining is not None:
+                remaining -= len(chunk)
+            yield chunk
+
+        if remaining:
+            raise TruncatedResponse('Response ended after {0:d} of {1:d} bytes'.format(received, size))
+
+    async def store_response(self, p, timeout=None, size=None):
+        """Stream an unterminated response to the file p, see
+        Fluke1586A.store_response(). Returns bytes received and bytes/sec."""
+        normalizer = NewlineNormalizer()
+        nbytes = 0
+        tstart = time.time()
+        with p.open(mode='w', newline='') as fh:
+            async for chunk in self.iter_response(timeout=timeout, size=size):
+                nbytes += len(chunk)
+                fh.write(normalizer.feed(chunk))
+            fh.write(normalizer.close())
+        elapsed = time.time()-tstart
+        rate = nbytes/elapsed if elapsed > 0 else 0.
+        return nbytes, rate
+
+    async def _query(self, title, cmd, arguments=None):
+        # Setters have no reply, so do not wait for one
+        resp, cmd = await self.send_message(cmd, arguments, get_response=_is_query(cmd))
+        logging.info('{0}: {1}   ({2}@{3}:{4})'.format(title, resp, self.nickname, self.com_port, cmd))
+        return resp, cmd
+
+    async def get_identification(self):
+        return await self._query('get_status', '*idn?')
+
+    async def get_version(self):
+        return await self._query('get_version', 'SYST:VERS?')
+
+    async def get_date(self):
+        return await self._query('get_date', 'SYST:DATE?')
+
+    async def get_time(self):
+        return await self._query('get_time', 'SYST:TIME?')
+
+    async def set_date(self):
+        t1 = dt.date.today()
+        return await self._query('set_date', 'SYST:DATE', [t1.year, t1.month, t1.day])
+
+    async def set_time(self):
+        t1 = dt.datetime.now()
+        arguments = [t1.hour, t1.minute, math.ceil(t1.second+t1.microsecond/1e6)]
+        return await self._query('set_time', 'SYST:TIME', arguments)
+
+    async def probe_offset(self, samples=1):
+        """Measure the offset of the instrument clock relative to the PC clock,
+        see Fluke1586A.probe_offset(). Returns the offset and the round trip
+        of the sample with the shortest round trip (datetime.timedelta)."""
+        best = None
+        for id in range(samples):
+            fdate, cmd = await self.get_date()
+            t1 = dt.datetime.now()
+            ftime, cmd = await self.get_time()
+            t2 = dt.datetime.now()
+            com_delay = (t2-t1)
+            if best is None or com_delay < best[2]:
+                fdate = _convert_reply('SYST:DATE?', fdate)
+                ftime = _convert_reply('SYST:TIME?', ftime)
+                best = (dt.datetime(*fdate, *ftime), t1+com_delay/2, com_delay)
+        f_datetime, pc_datetime, com_delay = best
+        return f_datetime-pc_datetime, com_delay
+
+    async def get_offset(self, samples=1):
+        """Return the offset of the instrument clock relative to the PC clock
+        (datetime.timedelta), see Fluke1586A.get_offset()."""
+        offset, com_delay = await self.probe_offset(samples)
+        logging.info('get_offset: {0:.1f} s, comm delay {1:.2f} s   ({2}@{3})'.format(
+            offset.total_seconds(), com_delay.total_seconds(), self.nickname, self.com_port))
+        return offset
+
+    async def sync_datetime(self):
+        """Set instrument date and time to PC date and time.
+        Returns the instrument offsets before and after synchronization."""
+        before = await self.get_offset()
+        t1 = dt.datetime.now()
+        commands = [('SYST:DATE', [t1.year, t1.month, t1.day]),
+                    ('SYST:TIME', [t1.hour, t1.minute, math.ceil(t1.second+t1.microsecond/1e6)])]
+        # Date and time in one compound command, as Fluke1586A.sync_datetime
+        await self.send_message(';:'.join(format_command(cmd, arguments)[:-1] for cmd, arguments in commands),
+                                get_response=False)
+        after = await self.get_offset()
+        logging.info('sync_datetime: offset {0:.1f} s -> {1:.1f} s   ({2}@{3})'.format(
+            before.total_seconds(), after.total_seconds(), self.nickname, self.com_port))
+        return before, after
+
+    async def get_values(self, slot, id):
+        if not isinstance(slot, int):
+            raise ValueError('The data slot must be an integer value!')
+        await self.send_message('LOG:AUT:LAB', [slot], get_response=False)
+        await self.send_message('LOG:AUT:VAL?', [id], get_response=False)
+        return await self.get_response(terminated=False)
+
+    async def download_data(self, name=None, size=None):
+        """Download the scan file name and its setup info to <download_dir>/<name>/,
+        see Fluke1586A.download_data()."""
+        (self.download_dir / name).mkdir(parents=True, exist_ok=True)
+
+        for query, suffix, nbytes in [('MEM:LOG:READ?', 'data', size),
+                                      ('MEM:LOG:READ:CONF?', 'conf', None)]:
+            p = self.download_dir / name / '{0}_{1}.csv'.format(name, suffix)
+            await self.send_message(query, [name], get_response=False)
+            nbytes, rate = await self.store_response(p, size=nbytes)
+            logging.info('download_data: {0} bytes at {1:.1f} bytes/s   ({2}@{3}:{4})'.format(nbytes, rate, self.nickname, self.com_port, p))
+
+    async def initiate_scan(self):
+        return await self._query('INIT', 'INIT')
+
+    async def abort_scan(self):
+        return await self._query('ABOR', 'ABOR')
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# Python 3.X
+
+"""Throughput and latency benchmarks of pyfluke1586A against the simulator.
+
+Starts a Fluke1586ASimulator (see pyfluke1586A_sim.py) and measures
+
+    latency    per command round trip (median, 95th percentile, max)
+    catalog    time to list all scan files
+    download   MB/s and CPU use (of the driver thread) of a full scan file download
+    parse      rows/s of parsing the downloaded file (pyfluke1586A_data)
+
+The results are printed as a table and can be saved as JSON for comparing
+runs, e.g. before and after a change:
+
+    python pyfluke1586A_bench.py --rows 200000 --json bench_output.txt
+    python pyfluke1586A_bench.py --baud 115200 --latency 0.005
+"""
+
+import sys
+import time
+import json
+import argparse
+import tempfile
+from pathlib import Path
+
+from pyfluke1586A import Fluke1586A, Fluke1586AMetrics, _file_size
+from pyfluke1586A_sim import Fluke1586ASimulator
+from pyfluke1586A_data import load_scan
+
+BenchCommands = ['*idn?', 'SYST:VERS?', 'SYST:DATE?', 'SYST:TIME?', 'MEM:LOG:NFIL?']
+
+
+def _percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values)-1, int(q*len(values)))]
+
+
+class _Timer(object):
+    """Wall clock and CPU time of a block. The CPU time is that of the
+    calling thread only, not of e.g. the simulator in the same process."""
+    def __enter__(self):
+        self.wall = time.perf_counter()
+        self.cpu = time.thread_time()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.wall = time.perf_counter()-self.wall
+        self.cpu = time.thread_time()-self.cpu
+
+
+def bench_latency(fluke, repeat):
+    results = {}
+    for cmd in BenchCommands:
+        times = []
+        for id in range(repeat):
+            with _Timer() as t:
+                fluke.send_message(cmd)
+            times.append(t.wall)
+        results[cmd] = {'median': _percentile(times, 0.5), 'p95': _percentile(times, 0.95), 'max': max(times)}
+    with _Timer() as t:
+        for id in range(repeat):
+            fluke.get_offset()
+    results['get_offset'] = {'median': t.wall/repeat, 'p95': None, 'max': None}
+    return results
+
+
+def bench_download(fluke, name):
+    info = fluke.get_scan_file_info(name)
+    with _Timer() as t:
+        fluke.download_data(name, size=_file_size(info))
+    nbytes = (fluke.download_dir / name / '{0}_data.csv'.format(name)).stat().st_size
+    return {'bytes': nbytes, 'secs': t.wall, 'MB/s': nbytes/t.wall/1e6, 'cpu': t.cpu/t.wall}
+
+
+def bench_parse(fluke, name):
+    with _Timer() as t:
+        scan = load_scan(fluke.download_dir / name, cache=False)
+    return {'rows': len(scan), 'secs': t.wall, 'rows/s': len(scan)/t.wall}
+
+
+def run_benchmarks(url, repeat=20, download_dir=None):
+    """Run all benchmarks against the instrument (or simulator) at url.
+    Files are downloaded to download_dir (default: a temporary directory)."""
+    if download_dir is None:
+        with tempfile.TemporaryDirectory() as tmp:
+            return run_benchmarks(url, repeat, tmp)
+    fluke = Fluke1586A(url, verbose=False, download_dir=download_dir)
+    fluke.enable_metrics(Fluke1586AMetrics())
+    try:
+        results = {'port': url}
+        results['latency'] = bench_latency(fluke, repeat)
+        with _Timer() as t:
+            files = fluke.list_scan_files(refresh=True)
+        results['catalog'] = {'files': len(files), 'secs': t.wall}
+        name = max(files, key=lambda info: _file_size(info) or 0)['name']
+        results['download'] = bench_download(fluke, name)
+        results['parse'] = bench_parse(fluke, name)
+        results['metrics'] = fluke.metrics.to_dict()
+    finally:
+        fluke.close()
+    return results
+
+
+def format_results(results):
+    lines = ['Benchmark of {0}'.format(results['port']), '', 'Latency (ms)      median     p95     max']
+    for cmd, lat in results['latency'].items():
+        lines.append('{0:<15s} {1:8.2f} {2:>7s} {3:>7s}'.format(
+            cmd, 1e3*lat['median'],
+            *['-' if lat[k] is None else '{0:.2f}'.format(1e3*lat[k]) for k in ['p95', 'max']]))
+    cat, down, parse = results['catalog'], results['download'], results['parse']
+    lines.append('')
+    lines.append('Catalog:   {0:d} files in {1:.3f} s'.format(cat['files'], cat['secs']))
+    lines.append('Download:  {0:d} bytes in {1:.3f} s, {2:.2f} MB/s, CPU {3:.0%}'.format(
+        down['bytes'], down['secs'], down['MB/s'], down['cpu']))
+    lines.append('Parse:     {0:d} rows in {1:.3f} s, {2:.0f} rows/s'.format(parse['rows'], parse['secs'], parse['rows/s']))
+    return '\n'.join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark pyfluke1586A against a simulated Fluke 1586A.')
+    parser.add_argument('--port', default=None, help='benchmark this port/URL instead of starting the simulator')
+    parser.add_argument('--pty', action='store_true', help='connect to the simulator through a pseudo terminal')
+    parser.add_argument('--baud', type=int, default=None, help='emulated serial transfer rate')
+    parser.add_argument('--latency', type=float, default=0., help='simulated reply latency in seconds')
+    parser.add_argument('--files', type=int, default=2)
+    parser.add_argument('--rows', type=int, default=100000, help='rows per simulated scan file')
+    parser.add_argument('--channels', type=int, default=4)
+    parser.add_argument('--repeat', type=int, default=20, help='round trips per command')
+    parser.add_argument('--json', default=None, help='also save the results as JSON to this file')
+    args = parser.parse_args(argv)
+
+    sim = None
+    url = args.port
+    if url is None:
+        sim = Fluke1586ASimulator(files=args.files, rows=args.rows, channels=args.channels,
+                                  baudrate=args.baud, latency=args.latency)
+        url = sim.serve_pty() if args.pty else sim.serve_tcp()
+    try:
+        results = run_benchmarks(url, repeat=args.repeat)
+    finally:
+        if sim is not None:
+            sim.close()
+
+    print(format_results(results))
+    if args.json:
+        Path(args.json).write_text(json.dumps(results, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
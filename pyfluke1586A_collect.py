@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# Python 3.X
+
+"""Unattended, scheduled data collection from a fleet of Fluke 1586A.
+
+    python pyfluke1586A_collect.py --config fleet.toml --every 10m --incremental
+    python pyfluke1586A_collect.py --config fleet.toml --once      # e.g. from cron
+
+The instruments are read from the fleet config file (see
+pyfluke1586A_fleet.py). Three tasks are scheduled, each at its own
+interval plus a random jitter, so a rack of collectors does not hit the
+instruments (or the network) at the same moment:
+
+    download   download all scan files (--every)
+    sync       synchronize the instrument clock if it is off by more than
+               --max-offset seconds (--sync-every)
+    health     check that the instrument answers and log its clock offset
+               (--health-every)
+
+Ports are opened once and the sessions are kept open between cycles; a
+failing instrument is reopened at its next task. Each task runs in a
+worker thread of its instrument and is abandoned after --timeout seconds,
+so one hanging instrument does not delay the others. The status of the
+last run of each task is written to <download dir>/collector_status.json.
+
+Heavy modules are only imported when needed, so a one-shot run starts
+quickly.
+"""
+
+import sys
+import time
+import json
+import random
+import signal
+import logging
+import argparse
+import threading
+from pathlib import Path
+
+CollectorTasks = ['download', 'sync', 'health']
+
+
+def parse_interval(text):
+    """Interval in seconds from e.g. '90', '30s', '10m', '2h' or '1d'."""
+    units = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}
+    text = str(text).strip().lower()
+    if text and text[-1] in units:
+        return float(text[:-1])*units[text[-1]]
+    return float(text)
+
+
+class Collector(object):
+    def __init__(self, instruments, download_dir='./downloads', incremental=False, archive=None,
+                 intervals=None, jitter=0., timeout=600., max_offset=1.0):
+        self.instruments = [dict(inst) for inst in instruments]
+        self.download_dir = Path(download_dir)
+        self.incremental = incremental
+        self.archive = archive
+        self.intervals = intervals or {'download': 600., 'sync': 86400., 'health': 60.}
+        self.jitter = jitter
+        self.timeout = timeout
+        self.max_offset = max_offset
+        self.sessions = {}      # nickname -> open Fluke1586A
+        self.workers = {}       # nickname -> ThreadPoolExecutor with one thread
+        self.busy = {}          # nickname -> Future of the running task
+        self.status = {}
+        self._stop = threading.Event()
+
+    def _session(self, inst):
+        """The shared session (Fluke1586A.session) of instrument inst."""
+        from pyfluke1586A import Fluke1586A
+        from pyfluke1586A_fleet import driver_kwargs
+        nickname = inst['nickname']
+        kwargs = driver_kwargs(inst)
+        kwargs.setdefault('download_dir', self.download_dir / nickname)
+        fluke = self.sessions[nickname] = Fluke1586A.session(inst['port'], nickname=nickname, verbose=False, **kwargs)
+        return fluke
+
+    def _drop_session(self, nickname):
+        # A closed session is reopened by the next Fluke1586A.session() call
+        fluke = self.sessions.pop(nickname, None)
+        if fluke is not None:
+            fluke.close()
+
+    def _task(self, task, inst):
+        fluke = self._session(inst)
+        with fluke.lock:
+            if task == 'download':
+                return [info['name'] for info in fluke.download_all(incremental=self.incremental, archive=self.archive)]
+            offset, delay = fluke.probe_offset(3)
+            offset = offset.total_seconds()
+            if task == 'sync' and abs(offset) > self.max_offset:
+                before, after = fluke.sync_datetime()
+                return {'offset_before': before.total_seconds(), 'offset_after': after.total_seconds()}
+            return {'idn': fluke.instrument_id(), 'offset': offset, 'delay': delay.total_seconds()}
+
+    def run_task(self, task):
+        """Run task on all instruments in parallel, each for at most
+        self.timeout seconds. Returns a dict nickname -> status."""
+        from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+        started = {}
+        results = {}
+        for inst in self.instruments:
+            nickname = inst['nickname']
+            future = self.busy.get(nickname)
+            if future is not None and not future.done():
+                results[nickname] = {'ok': False, 'error': 'busy with a previous task'}
+                continue
+            worker = self.workers.get(nickname)
+            if worker is None:
+                worker = self.workers[nickname] = ThreadPoolExecutor(max_workers=1, thread_name_prefix=nickname)
+            started[nickname] = self.busy[nickname] = worker.submit(self._task, task, inst)
+
+        deadline = time.time()+self.timeout
+        for nickname, future in started.items():
+            try:
+                value = future.result(timeout=max(0., deadline-time.time()))
+                results[nickname] = {'ok': True, 'value': value}
+            except TimeoutError:
+                results[nickname] = {'ok': False, 'error': 'timed out after {0:.0f} s'.format(self.timeout)}
+            except Exception as e:
+                results[nickname] = {'ok': False, 'error': '{0}: {1}'.format(type(e).__name__, e)}
+                self._drop_session(nickname)    # reopen the port next time
+            logging.info('collect {0}: {1}   ({2})'.format(task, results[nickname], nickname))
+
+        now = time.strftime('%Y-%m-%dT%H:%M:%S')
+        for nickname, res in results.items():
+            res['time'] = now
+            self.status.setdefault(nickname, {})[task] = res
+        self._write_status()
+        return results
+
+    def _write_status(self):
+        self.download_dir.mkdir(parents=True, exist_ok=True)
+        p = self.download_dir / 'collector_status.json'
+        p_tmp = p.with_name(p.name+'.tmp')
+        p_tmp.write_text(json.dumps(self.status, indent=2, default=str))
+        p_tmp.replace(p)
+
+    def _next(self, task, now):
+        return now+self.intervals[task]+random.uniform(0, self.jitter)
+
+    def run(self, once=False):
+        """Run the tasks on schedule until stop() is called, or each task once."""
+        tasks = [task for task in CollectorTasks if self.intervals.get(task)]
+        if not tasks:
+            raise ValueError('All task intervals are 0, nothing to run')
+        if once:
+            for task in tasks:
+                self.run_task(task)
+            return
+        due = {task: time.time()+random.uniform(0, self.jitter) for task in tasks}
+        while not self._stop.is_set():
+            task = min(due, key=due.get)
+            if self._stop.wait(max(0., due[task]-time.time())):
+                break
+            self.run_task(task)
+            due[task] = self._next(task, time.time())
+
+    def stop(self):
+        self._stop.set()
+
+    def close(self):
+        for worker in self.workers.values():
+            worker.shutdown(wait=False)
+        for nickname in list(self.sessions):
+            self._drop_session(nickname)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Collect data from Fluke 1586A scanners on a schedule.')
+    parser.add_argument('--config', required=True, help='TOML file listing the instruments')
+    parser.add_argument('--every', default='10m', help='download interval, e.g. 10m (0: no downloads)')
+    parser.add_argument('--sync-every', default='1d', help='clock sync interval (0: never)')
+    parser.add_argument('--health-every', default='1m', help='health check interval (0: never)')
+    parser.add_argument('--jitter', default='30s', help='max random delay added to each interval')
+    parser.add_argument('--timeout', default='10m', help='max duration of a task on one instrument')
+    parser.add_argument('--max-offset', type=float, default=1.0, help='sync clocks off by more than this (s)')
+    parser.add_argument('--incremental', action='store_true', help='only download new rows')
+    parser.add_argument('--archive', default=None, help='also append downloads to this archive directory')
+    parser.add_argument('--download-dir', default='./downloads')
+    parser.add_argument('--once', action='store_true', help='run each task once and exit')
+    parser.add_argument('--log', default=None, help='log file (default: log to stderr)')
+    args = parser.parse_args(argv)
+    intervals = {}
+    for task, option in [('download', 'every'), ('sync', 'sync_every'), ('health', 'health_every')]:
+        try:
+            intervals[task] = parse_interval(getattr(args, option))
+        except ValueError:
+            parser.error('invalid interval for --{0}: {1}'.format(option.replace('_', '-'), getattr(args, option)))
+    if not any(intervals.values()):
+        parser.error('--every, --sync-every and --health-every are all 0, nothing to run')
+
+    logging.basicConfig(format='%(asctime)s %(message)s', filename=args.log, level=logging.INFO)
+
+    from pyfluke1586A_fleet import read_fleet_config
+    collector = Collector(read_fleet_config(args.config), download_dir=args.download_dir,
+                          incremental=args.incremental, archive=args.archive,
+                          intervals=intervals,
+                          jitter=parse_interval(args.jitter), timeout=parse_interval(args.timeout),
+                          max_offset=args.max_offset)
+    signal.signal(signal.SIGTERM, lambda signum, frame: collector.stop())
+    try:
+        collector.run(once=args.once)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        collector.close()
+    failed = [task for inst in collector.status.values() for task, res in inst.items() if not res['ok']]
+    return 1 if args.once and failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
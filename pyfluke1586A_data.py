@@ -0,0 +1,436 @@
+#!/usr/bin/env python
+# Python 3.X
+
+"""Parse scan files downloaded from the Fluke 1586A into NumPy arrays.
+
+The MEM:LOG:READ? payload (or the <name>_data.csv written by
+Fluke1586A.download_data) is a CSV table with one row per scan: an
+optional scan number, a time stamp and one column per channel (possibly
+interleaved with alarm columns). The MEM:LOG:READ:CONF? payload
+(<name>_conf.csv) describes the channel setup with one row per channel.
+
+The whole table is parsed in one pass by numpy and converted column by
+column, so no Python code runs per row:
+
+    scan = load_scan('./downloads/SCAN1')     # uses SCAN1_data.npz if up to date
+    scan.time                                 # datetime64[ms] array
+    scan['101']                               # float array for channel 101
+
+Very large scan files can be opened memory mapped instead: the arrays of
+the .npz cache are mapped where they are stored in the file, so opening
+takes the same time whatever the size, and only the pages of the rows
+that are used are read from disk:
+
+    scan = map_scan('./downloads/SCAN1')      # np.memmap backed columns
+    part = scan.between('2020-07-07T02:00', '2020-07-07T03:00')
+    part['101'].mean()                        # reads only this hour of channel 101
+"""
+
+import io
+import re
+import json
+import struct
+import zipfile
+import datetime as dt
+from pathlib import Path
+
+import numpy as np
+
+from pyfluke1586A import _normalize_newlines
+
+# Date/time formats tried when time stamps are not ISO 8601
+TimeFormats = ['%m/%d/%Y %H:%M:%S.%f', '%m/%d/%Y %H:%M:%S', '%d-%m-%Y %H:%M:%S.%f', '%d-%m-%Y %H:%M:%S']
+
+NpzAlignment = 64       # arrays in .npz files start at multiples of this offset, so they can be memory mapped
+MarkCheckBytes = 256    # bytes before a mark of load_scan_rows compared to tell that the file continues there
+
+
+def _to_text(payload):
+    """Accept bytes (raw instrument payload) or str and return text with '\\n' line endings."""
+    if isinstance(payload, (bytes, bytearray, memoryview)):
+        payload = bytes(payload).decode()
+    return _normalize_newlines(payload)
+
+
+def _split_header(text, match):
+    """Return the header fields and the text following the first line for
+    which match(fields) is true."""
+    pos = 0
+    while pos < len(text):
+        end = text.find('\n', pos)
+        if end < 0:
+            end = len(text)
+        fields = [f.strip().strip('"').strip() for f in text[pos:end].split(',')]
+        if match(fields):
+            return fields, text[end+1:]
+        pos = end+1
+    raise ValueError('No header line found')
+
+
+def _load_table(text, ncols):
+    """Parse a CSV table in one call to numpy, returning a 2D array of strings."""
+    if len(text.strip()) == 0:
+        return np.empty((0, ncols), dtype=str)
+    table = np.loadtxt(io.StringIO(text), delimiter=',', dtype=str, comments=None, ndmin=2)
+    return np.char.strip(np.char.strip(table), '"')
+
+
+def _channel_number(field):
+    """Channel number (e.g. '101') in a column header such as 'CH101 (C)', or None."""
+    m = re.search(r'(?<!\d)(\d{3,4})(?!\d)', field)
+    return m.group(1) if m else None
+
+
+def _unit_in_header(field):
+    m = re.search(r'\(([^)]*)\)\s*$', field)
+    return m.group(1).strip() if m else None
+
+
+def parse_time(strings):
+    """Convert an array of time stamp strings to datetime64[ms].
+
+    ISO 8601 time stamps are converted by numpy in bulk. Other formats
+    (see TimeFormats) fall back to datetime.strptime per value.
+    """
+    strings = np.asarray(strings, dtype=str)
+    try:
+        return strings.astype('datetime64[ms]')
+    except ValueError:
+        pass
+    for fmt in TimeFormats:
+        try:
+            dt.datetime.strptime(strings[0], fmt)
+        except (ValueError, IndexError):
+            continue
+        return np.array([dt.datetime.strptime(s, fmt) for s in strings], dtype='datetime64[ms]')
+    raise ValueError('Unknown time stamp format: {0}'.format(strings[0]))
+
+
+def _to_float(column):
+    """Convert a column of strings to float, empty values become NaN."""
+    return np.where(column == '', 'nan', column).astype(float)
+
+
+def parse_conf(payload):
+    """Parse the channel setup (MEM:LOG:READ:CONF? payload or <name>_conf.csv).
+
+    Returns a dict mapping channel number (str) to a dict of the setup
+    fields of that channel, with at least the keys 'name' and 'unit'.
+    """
+    text = _to_text(payload)
+    try:
+        header, body = _split_header(text, lambda fields: any('channel' in f.lower() for f in fields))
+    except ValueError:
+        return {}
+    keys = [f.lower() for f in header]
+    table = _load_table(body, len(keys))
+
+    chan_col = [id for id, k in enumerate(keys) if 'channel' in k][0]
+    name_col = [id for id, k in enumerate(keys) if k in ['label', 'name', 'tag', 'channel name']]
+    unit_col = [id for id, k in enumerate(keys) if 'unit' in k]
+
+    conf = {}
+    for row in table.tolist():
+        channel = _channel_number(row[chan_col]) or row[chan_col]
+        setup = dict(zip(keys, row))
+        setup['name'] = row[name_col[0]] if name_col and row[name_col[0]] else channel
+        setup['unit'] = row[unit_col[0]] if unit_col else ''
+        conf[channel] = setup
+    return conf
+
+
+class ScanData(object):
+    """Columnar data of one scan file.
+
+    time      datetime64[ms] array with the time stamp of each scan
+    scan      int array with the scan number of each row (or None)
+    channels  list of channel numbers (str), in the order of the data file
+    values    dict of float arrays, one per channel
+    names     dict of channel names (from the conf file, default: channel number)
+    units     dict of channel units (from the conf file or the column header)
+    """
+    def __init__(self, time, values, channels=None, scan=None, names=None, units=None):
+        self.time = time
+        self.values = values
+        self.channels = list(values.keys()) if channels is None else list(channels)
+        self.scan = scan
+        self.names = {ch: ch for ch in self.channels} if names is None else dict(names)
+        self.units = {ch: '' for ch in self.channels} if units is None else dict(units)
+
+    def __len__(self):
+        return len(self.time)
+
+    def __getitem__(self, channel):
+        return self.values[channel]
+
+    def __repr__(self):
+        return '<ScanData: {0} rows, channels {1}>'.format(len(self), ', '.join(self.channels))
+
+    def rows(self, start=None, stop=None):
+        """The rows start:stop as a ScanData of views (no data is copied)."""
+        index = slice(start, stop)
+        return ScanData(self.time[index], {ch: self.values[ch][index] for ch in self.channels},
+                        channels=self.channels, scan=None if self.scan is None else self.scan[index],
+                        names=self.names, units=self.units)
+
+    def between(self, start=None, end=None):
+        """The rows with start <= time < end as a ScanData of views. The
+        rows are found by binary search, so the time stamps must be sorted."""
+        lo = 0 if start is None else int(np.searchsorted(self.time, np.datetime64(start, 'ms'), side='left'))
+        hi = len(self) if end is None else int(np.searchsorted(self.time, np.datetime64(end, 'ms'), side='left'))
+        return self.rows(lo, hi)
+
+    def save_npz(self, p):
+        """Save to a (uncompressed, fast loading) .npz file."""
+        meta = {'channels': self.channels, 'names': self.names, 'units': self.units}
+        arrays = {'time': self.time, 'meta': np.array(json.dumps(meta))}
+        if self.scan is not None:
+            arrays['scan'] = self.scan
+        for id, ch in enumerate(self.channels):
+            arrays['ch{0:d}'.format(id)] = self.values[ch]
+        with Path(p).open('wb') as fh:
+            _save_aligned_npz(fh, arrays)
+
+    @classmethod
+    def load_npz(cls, p):
+        with np.load(p) as npz:
+            meta = json.loads(str(npz['meta']))
+            values = {ch: npz['ch{0:d}'.format(id)] for id, ch in enumerate(meta['channels'])}
+            scan = npz['scan'] if 'scan' in npz.files else None
+            return cls(npz['time'], values, channels=meta['channels'], scan=scan,
+                       names=meta['names'], units=meta['units'])
+
+    @classmethod
+    def map_npz(cls, p):
+        """Open a .npz file written by save_npz with all columns as
+        read-only np.memmap arrays. Nothing but the headers is read."""
+        arrays = _map_npz_arrays(p)
+        meta = json.loads(str(arrays['meta'][()]))
+        values = {ch: arrays['ch{0:d}'.format(id)] for id, ch in enumerate(meta['channels'])}
+        return cls(arrays['time'], values, channels=meta['channels'], scan=arrays.get('scan'),
+                   names=meta['names'], units=meta['units'])
+
+
+def _save_aligned_npz(fh, arrays):
+    """Like np.savez, but the data of each array starts at a multiple of
+    NpzAlignment in the file. Unaligned memory mapped arrays are copied by
+    numpy before e.g. a binary search, which would read the whole file."""
+    with zipfile.ZipFile(fh, 'w', zipfile.ZIP_STORED) as zf:
+        for name, array in arrays.items():
+            info = zipfile.ZipInfo(name+'.npy')
+            # Pad the extra field of the local header (which also holds
+            # the 20 byte zip64 record) up to the alignment. The npy
+            # header is padded to a multiple of 64 bytes by numpy.
+            start = fh.tell()+30+len(info.filename.encode())+4+20
+            pad = -start % NpzAlignment
+            info.extra = struct.pack('<HH', 0x7061, pad)+b'\0'*pad    # 0x7061: padding, ignored by readers
+            with zf.open(info, 'w', force_zip64=True) as fid:
+                np.lib.format.write_array(fid, np.asanyarray(array), allow_pickle=False)
+
+
+def _npz_layout(p):
+    """Locate the arrays of an uncompressed .npz file from the headers,
+    without reading or mapping the data. Returns a dict mapping array name
+    to (offset of the data in the file, shape, fortran_order, dtype)."""
+    p = Path(p)
+    layout = {}
+    with zipfile.ZipFile(p) as zf, p.open('rb') as fh:
+        for info in zf.infolist():
+            if info.compress_type != zipfile.ZIP_STORED:
+                raise ValueError('{0} in {1} is compressed and cannot be memory mapped'.format(info.filename, p))
+            # The data follows the local file header, whose extra field may
+            # differ from the one in the central directory
+            fh.seek(info.header_offset)
+            name_len, extra_len = struct.unpack('<HH', fh.read(30)[26:30])
+            fh.seek(info.header_offset+30+name_len+extra_len)
+            version = np.lib.format.read_magic(fh)
+            if version == (1, 0):
+                shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(fh)
+            else:
+                shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(fh)
+            name = info.filename[:-4] if info.filename.endswith('.npy') else info.filename
+            if dtype.hasobject:
+                raise ValueError('{0} in {1} holds Python objects and cannot be memory mapped'.format(info.filename, p))
+            layout[name] = (fh.tell(), shape, fortran_order, dtype)
+    return layout
+
+
+def _npz_aligned(p):
+    """True if the data of all (non-empty) arrays of the .npz file p starts
+    at a multiple of NpzAlignment, as written by save_npz."""
+    return all(offset % NpzAlignment == 0 for offset, shape, fortran_order, dtype in _npz_layout(p).values()
+               if int(np.prod(shape)) > 0)
+
+
+def _map_npz_arrays(p):
+    """Memory map the arrays of an uncompressed .npz file. Returns a dict
+    mapping array name to np.memmap (or to an empty array)."""
+    arrays = {}
+    for name, (offset, shape, fortran_order, dtype) in _npz_layout(p).items():
+        if int(np.prod(shape)) == 0:
+            arrays[name] = np.empty(shape, dtype=dtype)
+        else:
+            arrays[name] = np.memmap(p, dtype=dtype, mode='r', offset=offset, shape=shape,
+                                     order='F' if fortran_order else 'C')
+    return arrays
+
+
+def _load_columns(body, header, text_cols, int_cols, float_cols):
+    """Parse the selected columns of a CSV table in one call to numpy.
+    Returns a dict mapping column index to array."""
+    usecols = sorted(text_cols+int_cols+float_cols)
+    if len(body.strip()) == 0:
+        return {id: np.empty(0) for id in usecols}
+
+    types = {id: 'U40' for id in text_cols}
+    types.update({id: 'i8' for id in int_cols})
+    types.update({id: 'f8' for id in float_cols})
+    dtype = np.dtype([('c{0:d}'.format(id), types[id]) for id in usecols])
+    try:
+        table = np.loadtxt(io.StringIO(body), delimiter=',', dtype=dtype, usecols=usecols,
+                           comments=None, ndmin=1)
+        columns = {id: table['c{0:d}'.format(id)] for id in usecols}
+    except ValueError:
+        # Empty or quoted values, parse all columns as text and convert
+        table = _load_table(body, len(header))
+        if table.shape[1] != len(header):
+            raise ValueError('Data rows have {0} columns, header has {1}'.format(table.shape[1], len(header)))
+        columns = {id: table[:, id] for id in text_cols}
+        columns.update({id: table[:, id].astype(int) for id in int_cols})
+        columns.update({id: _to_float(table[:, id]) for id in float_cols})
+    for id in text_cols:
+        columns[id] = np.char.strip(np.char.strip(columns[id]), '"')
+    return columns
+
+
+def parse_scan_data(payload, conf=None):
+    """Parse a scan data file (MEM:LOG:READ? payload or <name>_data.csv)
+    into a ScanData object. conf is the result of parse_conf() and supplies
+    channel names and units."""
+    text = _to_text(payload)
+    header, body = _split_header(text, lambda fields: any('time' in f.lower() for f in fields))
+    first = body.lstrip('\n').split('\n', 1)[0].split(',')
+
+    keys = [f.lower() for f in header]
+    time_col = [id for id, k in enumerate(keys) if 'time' in k][0]
+    date_col = [id for id, k in enumerate(keys) if 'date' in k and id != time_col][:1]
+    scan_col = [id for id, k in enumerate(keys) if k in ['scan', 'scan number', 'reading', 'record', 'index']][:1]
+
+    # Channel columns are those with a channel number in the header and a
+    # numeric value in the first row (alarm columns are skipped)
+    chan_cols = []
+    for id, field in enumerate(header):
+        if id in [time_col]+date_col+scan_col or _channel_number(field) is None:
+            continue
+        try:
+            float(first[id].strip().strip('"') or 'nan')
+        except (ValueError, IndexError):
+            continue
+        chan_cols.append(id)
+
+    columns = _load_columns(body, header, [time_col]+date_col, scan_col, chan_cols)
+
+    timestamps = columns[time_col]
+    if date_col:
+        timestamps = np.char.add(np.char.add(columns[date_col[0]], ' '), timestamps)
+    time = parse_time(timestamps)
+    scan = columns[scan_col[0]] if scan_col else None
+
+    conf = conf or {}
+    values, names, units = {}, {}, {}
+    for id in chan_cols:
+        channel = _channel_number(header[id])
+        values[channel] = columns[id]
+        setup = conf.get(channel, {})
+        names[channel] = setup.get('name', channel)
+        units[channel] = setup.get('unit') or _unit_in_header(header[id]) or ''
+
+    return ScanData(time, values, scan=scan, names=names, units=units)
+
+
+def load_scan(directory, name=None, cache=True):
+    """Load a downloaded scan file from directory (./downloads/<name>).
+
+    The parsed data is cached as <name>_data.npz next to the csv file and
+    reused as long as it is newer than the csv files.
+    """
+    directory = Path(directory)
+    if name is None:
+        name = directory.name
+    p_data = directory / '{0}_data.csv'.format(name)
+    p_conf = directory / '{0}_conf.csv'.format(name)
+    p_npz = directory / '{0}_data.npz'.format(name)
+
+    sources = [p for p in [p_data, p_conf] if p.exists()]
+    if cache and p_npz.exists() and all(p_npz.stat().st_mtime >= p.stat().st_mtime for p in sources):
+        return ScanData.load_npz(p_npz)
+
+    conf = parse_conf(p_conf.read_text()) if p_conf.exists() else None
+    scan = parse_scan_data(p_data.read_text(), conf)
+    if cache:
+        scan.save_npz(p_npz)
+    return scan
+
+
+def load_scan_rows(directory, name=None, mark=None):
+    """Load the rows of a downloaded scan file that follow mark, the mark
+    returned by a previous call (None: all rows).
+
+    Only the csv header (kept in the mark) and the part of the data file
+    after the mark are read and parsed, so a file that grows by incremental
+    downloads is not parsed again as a whole. If the file does not continue
+    at the mark (it was downloaded again, or is shorter), all rows are
+    loaded. The mark is set at the start of the last line, which is parsed
+    again by the next call in case it was incomplete.
+
+    Returns (data, first_row, mark): a ScanData of the rows loaded (None if
+    there are none), the row number of its first row and the new mark.
+    """
+    directory = Path(directory)
+    if name is None:
+        name = directory.name
+    p_data = directory / '{0}_data.csv'.format(name)
+    p_conf = directory / '{0}_conf.csv'.format(name)
+
+    with p_data.open('rb') as fh:
+        offset, header, first_row = 0, '', 0
+        if mark is not None:
+            check = mark['check'].encode('latin-1')
+            fh.seek(mark['bytes']-len(check))
+            if fh.read(len(check)) == check:
+                offset, header, first_row = mark['bytes'], mark['header'], mark['rows']
+        fh.seek(offset)
+        rest = fh.read()
+        last = rest.rstrip(b'\r\n').rfind(b'\n')+1
+        fh.seek(max(0, offset+last-MarkCheckBytes))
+        check = fh.read(offset+last-fh.tell())
+
+    text = rest.decode()
+    if not header:
+        _, body = _split_header(text, lambda fields: any('time' in f.lower() for f in fields))
+        header, text = text[:len(text)-len(body)], body
+    if len(text.strip()) == 0:
+        return None, first_row, mark
+    conf = parse_conf(p_conf.read_text()) if p_conf.exists() else None
+    data = parse_scan_data(header+text, conf)
+    mark = {'bytes': offset+last, 'rows': first_row+len(data)-1, 'header': header,
+            'check': check.decode('latin-1')}
+    return data, first_row, mark
+
+
+def map_scan(directory, name=None):
+    """Open a downloaded scan file from directory memory mapped (see
+    ScanData.map_npz). The .npz cache is created or updated first if it is
+    missing or older than the csv files, which parses the csv files once."""
+    directory = Path(directory)
+    if name is None:
+        name = directory.name
+    p_npz = directory / '{0}_data.npz'.format(name)
+    sources = [p for p in [directory / '{0}_data.csv'.format(name), directory / '{0}_conf.csv'.format(name)] if p.exists()]
+    if not p_npz.exists() or any(p_npz.stat().st_mtime < p.stat().st_mtime for p in sources):
+        load_scan(directory, name)
+    if not _npz_aligned(p_npz):
+        # Cache written by np.savez, rewrite it aligned. This is checked
+        # before mapping: a mapped file cannot be rewritten on Windows.
+        ScanData.load_npz(p_npz).save_npz(p_npz)
+    return ScanData.map_npz(p_npz)
@@ -0,0 +1,322 @@
+#!/usr/bin/env python
+# Python 3.X
+
+"""Drive a rack of Fluke 1586A scanners concurrently.
+
+The instruments are listed in a TOML config file:
+
+    [[instrument]]
+    port = "COM3"
+    nickname = "rack-A1"
+
+    [[instrument]]
+    port = "socket://192.168.1.11:3490"
+    nickname = "rack-A2"
+    baudrate = 9600          # optional, any Fluke1586A keyword argument
+    latency = 0.002          # optional, one-way delay (s) of the line, see coordinated()
+
+Every operation runs on all instruments in parallel on a bounded pool of
+worker threads. Errors are caught per instrument, so one failing scanner
+does not stop the others, and the results are collected in one summary:
+
+    python pyfluke1586A_fleet.py fleet.toml identify
+    python pyfluke1586A_fleet.py fleet.toml download
+
+The start, abort and align actions act on all instruments at the same
+moment instead: every instrument is prepared first, then one worker
+thread per instrument waits for a common fire time and sends a single
+pre-encoded command, early by the time to transmit it (plus the latency
+of the line, if configured). align sets the instrument clocks to the PC
+clock at a whole second boundary. The scheduling jitter, the spread of
+the errors of the send times on the PC, is reported; the arrival at the
+instruments cannot be measured:
+
+    python pyfluke1586A_fleet.py fleet.toml start
+    python pyfluke1586A_fleet.py fleet.toml align
+"""
+
+import sys
+import math
+import time
+import logging
+import argparse
+import threading
+import collections
+import datetime as dt
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import tomllib
+except ImportError:
+    # Python < 3.11
+    import tomli as tomllib
+
+from pyfluke1586A import Fluke1586A
+
+MaxFleetWorkers = 16    # max number of instruments handled at the same time
+CoordinatedMarginSecs = 0.2     # time (in seconds) between all instruments being prepared and firing
+CoordinatedTimeoutSecs = 30.    # max time (in seconds) to wait for all instruments to be prepared
+CoordinatedProbes = 5           # round trips measured when preparing (reported) and verifying
+FleetConfigKeys = ['port', 'nickname', 'latency']  # keys of an instrument entry that are not Fluke1586A arguments
+
+
+FleetResult = collections.namedtuple('FleetResult', ['nickname', 'port', 'ok', 'value', 'error', 'elapsed'])
+
+
+def read_fleet_config(filename):
+    """Read the list of instruments from a TOML config file. Returns a list of
+    dicts with (at least) the keys 'port' and 'nickname'."""
+    with open(filename, 'rb') as fh:
+        config = tomllib.load(fh)
+
+    instruments = []
+    for id, inst in enumerate(config.get('instrument', [])):
+        if 'port' not in inst:
+            raise ValueError('Instrument {0} in {1} has no port'.format(id+1, filename))
+        inst = dict(inst)
+        inst.setdefault('nickname', inst['port'])
+        instruments.append(inst)
+    return instruments
+
+
+def driver_kwargs(inst):
+    """The Fluke1586A keyword arguments of an instrument entry of the config."""
+    return {k: v for k, v in inst.items() if k not in FleetConfigKeys}
+
+
+class Fluke1586AFleet(object):
+    """A set of Fluke1586A instruments operated in parallel.
+
+    Each instrument downloads to its own directory, <download_dir>/<nickname>,
+    so scan files with the same name on different instruments do not collide.
+    """
+    def __init__(self, instruments, max_workers=MaxFleetWorkers, download_dir='./downloads'):
+        self.instruments = [dict(inst) for inst in instruments]
+        self.download_dir = Path(download_dir)
+        self.max_workers = max_workers
+        self.flukes = collections.OrderedDict()   # nickname -> Fluke1586A, for the ports that could be opened
+        self.latency = {inst['nickname']: float(inst.get('latency', 0.)) for inst in self.instruments}
+
+    @classmethod
+    def from_config(cls, filename, **kwargs):
+        return cls(read_fleet_config(filename), **kwargs)
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def _map(self, func, items, max_workers=None):
+        """Call func(nickname, item) for all items in parallel and return a
+        list of FleetResult in the order of items. Exceptions are caught and
+        reported in the result of the instrument that raised them."""
+        def run(nickname, port, item):
+            tstart = time.time()
+            try:
+                value = func(nickname, item)
+                return FleetResult(nickname, port, True, value, None, time.time()-tstart)
+            except Exception as e:
+                logging.exception('Fleet operation failed   ({0}@{1})'.format(nickname, port))
+                return FleetResult(nickname, port, False, None, e, time.time()-tstart)
+
+        if len(items) == 0:
+            return []
+        with ThreadPoolExecutor(max_workers=min(max_workers or self.max_workers, len(items))) as pool:
+            futures = [pool.submit(run, nickname, port, item) for nickname, port, item in items]
+            return [f.result() for f in futures]
+
+    def open(self):
+        """Open all instrument ports in parallel. Returns a list of FleetResult;
+        instruments that could not be opened are left out of later operations."""
+        def open_one(nickname, inst):
+            kwargs = driver_kwargs(inst)
+            kwargs.setdefault('download_dir', self.download_dir / nickname)
+            return Fluke1586A(inst['port'], nickname=nickname, verbose=False, **kwargs)
+
+        results = self._map(open_one, [(inst['nickname'], inst['port'], inst) for inst in self.instruments])
+        for res in results:
+            if res.ok:
+                self.flukes[res.nickname] = res.value
+        return results
+
+    def close(self):
+        for fluke in self.flukes.values():
+            fluke.close()
+        self.flukes.clear()
+
+    def run(self, method, *args, **kwargs):
+        """Call the Fluke1586A method (name or function) on all open
+        instruments in parallel. Returns a list of FleetResult."""
+        def call(nickname, fluke):
+            if callable(method):
+                return method(fluke, *args, **kwargs)
+            return getattr(fluke, method)(*args, **kwargs)
+        return self._map(call, [(nickname, fluke.com_port, fluke) for nickname, fluke in self.flukes.items()])
+
+    def identify(self):
+        return self.run(lambda fluke: fluke.get_identification()[0].decode())
+
+    def check_offsets(self):
+        return self.run(lambda fluke: fluke.get_offset().total_seconds())
+
+    def sync_datetime(self):
+        return self.run(lambda fluke: tuple(o.total_seconds() for o in fluke.sync_datetime()))
+
+    def download_all(self):
+        return self.run(lambda fluke: [info['name'] for info in fluke.download_all()])
+
+    def coordinated(self, commands, align=False, verify=False):
+        """Send commands to all open instruments at the same moment.
+
+        commands(fire_time) returns the list of setters (as for
+        Fluke1586A.send_batch) to send at fire_time (a time.time() value).
+        Each instrument is prepared in its own thread: the delay to the
+        instrument is the time to transmit the command on a serial line
+        plus the configured latency of the line (default 0). The round trip
+        time is measured and reported, but not used: it includes the time
+        the instrument takes to reply, which a setter does not wait for.
+        When all instruments are prepared, the fire time is set
+        CoordinatedMarginSecs (plus the longest delay) ahead, rounded up to
+        a whole second if align is True, and every thread sends its command
+        that much earlier than the fire time. Instruments that fail to
+        prepare do not hold up the others.
+
+        Returns a list of FleetResult, whose values are dicts with the fire
+        time, the delay, the shortest round trip and the error of the send
+        time on the PC (jitter, s), and, if verify is True, the instrument
+        clock offset measured afterwards. See scheduling_jitter().
+        """
+        if len(self.flukes) == 0:
+            return []
+        plan = {'delays': {}}
+
+        def set_fire_time():
+            t = time.time()+CoordinatedMarginSecs+max(plan['delays'].values(), default=0.)
+            plan['fire'] = math.ceil(t) if align else t
+
+        barrier = threading.Barrier(len(self.flukes), action=set_fire_time, timeout=CoordinatedTimeoutSecs)
+
+        def fire(nickname, fluke):
+            with fluke.lock:
+                try:
+                    rtt = fluke.probe_offset(CoordinatedProbes)[1].total_seconds()
+                    nbytes = len(fluke.prepare_commands(commands(time.time())))
+                    plan['delays'][nickname] = self.latency.get(nickname, 0.)+fluke.transmit_time(nbytes)
+                except Exception:
+                    barrier.wait()      # let the others fire
+                    raise
+                barrier.wait()
+                data = fluke.prepare_commands(commands(plan['fire']))
+                delay = plan['delays'][nickname]
+                _sleep_until(plan['fire']-delay)
+                t_start, t_end = fluke.fire_commands(data)
+                result = {'fire': dt.datetime.fromtimestamp(plan['fire']).isoformat(timespec='milliseconds'),
+                          'delay': round(delay, 4), 'rtt': round(rtt, 4),
+                          'jitter': round(t_start-(plan['fire']-delay), 4)}
+                if verify:
+                    time.sleep(fluke.timeout)   # let the instrument apply the command
+                    result['offset'] = round(fluke.probe_offset(CoordinatedProbes)[0].total_seconds(), 4)
+                return result
+
+        # One thread per instrument: all have to wait at the barrier together
+        return self._map(fire, [(nickname, fluke.com_port, fluke) for nickname, fluke in self.flukes.items()],
+                         max_workers=len(self.flukes))
+
+    def coordinated_start(self):
+        """Start scanning (INIT) on all instruments at the same moment."""
+        return self.coordinated(lambda fire_time: ['INIT'])
+
+    def coordinated_abort(self):
+        """Stop scanning (ABOR) on all instruments at the same moment."""
+        return self.coordinated(lambda fire_time: ['ABOR'])
+
+    def coordinated_sync(self):
+        """Set the clocks of all instruments to the PC clock at the same
+        whole second. Date and time are sent in one compound command, so a
+        change of date between the two cannot occur."""
+        def commands(fire_time):
+            t = dt.datetime.fromtimestamp(round(fire_time))
+            return [('SYST:DATE', [t.year, t.month, t.day]), ('SYST:TIME', [t.hour, t.minute, t.second])]
+        return self.coordinated(commands, align=True, verify=True)
+
+
+def _sleep_until(t):
+    """Sleep until time.time() is t. The last milliseconds are spent
+    polling the clock, as sleep() may wake up late."""
+    while True:
+        remaining = t-time.time()
+        if remaining <= 0:
+            return
+        time.sleep(remaining-0.002 if remaining > 0.003 else 0)
+
+
+def scheduling_jitter(results):
+    """Spread (max - min, in seconds) of the errors of the times the PC sent
+    a coordinated command to the instruments that received it. This is the
+    skew added on the PC side; the skew of the arrival at the instruments
+    also depends on the lines, which is not measured."""
+    errors = [res.value['jitter'] for res in results if res.ok]
+    return max(errors)-min(errors) if errors else 0.
+
+
+def format_summary(title, results):
+    """Format a list of FleetResult as a table."""
+    lines = ['{0}:'.format(title), '']
+    for res in results:
+        if res.ok:
+            status = 'OK'
+            value = res.value
+        else:
+            status = 'FAILED'
+            value = '{0}: {1}'.format(type(res.error).__name__, res.error)
+        lines.append('{0:<15s} {1:<28s} {2:<7s} {3:6.2f} s   {4}'.format(res.nickname, res.port, status, res.elapsed, value))
+    nfailed = len([res for res in results if not res.ok])
+    lines.append('')
+    lines.append('{0} instruments, {1} failed, total {2:.2f} s'.format(
+        len(results), nfailed, max([res.elapsed for res in results], default=0.)))
+    return '\n'.join(lines)
+
+
+actions = {'identify': ('Identification',            Fluke1586AFleet.identify),
+           'offset':   ('Instrument offset (s)',     Fluke1586AFleet.check_offsets),
+           'sync':     ('Offset before/after sync (s)', Fluke1586AFleet.sync_datetime),
+           'download': ('Downloaded scan files',     Fluke1586AFleet.download_all),
+           'start':    ('Coordinated scan start',    Fluke1586AFleet.coordinated_start),
+           'abort':    ('Coordinated scan abort',    Fluke1586AFleet.coordinated_abort),
+           'align':    ('Coordinated clock sync',    Fluke1586AFleet.coordinated_sync),
+           }
+CoordinatedActions = ['start', 'abort', 'align']
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Operate several Fluke 1586A scanners in parallel.')
+    parser.add_argument('config', help='TOML file listing the instruments')
+    parser.add_argument('action', choices=list(actions.keys()))
+    parser.add_argument('--workers', type=int, default=MaxFleetWorkers, help='max instruments handled at once')
+    parser.add_argument('--download-dir', default='./downloads')
+    args = parser.parse_args(argv)
+
+    fleet = Fluke1586AFleet.from_config(args.config, max_workers=args.workers, download_dir=args.download_dir)
+    try:
+        opened = fleet.open()
+        failed = [res for res in opened if not res.ok]
+        if failed:
+            print(format_summary('Ports that could not be opened', failed))
+            print('')
+        title, action = actions[args.action]
+        results = action(fleet)
+        print(format_summary(title, results))
+        if args.action in CoordinatedActions:
+            print('Scheduling jitter on the PC (not measured at the instruments): {0:.1f} ms'.format(
+                1e3*scheduling_jitter(results)))
+    finally:
+        fleet.close()
+
+    return 0 if all(res.ok for res in opened+results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# Python 3.X
+
+"""Live acquisition from a running Fluke 1586A scan.
+
+LiveStream tails the readings of a data slot in a background thread. The
+slot is selected once, after which each poll only requests the readings
+after the last one received (LOG:AUT:VAL? <next index>). Readings are
+parsed into LiveReading records and passed through a fixed-size
+RingBuffer, so memory stays bounded and a slow consumer throttles the
+poller instead of letting data pile up:
+
+    with LiveStream(fluke, slot=1) as stream:
+        for reading in stream:
+            print(reading.index, reading.time, reading.values)
+"""
+
+import logging
+import threading
+import collections
+
+from pyfluke1586A import parse_reading_table
+
+LivePollIntervalSecs = 0.05     # delay between polls while new readings keep arriving
+LiveMaxPollIntervalSecs = 2.0   # max delay between polls while no new readings arrive
+
+
+LiveReading = collections.namedtuple('LiveReading', ['index', 'time', 'values'])
+
+
+def parse_readings(resp, first_index):
+    """Parse a LOG:AUT:VAL? reply (one reading per line) into a list of
+    LiveReading. The reply is decoded in one pass by parse_reading_table:
+    index is the reading number of the line (or, if the line has none, the
+    readings are numbered from first_index), time its time stamp field (if
+    any) as datetime64[ms] and values the measured values, the other
+    numeric fields."""
+    table = parse_reading_table(resp)
+    return [LiveReading(first_index+id if table.index is None else int(table.index[id]),
+                        None if table.time is None else table.time[id], values)
+            for id, values in enumerate(table.values)]
+
+
+class RingBuffer(object):
+    """Fixed-capacity, thread-safe FIFO buffer.
+
+    When the buffer is full, put() blocks until the consumer has made room
+    (backpressure), or, with overwrite=True, drops the oldest item and
+    counts it in self.dropped.
+    """
+    def __init__(self, capacity, overwrite=False):
+        self.capacity = capacity
+        self.overwrite = overwrite
+        self.dropped = 0
+        self.closed = False
+        self._items = [None]*capacity
+        self._start = 0
+        self._count = 0
+        self._cond = threading.Condition()
+
+    def __len__(self):
+        return self._count
+
+    def put(self, item, timeout=None):
+        """Add item. Returns False if the buffer stayed full for timeout seconds
+        or was closed."""
+        with self._cond:
+            if self._count == self.capacity:
+                if self.overwrite:
+                    self._start = (self._start+1) % self.capacity
+                    self._count -= 1
+                    self.dropped += 1
+                elif not self._cond.wait_for(lambda: self._count < self.capacity or self.closed, timeout):
+                    return False
+            if self.closed:
+                return False
+            self._items[(self._start+self._count) % self.capacity] = item
+            self._count += 1
+            self._cond.notify_all()
+            return True
+
+    def get(self, timeout=None):
+        """Remove and return the oldest item. Returns None if nothing arrived
+        within timeout seconds, or if the buffer is closed and empty."""
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._count > 0 or self.closed, timeout):
+                return None
+            if self._count == 0:
+                return None
+            item = self._items[self._start]
+            self._items[self._start] = None
+            self._start = (self._start+1) % self.capacity
+            self._count -= 1
+            self._cond.notify_all()
+            return item
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+
+class LiveStream(object):
+    """Continuously read new readings of a data slot into a RingBuffer.
+
+    Iterating over the stream yields LiveReading records as they arrive,
+    until stop() is called. next_index is the index of the next reading to
+    request; pass start to resume a previous stream.
+    """
+    def __init__(self, fluke, slot, start=1, capacity=4096, overwrite=False,
+                 poll_interval=LivePollIntervalSecs, max_poll_interval=LiveMaxPollIntervalSecs):
+        self.fluke = fluke
+        self.slot = slot
+        self.next_index = start
+        self.buffer = RingBuffer(capacity, overwrite=overwrite)
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+        self.error = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='LiveStream-{0}'.format(self.fluke.com_port), daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self.buffer.close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def _run(self):
+        interval = self.poll_interval
+        try:
+            while not self._stop.is_set():
+                # The port is shared (e.g. with a ClockMonitor): hold its lock
+                # for each poll, but not while waiting for the next one. The
+                # slot is selected again, in case another user changed it.
+                with self.fluke.lock:
+                    self.fluke.select_slot(self.slot)
+                    resp = self.fluke.read_values(self.next_index)
+                readings = parse_readings(resp, self.next_index)
+                for reading in readings:
+                    # Blocks while the buffer is full, but wakes up regularly to check for stop()
+                    while not self.buffer.put(reading, timeout=0.5):
+                        if self._stop.is_set() or self.buffer.closed:
+                            return
+                    self.next_index = reading.index+1
+                if readings:
+                    interval = self.poll_interval
+                else:
+                    interval = min(2*interval, self.max_poll_interval)
+                self._stop.wait(interval)
+        except Exception as e:
+            self.error = e
+            logging.exception('Live stream stopped   ({0}@{1})'.format(self.fluke.nickname, self.fluke.com_port))
+        finally:
+            self.buffer.close()
+
+    def __iter__(self):
+        while True:
+            reading = self.buffer.get()
+            if reading is None:
+                if self.error is not None:
+                    raise self.error
+                return
+            yield reading
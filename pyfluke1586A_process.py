@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# Python 3.X
+
+"""Batch post-processing of downloaded scan files on all CPU cores.
+
+Every scan file downloaded by Fluke1586A.download_data (a directory with
+<name>_data.csv and <name>_conf.csv) is processed as an independent job
+on a process pool:
+
+    parse       the csv files (pyfluke1586A_data.load_scan)
+    convert     channel values to common units, using the units of the conf file
+    statistics  count, min, max and mean per channel -> <name>_stats.json
+    resample    bin means on a common time grid      -> <name>_<interval>s.npz
+
+Results are returned (and summarized in summary.csv) in the sorted order
+of the scan file paths, whatever order the jobs finish in. A scan file
+whose outputs are newer than its csv files and were made with the same
+settings is skipped, so rerunning over a full download tree only
+processes new or updated files:
+
+    python pyfluke1586A_process.py ./downloads --resample 60 --workers 8
+"""
+
+import sys
+import csv
+import json
+import argparse
+import collections
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from pyfluke1586A_data import ScanData, load_scan
+
+# Conversions to common units: unit in conf file -> (unit, function)
+UnitConversions = {
+    'F':    ('C',   lambda v: (v-32.)/1.8),
+    'K':    ('C',   lambda v: v-273.15),
+    'mV':   ('V',   lambda v: v*1e-3),
+    'uV':   ('V',   lambda v: v*1e-6),
+    'mA':   ('A',   lambda v: v*1e-3),
+    'uA':   ('A',   lambda v: v*1e-6),
+    'kOhm': ('Ohm', lambda v: v*1e3),
+    'MOhm': ('Ohm', lambda v: v*1e6),
+    }
+
+
+ProcessResult = collections.namedtuple('ProcessResult', ['name', 'directory', 'status', 'stats', 'error'])
+
+
+def find_scan_files(root):
+    """Directories below root holding a downloaded scan file, sorted by path."""
+    return sorted(p.parent for p in Path(root).rglob('*_data.csv') if p.name == '{0}_data.csv'.format(p.parent.name))
+
+
+def convert_units(scan, convert=True):
+    """Convert the channels of scan (in place) to the units in UnitConversions."""
+    if not convert:
+        return scan
+    for ch in scan.channels:
+        conversion = UnitConversions.get(scan.units.get(ch, ''))
+        if conversion is not None:
+            unit, func = conversion
+            scan.values[ch] = func(scan.values[ch])
+            scan.units[ch] = unit
+    return scan
+
+
+def channel_statistics(scan):
+    """Count (of non-NaN values), min, max and mean of each channel."""
+    stats = collections.OrderedDict()
+    for ch in scan.channels:
+        values = scan[ch]
+        valid = values[~np.isnan(values)]
+        stats[ch] = {'name': scan.names[ch], 'unit': scan.units[ch], 'count': int(len(valid)),
+                     'min': float(valid.min()) if len(valid) else None,
+                     'max': float(valid.max()) if len(valid) else None,
+                     'mean': float(valid.mean()) if len(valid) else None}
+    return stats
+
+
+def resample(scan, interval):
+    """Bin means of all channels on a time grid of interval seconds, aligned
+    to whole multiples of interval (so all scan files share the grid).
+    Bins without data are left out."""
+    step = np.timedelta64(int(round(interval*1000)), 'ms')
+    if len(scan) == 0:
+        return ScanData(scan.time[:0], {ch: scan[ch][:0] for ch in scan.channels}, channels=scan.channels,
+                        names=scan.names, units=scan.units)
+    bins = (scan.time - np.datetime64(0, 'ms')) // step
+    grid, index = np.unique(bins, return_inverse=True)
+    values = {}
+    for ch in scan.channels:
+        valid = ~np.isnan(scan[ch])
+        sums = np.bincount(index[valid], weights=scan[ch][valid], minlength=len(grid))
+        counts = np.bincount(index[valid], minlength=len(grid))
+        with np.errstate(invalid='ignore', divide='ignore'):
+            values[ch] = sums/counts
+    return ScanData(np.datetime64(0, 'ms')+grid*step, values, channels=scan.channels,
+                    names=scan.names, units=scan.units)
+
+
+def _outputs(directory, name, interval):
+    outputs = [directory / '{0}_stats.json'.format(name)]
+    if interval:
+        outputs.append(directory / '{0}_{1:g}s.npz'.format(name, interval))
+    return outputs
+
+
+def _up_to_date(directory, name, settings):
+    """True if the outputs exist, are newer than the csv files and were made with settings."""
+    sources = [p for p in [directory / '{0}_data.csv'.format(name), directory / '{0}_conf.csv'.format(name)] if p.exists()]
+    outputs = _outputs(directory, name, settings['resample'])
+    if not all(p.exists() for p in outputs):
+        return False
+    if min(p.stat().st_mtime for p in outputs) < max(p.stat().st_mtime for p in sources):
+        return False
+    return json.loads(outputs[0].read_text()).get('settings') == settings
+
+
+def process_scan(directory, resample_interval=None, convert=True, force=False):
+    """Process one downloaded scan file. Runs in a worker process.
+    Returns a ProcessResult with status 'done' or 'skipped'."""
+    directory = Path(directory)
+    name = directory.name
+    settings = {'resample': resample_interval, 'convert': convert}
+    p_stats = _outputs(directory, name, resample_interval)[0]
+    if not force and _up_to_date(directory, name, settings):
+        return ProcessResult(name, str(directory), 'skipped', json.loads(p_stats.read_text())['channels'], None)
+
+    scan = convert_units(load_scan(directory, name), convert)
+    stats = channel_statistics(scan)
+    summary = {'name': name, 'settings': settings, 'rows': len(scan),
+               'start': str(scan.time[0]) if len(scan) else None,
+               'end': str(scan.time[-1]) if len(scan) else None,
+               'channels': stats}
+    if resample_interval:
+        resample(scan, resample_interval).save_npz(_outputs(directory, name, resample_interval)[1])
+    p_stats.write_text(json.dumps(summary, indent=2))
+    return ProcessResult(name, str(directory), 'done', stats, None)
+
+
+def _process_job(args):
+    directory, resample_interval, convert, force = args
+    try:
+        return process_scan(directory, resample_interval, convert, force)
+    except Exception as e:
+        return ProcessResult(Path(directory).name, str(directory), 'failed', None, '{0}: {1}'.format(type(e).__name__, e))
+
+
+def process_all(root, resample_interval=None, convert=True, force=False, workers=None):
+    """Process all scan files below root on a pool of workers processes
+    (default: one per core). Returns the list of ProcessResult, sorted by
+    path, and writes it to <root>/summary.csv."""
+    jobs = [(str(d), resample_interval, convert, force) for d in find_scan_files(root)]
+    if workers == 1 or len(jobs) <= 1:
+        results = [_process_job(job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(_process_job, jobs))   # map keeps the order of jobs
+    write_summary(Path(root) / 'summary.csv', results)
+    return results
+
+
+def write_summary(p, results):
+    """One line per scan file and channel with the channel statistics."""
+    with Path(p).open('w', newline='') as fh:
+        writer = csv.writer(fh)
+        writer.writerow(['directory', 'name', 'status', 'channel', 'channel name', 'unit', 'count', 'min', 'max', 'mean'])
+        for res in results:
+            if not res.stats:
+                writer.writerow([res.directory, res.name, res.status]+['']*7)
+                continue
+            for ch, st in res.stats.items():
+                writer.writerow([res.directory, res.name, res.status, ch, st['name'], st['unit'],
+                                 st['count'], st['min'], st['max'], st['mean']])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Process downloaded Fluke 1586A scan files in parallel.')
+    parser.add_argument('root', nargs='?', default='./downloads', help='download directory')
+    parser.add_argument('--resample', type=float, default=None, help='resampling interval in seconds')
+    parser.add_argument('--no-convert', action='store_true', help='keep the units of the conf files')
+    parser.add_argument('--force', action='store_true', help='process files whose outputs are up to date')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes (default: one per core)')
+    args = parser.parse_args(argv)
+
+    results = process_all(args.root, args.resample, not args.no_convert, args.force, args.workers)
+    for res in results:
+        print('{0:<8s} {1}{2}'.format(res.status, res.directory, '   '+res.error if res.error else ''))
+    print('{0} scan files, {1} processed, {2} up to date, {3} failed'.format(
+        len(results), *[len([r for r in results if r.status == s]) for s in ['done', 'skipped', 'failed']]))
+    return 0 if all(res.status != 'failed' for res in results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+# Python 3.X
+
+"""Multi-resolution min/max/mean levels of archived scan data.
+
+For overview plots of long time ranges, ScanArchive (pyfluke1586A_archive.py)
+keeps, next to the full resolution chunks of every scan file, aggregated
+levels with the count, sum, min and max of each channel per bin of 1 min,
+1 h and 1 day. Bins are aligned to whole multiples of the bin width, so
+the bins of all scan files and instruments share the same grid.
+
+The levels are updated with every append: only the new rows are
+aggregated. Closed bins are appended to one raw binary file per column
+and level, the last (still open) bin of each level is kept in the
+manifest of the scan file:
+
+    <scan dir>/pyramid/60/time.bin
+    <scan dir>/pyramid/60/101_count.bin
+    <scan dir>/pyramid/60/101_sum.bin
+    ...
+
+Rows that are older than the open bin (the instrument clock was set back)
+cannot be added to the closed bins. The levels are then rebuilt from all
+rows of the scan file, sorted by time, in a new directory (pyramid.1,
+pyramid.2, ...) that replaces the old one when the manifest is written.
+
+An overview query picks the coarsest level that still gives the
+requested number of points over the time range, and falls back to the
+full resolution data for short ranges:
+
+    ov = archive.overview(fluke.instrument_id(), ['101'], '2020-01-01', '2021-01-01', points=1000)
+    plt.fill_between(ov.time, ov.min['101'], ov.max['101'])
+    plt.plot(ov.time, ov.mean['101'])
+"""
+
+import shutil
+import collections
+
+import numpy as np
+
+PyramidLevels = [60, 3600, 86400]               # bin widths in seconds: 1 min, 1 h, 1 day
+PyramidStats = ['count', 'sum', 'min', 'max']   # aggregated per channel and bin
+PyramidDtypes = {'count': 'int64', 'sum': 'float64', 'min': 'float64', 'max': 'float64'}
+
+# Aggregated data of a time range: level is the bin width in seconds (0:
+# full resolution), time the start of each bin, mean, min, max and count
+# dicts of arrays per channel
+Overview = collections.namedtuple('Overview', ['level', 'time', 'mean', 'min', 'max', 'count'])
+
+
+def _column(channel, stat):
+    return '{0}_{1}'.format(channel, stat)
+
+
+def _reduce_bins(time, columns):
+    """Combine the rows of columns with equal (sorted) time stamps into one
+    bin each: counts and sums are added, min and max ignore NaN."""
+    if len(time) == 0:
+        return time, columns
+    starts = np.flatnonzero(np.r_[True, time[1:] != time[:-1]])
+    reduced = {}
+    for column, values in columns.items():
+        stat = column.rsplit('_', 1)[1]
+        ufunc = {'count': np.add, 'sum': np.add, 'min': np.fmin, 'max': np.fmax}[stat]
+        reduced[column] = ufunc.reduceat(values, starts)
+    return time[starts], reduced
+
+
+def aggregate(time, values, level):
+    """Aggregate rows (time stamps sorted) into bins of level seconds.
+    Returns the bin start times and a dict with the columns
+    '<channel>_<stat>' of PyramidStats."""
+    step = np.timedelta64(int(level*1000), 'ms')
+    bins = np.datetime64(0, 'ms')+((time-np.datetime64(0, 'ms'))//step)*step
+    columns = {}
+    for ch, v in values.items():
+        valid = ~np.isnan(v)
+        columns[_column(ch, 'count')] = valid.astype('int64')
+        columns[_column(ch, 'sum')] = np.where(valid, v, 0.)
+        columns[_column(ch, 'min')] = np.asarray(v, dtype='float64')
+        columns[_column(ch, 'max')] = np.asarray(v, dtype='float64')
+    return _reduce_bins(bins, columns)
+
+
+def _level_dir(directory, level):
+    return directory / '{0:d}'.format(level)
+
+
+def _append_closed(directory, level, closed, time, columns):
+    """Append bins to the column files of a level. The files are first cut
+    to the closed bins of the manifest, dropping bins written by an
+    append that was interrupted before the manifest was replaced."""
+    d = _level_dir(directory, level)
+    d.mkdir(parents=True, exist_ok=True)
+    for column, values in [('time', time)]+list(columns.items()):
+        values = np.ascontiguousarray(values)
+        p = d / '{0}.bin'.format(column)
+        with p.open('r+b' if p.exists() else 'wb') as fh:
+            fh.truncate(closed*values.itemsize)
+            fh.seek(0, 2)
+            fh.write(values.tobytes())
+
+
+def pyramid_dir(scan_dir, state):
+    """The directory of the levels of state in the directory of a scan file."""
+    return scan_dir / (state or {}).get('dir', 'pyramid')
+
+
+def can_update(state, time):
+    """True if the rows with time stamps time can be added to the levels of
+    state by update_pyramid: they are sorted and none is older than the
+    open bin of any level."""
+    if len(time) > 1 and not np.all(time[1:] >= time[:-1]):
+        return False
+    if state is None or len(time) == 0:
+        return True
+    return all(state[str(level)]['open'] is None or
+               time[0] >= np.datetime64(state[str(level)]['open']['time'], 'ms') for level in PyramidLevels)
+
+
+def update_pyramid(directory, state, time, values):
+    """Add new rows to the levels in directory. state is the 'pyramid'
+    entry of the manifest (None for a new scan file); the updated state is
+    returned and must be saved with the manifest. Raises ValueError if the
+    rows cannot be added (see can_update)."""
+    if not can_update(state, time):
+        raise ValueError('Rows are not sorted or older than the open bin, rebuild the levels')
+    if state is None:
+        state = {str(level): {'closed': 0, 'open': None} for level in PyramidLevels}
+    if len(time) == 0:
+        return state
+    for level in PyramidLevels:
+        entry = state[str(level)]
+        bin_time, columns = aggregate(time, values, level)
+        if entry['open'] is not None:
+            # The open bin is combined with the new rows of the same bin,
+            # or closed if the new rows start a later bin
+            open_time = np.array([entry['open']['time']], dtype='datetime64[ms]')
+            bin_time = np.concatenate([open_time, bin_time])
+            for column in columns:
+                value = np.array([entry['open']['columns'][column]], dtype=columns[column].dtype)
+                columns[column] = np.concatenate([value, columns[column]])
+            bin_time, columns = _reduce_bins(bin_time, columns)
+        _append_closed(directory, level, entry['closed'], bin_time[:-1], {c: v[:-1] for c, v in columns.items()})
+        entry['closed'] += len(bin_time)-1
+        entry['open'] = {'time': str(bin_time[-1]),
+                         'columns': {c: v[-1].item() for c, v in columns.items()}}
+    return state
+
+
+def build_pyramid(scan_dir, generation, time, values):
+    """Build the levels of all rows of a scan file (in any order) in the new
+    directory pyramid.<generation>. Returns the state."""
+    name = 'pyramid.{0:d}'.format(generation)
+    shutil.rmtree(scan_dir / name, ignore_errors=True)    # left by an interrupted rebuild
+    order = np.argsort(time, kind='stable')
+    state = update_pyramid(scan_dir / name, None, time[order], {ch: v[order] for ch, v in values.items()})
+    state['dir'] = name
+    state['generation'] = generation
+    return state
+
+
+def _read_column(directory, level, column, dtype, count):
+    p = _level_dir(directory, level) / '{0}.bin'.format(column)
+    if count == 0 or not p.exists():
+        return np.empty(0, dtype=dtype)
+    return np.memmap(p, dtype=dtype, mode='r', shape=(count,))
+
+
+def read_level(directory, state, level, channels, start=None, end=None):
+    """Read the bins of a level overlapping start <= time < end. Returns the
+    bin start times and a dict with the columns of channels. The closed bins
+    are memory mapped, so only the bins in the range are read."""
+    entry = state[str(level)]
+    step = np.timedelta64(int(level*1000), 'ms')
+    start = None if start is None else np.datetime64(start, 'ms')
+    end = None if end is None else np.datetime64(end, 'ms')
+    time = _read_column(directory, level, 'time', 'datetime64[ms]', entry['closed'])
+    lo = 0 if start is None else int(np.searchsorted(time, start-step, side='right'))
+    hi = len(time) if end is None else int(np.searchsorted(time, end, side='left'))
+    open_bin = entry['open']
+    if open_bin is not None and hi == len(time):
+        open_time = np.datetime64(open_bin['time'], 'ms')
+        if (start is not None and open_time+step <= start) or (end is not None and open_time >= end):
+            open_bin = None
+    else:
+        open_bin = None
+
+    columns = {}
+    for ch in channels:
+        for stat in PyramidStats:
+            column = _column(ch, stat)
+            values = np.array(_read_column(directory, level, column, PyramidDtypes[stat], entry['closed'])[lo:hi])
+            if open_bin is not None:
+                values = np.append(values, np.array(open_bin['columns'][column], dtype=PyramidDtypes[stat]))
+            columns[column] = values
+    time = np.array(time[lo:hi])
+    if open_bin is not None:
+        time = np.append(time, np.datetime64(open_bin['time'], 'ms'))
+    return time, columns
+
+
+def merge_bins(parts, channels):
+    """Merge the bins (time, columns) of several scan files into one set of
+    bins sorted by time, combining bins with the same time. Channels missing
+    from a part count as bins without values."""
+    if not parts:
+        return np.empty(0, dtype='datetime64[ms]'), {_column(ch, stat): np.empty(0, dtype=PyramidDtypes[stat])
+                                                     for ch in channels for stat in PyramidStats}
+    time = np.concatenate([t for t, columns in parts])
+    order = np.argsort(time, kind='stable')
+    merged = {}
+    for ch in channels:
+        for stat in PyramidStats:
+            column = _column(ch, stat)
+            empty = {'count': 0, 'sum': 0., 'min': np.nan, 'max': np.nan}[stat]
+            merged[column] = np.concatenate([columns[column] if column in columns else
+                                             np.full(len(t), empty, dtype=PyramidDtypes[stat])
+                                             for t, columns in parts])[order]
+    return _reduce_bins(time[order], merged)
+
+
+def make_overview(level, time, columns, channels):
+    """Overview of the bins (time, columns) of a level."""
+    counts = {ch: columns[_column(ch, 'count')] for ch in channels}
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = {ch: np.where(counts[ch] > 0, columns[_column(ch, 'sum')]/counts[ch], np.nan) for ch in channels}
+    return Overview(level, time, mean, {ch: columns[_column(ch, 'min')] for ch in channels},
+                    {ch: columns[_column(ch, 'max')] for ch in channels}, counts)
+
+
+def scan_overview(scan):
+    """Overview of full resolution data (a ScanData): level 0, with mean,
+    min and max equal to the values."""
+    return Overview(0, scan.time, dict(scan.values), dict(scan.values), dict(scan.values),
+                    {ch: (~np.isnan(scan[ch])).astype('int64') for ch in scan.channels})
+
+
+def choose_level(start, end, points):
+    """The coarsest level with at least points bins from start to end, or
+    0 (full resolution) if even the finest level has fewer bins."""
+    span = (np.datetime64(end, 'ms')-np.datetime64(start, 'ms'))/np.timedelta64(1, 's')
+    for level in reversed(PyramidLevels):
+        if span/level >= points:
+            return level
+    return 0
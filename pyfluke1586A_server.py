@@ -0,0 +1,408 @@
+#!/usr/bin/env python
+# Python 3.X
+
+"""Local server that shares Fluke 1586A instruments between many clients.
+
+A serial port can only be opened by one process. The server owns the
+ports and exposes the driver operations over HTTP with JSON replies:
+
+    python pyfluke1586A_server.py --config fleet.toml --listen 127.0.0.1:8586
+
+    GET  /                                  list of instruments
+    GET  /<nickname>/identify               *idn?
+    GET  /<nickname>/offset?samples=3       instrument clock offset (s)
+    GET  /<nickname>/query?command=SYST:DATE%3F
+    GET  /<nickname>/live?slot=1            stream of readings (one JSON object per line)
+    GET  /<nickname>/stats                  commands executed and coalesced
+    POST /<nickname>/sync, /initiate, /abort, /write?command=..., /download?name=...
+
+All commands to an instrument are executed by one worker thread, which
+takes them round robin from the queues of the clients, so a client
+sending many commands cannot starve the others. Identical queries that
+are waiting or running at the same time are coalesced: they are sent to
+the instrument once and all callers get the same reply. Live readings of
+a data slot are polled once, however many clients subscribe, and fanned
+out to a RingBuffer per subscriber (a slow subscriber drops its oldest
+readings instead of holding up the others).
+
+Fluke1586AClient is a small Python client for the server.
+"""
+
+import sys
+import json
+import logging
+import argparse
+import threading
+import collections
+import urllib.error
+import urllib.parse
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from pyfluke1586A import Fluke1586A, _file_size, _is_query
+from pyfluke1586A_live import RingBuffer, parse_readings, LivePollIntervalSecs
+
+ServerRequestTimeoutSecs = 600.     # max time (in seconds) a client waits for its command
+LiveSubscriberCapacity = 1024       # readings buffered per live subscriber
+
+
+def _read_values(fluke, slot, start=1):
+    fluke.select_slot(int(slot))
+    return fluke.read_values(int(start)).decode()
+
+
+def _download(fluke, name, incremental='false'):
+    info = fluke.get_scan_file_info(name)
+    fluke.download_data(name, size=_file_size(info),
+                        incremental=incremental.lower() in ['1', 'true', 'yes'])
+    return str(fluke.download_dir / name)
+
+
+def _only_queries(command):
+    """True if all parts of a (compound) command are queries, so sending
+    it once for several callers has no side effects."""
+    return all(_is_query(part.strip()) for part in command.split(';:'))
+
+
+# name -> (function(fluke, **params), coalesce(params)): the operations clients can request
+Operations = {
+    'identify': (lambda fluke: fluke.query('*idn?'),                    lambda params: True),
+    'version':  (lambda fluke: fluke.query('SYST:VERS?'),               lambda params: True),
+    'offset':   (lambda fluke, samples=1: fluke.probe_offset(int(samples))[0].total_seconds(), lambda params: True),
+    'catalog':  (lambda fluke, refresh='false': fluke.list_scan_files(refresh=refresh.lower() in ['1', 'true', 'yes']), lambda params: True),
+    'query':    (lambda fluke, command: fluke.send_message(command)[0].decode(), lambda params: _only_queries(params.get('command', ''))),
+    'values':   (_read_values,                                           lambda params: True),
+    'write':    (lambda fluke, command: fluke.send_message(command, get_response=False) and None, lambda params: False),
+    'sync':     (lambda fluke: [o.total_seconds() for o in fluke.sync_datetime()], lambda params: False),
+    'initiate': (lambda fluke: fluke.initiate_scan()[1].strip(),         lambda params: False),
+    'abort':    (lambda fluke: fluke.abort_scan()[1].strip(),            lambda params: False),
+    'download': (_download,                                              lambda params: False),
+    }
+
+
+class _Job(object):
+    def __init__(self, key, func, params):
+        self.key = key
+        self.func = func
+        self.params = params
+        self.value = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class InstrumentWorker(object):
+    """Executes the commands for one instrument, fairly and coalesced."""
+    def __init__(self, fluke):
+        self.fluke = fluke
+        self.queues = collections.OrderedDict()   # client -> deque of jobs, in round robin order
+        self.pending = {}                         # coalescing key -> job waiting or running
+        self.executed = 0
+        self.coalesced = 0
+        self.feeds = {}                           # slot -> _LiveFeed
+        self._cond = threading.Condition()
+        self._stop = False
+        self._thread = threading.Thread(target=self._run, name='Worker-{0}'.format(fluke.nickname), daemon=True)
+        self._thread.start()
+
+    def submit(self, client, operation, params=None):
+        """Queue operation for client and return its job (see _Job.done)."""
+        func, coalesce = Operations[operation]
+        params = dict(params or {})
+        key = (operation, tuple(sorted(params.items()))) if coalesce(params) else None
+        with self._cond:
+            job = self.pending.get(key) if key is not None else None
+            if job is not None:
+                self.coalesced += 1
+                return job
+            job = _Job(key, func, params)
+            if key is not None:
+                self.pending[key] = job
+            self.queues.setdefault(client, collections.deque()).append(job)
+            self._cond.notify()
+            return job
+
+    def call(self, client, operation, params=None, timeout=ServerRequestTimeoutSecs):
+        job = self.submit(client, operation, params)
+        if not job.done.wait(timeout):
+            raise TimeoutError('{0} not executed within {1:.0f} s'.format(operation, timeout))
+        if job.error is not None:
+            raise job.error
+        return job.value
+
+    def _next_job(self):
+        """Take the first job of the next client in round robin order."""
+        client, queue = next(iter(self.queues.items()))
+        job = queue.popleft()
+        del self.queues[client]
+        if queue:
+            self.queues[client] = queue     # back of the line
+        return job
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self.queues or self._stop)
+                if self._stop:
+                    return
+                job = self._next_job()
+            try:
+                with self.fluke.lock:
+                    job.value = job.func(self.fluke, **job.params)
+            except Exception as e:
+                logging.info('Server: {0} failed   ({1}@{2}): {3}'.format(job.key, self.fluke.nickname, self.fluke.com_port, e))
+                job.error = e
+            with self._cond:
+                self.executed += 1
+                if job.key is not None:
+                    self.pending.pop(job.key, None)
+            job.done.set()
+
+    def subscribe(self, slot, start=1):
+        """Subscribe to the live readings of slot. Returns a RingBuffer that
+        receives LiveReading records; call unsubscribe() with it when done."""
+        with self._cond:
+            feed = self.feeds.get(slot)
+            if feed is None or not feed.running or feed.stopping:
+                feed = self.feeds[slot] = _LiveFeed(self, slot, start)
+            return feed.add()
+
+    def unsubscribe(self, slot, buffer):
+        with self._cond:
+            feed = self.feeds.get(slot)
+        if feed is not None:
+            feed.remove(buffer)
+
+    def stop(self):
+        with self._cond:
+            self._stop = True
+            self._cond.notify_all()
+        for feed in list(self.feeds.values()):
+            feed.stop()
+
+
+class _LiveFeed(object):
+    """Polls the readings of one data slot (as jobs of the worker, so polling
+    shares the instrument fairly) and fans them out to the subscribers."""
+    def __init__(self, worker, slot, start=1, poll_interval=LivePollIntervalSecs):
+        self.worker = worker
+        self.slot = slot
+        self.next_index = start
+        self.poll_interval = poll_interval
+        self.subscribers = []
+        self.running = True
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='LiveFeed-{0}'.format(slot), daemon=True)
+        self._thread.start()
+
+    def add(self):
+        buffer = RingBuffer(LiveSubscriberCapacity, overwrite=True)
+        with self._lock:
+            self.subscribers.append(buffer)
+        return buffer
+
+    def remove(self, buffer):
+        buffer.close()
+        with self._lock:
+            if buffer in self.subscribers:
+                self.subscribers.remove(buffer)
+            if not self.subscribers:
+                self._stop.set()
+
+    @property
+    def stopping(self):
+        return self._stop.is_set()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        try:
+            while not self._stop.is_set():
+                resp = self.worker.call('live', 'values', {'slot': str(self.slot), 'start': str(self.next_index)})
+                readings = parse_readings(resp.encode(), self.next_index)
+                with self._lock:
+                    subscribers = list(self.subscribers)
+                for reading in readings:
+                    for buffer in subscribers:
+                        buffer.put(reading)
+                    self.next_index = reading.index+1
+                self._stop.wait(self.poll_interval if readings else 4*self.poll_interval)
+        except Exception as e:
+            logging.info('Server: live feed of slot {0} stopped: {1}'.format(self.slot, e))
+        finally:
+            self.running = False
+            with self._lock:
+                for buffer in self.subscribers:
+                    buffer.close()
+
+
+def _reading_to_json(reading):
+    return json.dumps({'index': reading.index, 'time': None if reading.time is None else str(reading.time),
+                       'values': reading.values.tolist()})
+
+
+class _Handler(BaseHTTPRequestHandler):
+    server_version = 'pyfluke1586A'
+
+    def log_message(self, format, *args):
+        logging.info('Server: {0} {1}'.format(self.address_string(), format % args))
+
+    def _reply(self, status, obj):
+        body = json.dumps(obj, default=str).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _handle(self, method):
+        url = urllib.parse.urlsplit(self.path)
+        params = {k: v[-1] for k, v in urllib.parse.parse_qs(url.query).items()}
+        client = params.pop('client', None) or self.client_address[0]
+        parts = [urllib.parse.unquote(p) for p in url.path.split('/') if p]
+        workers = self.server.workers
+
+        if len(parts) == 0:
+            return self._reply(200, {name: w.fluke.com_port for name, w in workers.items()})
+        if parts[0] not in workers or len(parts) != 2:
+            return self._reply(404, {'ok': False, 'error': 'Unknown path {0}'.format(url.path)})
+        worker, operation = workers[parts[0]], parts[1]
+
+        if operation == 'stats':
+            return self._reply(200, {'executed': worker.executed, 'coalesced': worker.coalesced,
+                                     'queued': sum(len(q) for q in worker.queues.values())})
+        if operation == 'live':
+            try:
+                slot, start = int(params.get('slot', 1)), int(params.get('start', 1))
+            except ValueError as e:
+                return self._reply(400, {'ok': False, 'error': str(e)})
+            return self._stream(worker, slot, start)
+        if operation not in Operations:
+            return self._reply(404, {'ok': False, 'error': 'Unknown operation {0}'.format(operation)})
+        if method == 'GET' and not Operations[operation][1](params):
+            return self._reply(405, {'ok': False, 'error': 'Use POST for {0}'.format(operation)})
+        try:
+            value = worker.call(client, operation, params)
+        except TypeError as e:
+            return self._reply(400, {'ok': False, 'error': str(e)})
+        except Exception as e:
+            return self._reply(502, {'ok': False, 'error': '{0}: {1}'.format(type(e).__name__, e)})
+        return self._reply(200, {'ok': True, 'value': value})
+
+    def _stream(self, worker, slot, start):
+        buffer = worker.subscribe(slot, start)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/x-ndjson')
+        self.end_headers()
+        try:
+            while True:
+                reading = buffer.get()
+                if reading is None:
+                    break
+                self.wfile.write((_reading_to_json(reading)+'\n').encode())
+                self.wfile.flush()
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        finally:
+            worker.unsubscribe(slot, buffer)
+        self.close_connection = True
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+
+class Fluke1586AServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, flukes, address=('127.0.0.1', 8586)):
+        """flukes is a list of open Fluke1586A (with unique nicknames)."""
+        self.workers = collections.OrderedDict((fluke.nickname or fluke.com_port, InstrumentWorker(fluke)) for fluke in flukes)
+        ThreadingHTTPServer.__init__(self, address, _Handler)
+
+    @property
+    def url(self):
+        return 'http://{0}:{1:d}'.format(*self.server_address)
+
+    def close(self):
+        """Close the server and the instrument ports (after shutdown() if
+        serve_forever() runs in another thread)."""
+        self.server_close()
+        for worker in self.workers.values():
+            worker.stop()
+            worker.fluke.close()
+
+
+class Fluke1586AClient(object):
+    """Client for an instrument on a Fluke1586AServer:
+
+        fluke = Fluke1586AClient('http://127.0.0.1:8586', 'rack-A1')
+        fluke.call('identify')
+        for reading in fluke.live(slot=1): ...
+    """
+    def __init__(self, url, nickname, client=None, timeout=ServerRequestTimeoutSecs):
+        self.url = url.rstrip('/')
+        self.nickname = nickname
+        self.client = client
+        self.timeout = timeout
+
+    def _url(self, operation, params):
+        params = dict(params)
+        if self.client:
+            params['client'] = self.client
+        return '{0}/{1}/{2}?{3}'.format(self.url, urllib.parse.quote(self.nickname, safe=''), operation, urllib.parse.urlencode(params))
+
+    def call(self, operation, **params):
+        method = 'GET' if operation in Operations and Operations[operation][1]({k: str(v) for k, v in params.items()}) else 'POST'
+        request = urllib.request.Request(self._url(operation, params), method=method)
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as resp:
+                reply = json.loads(resp.read())
+        except urllib.error.HTTPError as e:
+            reply = json.loads(e.read())
+        if not reply.get('ok'):
+            raise RuntimeError(reply.get('error'))
+        return reply['value']
+
+    def live(self, slot=1, start=1):
+        """Yield the live readings of slot as dicts (index, time, values)."""
+        with urllib.request.urlopen(self._url('live', {'slot': slot, 'start': start})) as resp:
+            for line in resp:
+                yield json.loads(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Share Fluke 1586A instruments between clients over HTTP.')
+    parser.add_argument('--config', default=None, help='TOML file listing the instruments (see pyfluke1586A_fleet.py)')
+    parser.add_argument('--instrument', action='append', default=[], help='port of an instrument (repeatable)')
+    parser.add_argument('--listen', default='127.0.0.1:8586', help='address to listen on, host:port')
+    args = parser.parse_args(argv)
+
+    from pyfluke1586A_fleet import read_fleet_config, driver_kwargs
+    instruments = [{'port': port, 'nickname': port} for port in args.instrument]
+    if args.config:
+        instruments += read_fleet_config(args.config)
+    if not instruments:
+        parser.error('no instruments given, use --config or --instrument')
+
+    flukes = []
+    for inst in instruments:
+        flukes.append(Fluke1586A(inst['port'], nickname=inst['nickname'], verbose=False, **driver_kwargs(inst)))
+
+    host, port = args.listen.rsplit(':', 1)
+    server = Fluke1586AServer(flukes, (host, int(port)))
+    print('Serving {0} instruments at {1}  (Ctrl-C to stop)'.format(len(flukes), server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
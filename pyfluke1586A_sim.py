@@ -0,0 +1,341 @@
+#!/usr/bin/env python
+# Python 3.X
+
+"""Simulated Fluke 1586A for testing and benchmarking without hardware.
+
+The simulator answers the commands used by pyfluke1586A:
+
+    *idn?, SYST:VERS?, SYST:DATE[?], SYST:TIME[?], SYST:COMM:SER:BAUD,
+    MEM:LOG:NFIL?, MEM:LOG:NAME? <n>, MEM:LOG:PROP? "<name>",
+    MEM:LOG:READ? "<name>"[,<start>], MEM:LOG:READ:CONF? "<name>",
+    LOG:AUT:LAB <n>, LOG:AUT:VAL? <n>, INIT, ABOR
+
+including compound commands ('cmd1;:cmd2'). It serves on a TCP port,
+reachable as socket://host:port, or (POSIX only) on a pseudo terminal
+that is opened like a serial port. Transfer rate can be limited to that
+of a serial line (baudrate, 10 bits per byte) and each reply can be
+delayed by a fixed latency. Scan files are synthetic and can be made as
+large as needed:
+
+    python pyfluke1586A_sim.py --port 5025 --baud 9600 --files 3 --rows 100000
+
+    sim = Fluke1586ASimulator(rows=100000)
+    url = sim.serve_tcp()           # 'socket://127.0.0.1:<port>'
+    fluke = Fluke1586A(url)
+
+NtpSimulator answers NTP requests on a UDP port with the PC time plus a
+given offset, so the internet time offset (get_internet_time_offset,
+ClockMonitor) can be tested without network access:
+
+    ntp = NtpSimulator(offset=2.5)
+    host, port = ntp.serve_udp()
+    monitor = ClockMonitor(fluke, ntp_server=host, ntp_port=port)
+"""
+
+import os
+import sys
+import time
+import socket
+import struct
+import argparse
+import threading
+import socketserver
+import datetime as dt
+
+SimScanIntervalSecs = 1.0       # interval between readings of a running (simulated) scan
+NtpEpochOffset = 2208988800     # seconds from the NTP epoch (1900) to the Unix epoch (1970)
+
+
+class Fluke1586ASimulator(object):
+    def __init__(self, files=2, rows=1000, channels=4, baudrate=None, latency=0.,
+                 scan_interval=SimScanIntervalSecs, idn='FLUKE,1586A,SIM0001,1.00'):
+        self.idn = idn
+        self.baudrate = baudrate        # None: no rate limit
+        self.latency = latency          # delay (in seconds) before each reply
+        self.channels = ['{0:d}'.format(101+id) for id in range(channels)]
+        self.scan_interval = scan_interval
+        self.offset = dt.timedelta(0)   # instrument clock - PC clock
+        self.scan_started = None
+        self.slot = 1
+        self.files = {}                 # name -> number of rows
+        for id in range(files):
+            self.files['SIM_{0:04d}'.format(id+1)] = rows
+        self._cache = {}
+        self._lock = threading.Lock()
+        self.servers = []
+        for name in self.files:
+            self.data(name)     # generate now, so the first reply is not delayed
+
+    # ---- synthetic data --------------------------------------------------
+
+    def now(self):
+        return dt.datetime.now()+self.offset
+
+    def _row(self, name, id):
+        """Row id (1-based) of scan file name."""
+        t = dt.datetime(2020, 1, 1)+dt.timedelta(seconds=10*(id-1))
+        values = ','.join('{0:.4f},'.format(20.+0.01*ch+((id*(ch+7)) % 1000)/1000.) for ch in range(len(self.channels)))
+        return '{0:d},{1},{2}'.format(id, t.strftime('%Y-%m-%d %H:%M:%S.000'), values)
+
+    def header(self):
+        return 'Scan,Time,'+','.join('CH{0} (C),Alarm'.format(ch) for ch in self.channels)
+
+    def data(self, name, start=None):
+        """The MEM:LOG:READ? payload of scan file name, from row start if given."""
+        key = (name, start)
+        with self._lock:
+            if key not in self._cache:
+                rows = self.files[name]
+                lines = [] if start else [self.header()]
+                lines += [self._row(name, id) for id in range(start or 1, rows+1)]
+                self._cache[key] = ('\r\r'.join(lines)+'\r\r').encode()
+            return self._cache[key]
+
+    def conf(self, name):
+        lines = ['Channel,Label,Function,Unit']
+        lines += ['{0},CH{0},PRT,C'.format(ch) for ch in self.channels]
+        return ('\r\r'.join(lines)+'\r\r').encode()
+
+    def add_rows(self, name, n):
+        """Append n rows to scan file name (e.g. to test incremental downloads)."""
+        with self._lock:
+            self.files[name] = self.files.get(name, 0)+n
+            self._cache = {k: v for k, v in self._cache.items() if k[0] != name}
+        self.data(name)
+
+    def live_values(self, start):
+        """Readings of the running scan from index start (LOG:AUT:VAL?)."""
+        if self.scan_started is None:
+            return b''
+        n = int((time.time()-self.scan_started)/self.scan_interval)+1
+        t0 = dt.datetime.fromtimestamp(self.scan_started)+self.offset
+        lines = []
+        for id in range(max(start, 1), n+1):
+            t = t0+dt.timedelta(seconds=self.scan_interval*(id-1))
+            lines.append('{0:d},{1},{2:.4f}'.format(id, t.strftime('%Y-%m-%d %H:%M:%S.%f')[:-3], 20.+(id % 100)/100.))
+        return ('\r\r'.join(lines)+'\r\r').encode() if lines else b''
+
+    # ---- command handling ------------------------------------------------
+
+    def answer(self, command):
+        """Return the reply (bytes, None for no reply) to a single command."""
+        command = command.strip()
+        header, _, args = command.partition(' ')
+        header = header.upper()
+        args = args.strip()
+        name = args.split(',')[0].strip().strip('"')
+
+        if header == '*IDN?':
+            return (self.idn+'\r').encode()
+        if header == 'SYST:VERS?':
+            return b'1994.0\r'
+        if header == 'SYST:DATE?':
+            return self.now().strftime('%Y,%m,%d\r').encode()
+        if header == 'SYST:TIME?':
+            return self.now().strftime('%H,%M,%S\r').encode()
+        if header == 'SYST:DATE':
+            y, m, d = [int(v) for v in args.split(',')]
+            now = self.now()
+            self.offset += now.replace(year=y, month=m, day=d)-now
+            return None
+        if header == 'SYST:TIME':
+            h, m, s = [int(v) for v in args.split(',')]
+            now = self.now()
+            self.offset += now.replace(hour=h, minute=m, second=s, microsecond=0)-now
+            return None
+        if header == 'SYST:COMM:SER:BAUD':
+            if self.baudrate:
+                self.baudrate = int(args)
+            return None
+        if header == 'MEM:LOG:NFIL?':
+            return '{0:d}\r'.format(len(self.files)).encode()
+        if header == 'MEM:LOG:NAME?':
+            names = sorted(self.files)
+            return '{0}\r'.format(names[int(args)-1]).encode()
+        if header == 'MEM:LOG:PROP?':
+            return '{0:d},2020-01-01 00:00:00,SIM\r'.format(len(self.data(name))).encode()
+        if header == 'MEM:LOG:READ?':
+            start = args.split(',')
+            return self.data(name, int(start[1]) if len(start) > 1 else None)
+        if header == 'MEM:LOG:READ:CONF?':
+            return self.conf(name)
+        if header == 'LOG:AUT:LAB':
+            self.slot = int(args)
+            return None
+        if header == 'LOG:AUT:VAL?':
+            return self.live_values(int(args or 1)) or None
+        if header == 'INIT':
+            self.scan_started = time.time()
+            return None
+        if header == 'ABOR':
+            self.scan_started = None
+            return None
+        return None
+
+    def handle(self, line):
+        """Reply to a (possibly compound) command line."""
+        replies = [self.answer(cmd) for cmd in line.split(';:')]
+        replies = [r for r in replies if r is not None]
+        if len(replies) <= 1:
+            return replies[0] if replies else None
+        return b';'.join(r.rstrip(b'\r') for r in replies)+b'\r'
+
+    def serve(self, recv, send):
+        """Serve one connection, given functions to receive and send bytes."""
+        buf = b''
+        while True:
+            data = recv()
+            if not data:
+                return
+            buf += data
+            while b'\r' in buf:
+                line, buf = buf.split(b'\r', 1)
+                line = line.decode(errors='replace').strip()
+                if not line:
+                    continue
+                reply = self.handle(line)
+                if reply:
+                    if self.latency:
+                        time.sleep(self.latency)
+                    self._send(send, reply)
+
+    def _send(self, send, reply):
+        """Send reply, limited to the emulated serial transfer rate."""
+        if not self.baudrate:
+            send(reply)
+            return
+        rate = self.baudrate/10.     # 8N1: 10 bits per byte
+        chunk = max(1, int(rate*0.01))
+        tstart = time.time()
+        for pos in range(0, len(reply), chunk):
+            send(reply[pos:pos+chunk])
+            delay = tstart+(pos+chunk)/rate-time.time()
+            if delay > 0:
+                time.sleep(delay)
+
+    # ---- transports -----------------------------------------------------
+
+    def serve_tcp(self, host='127.0.0.1', port=0):
+        """Serve in a background thread on a TCP port.
+        Returns the URL to open, 'socket://host:port'."""
+        sim = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                sim.serve(lambda: self.request.recv(4096), self.request.sendall)
+
+        server = socketserver.ThreadingTCPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.servers.append(server)
+        return 'socket://{0}:{1:d}'.format(*server.server_address)
+
+    def serve_pty(self):
+        """Serve in a background thread on a pseudo terminal (POSIX only).
+        Returns the device name to open as a serial port."""
+        import pty, tty
+        master, slave = pty.openpty()
+        tty.setraw(slave)
+
+        def send(data):
+            while data:
+                data = data[os.write(master, data):]
+
+        def recv():
+            try:
+                return os.read(master, 4096)
+            except OSError:
+                return b''
+
+        threading.Thread(target=self.serve, args=(recv, send), daemon=True).start()
+        return os.ttyname(slave)
+
+    def close(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        self.servers = []
+
+
+class NtpSimulator(object):
+    """NTP server answering with the PC time plus offset seconds."""
+    def __init__(self, offset=0.):
+        self.offset = offset
+        self.requests = 0       # number of requests answered
+        self.servers = []
+
+    def _timestamp(self, t):
+        t += NtpEpochOffset
+        return struct.pack('!II', int(t), int((t-int(t))*2**32) & 0xffffffff)
+
+    def answer(self, request):
+        """The reply (bytes) to a client request, None if it is not one."""
+        if len(request) < 48 or request[0] & 0x07 != 3:     # mode 3: client
+            return None
+        received = self._timestamp(time.time()+self.offset)
+        version = (request[0] >> 3) & 0x07
+        header = struct.pack('!BBbbII4s', (version << 3) | 4, 1, 0, -20, 0, 0, b'SIM\0')
+        self.requests += 1
+        # reference, originate (the client transmit time), receive and transmit timestamps
+        return header+received+request[40:48]+received+self._timestamp(time.time()+self.offset)
+
+    def serve_udp(self, host='127.0.0.1', port=0):
+        """Serve in a background thread on a UDP port. Returns (host, port)."""
+        ntp = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                data, sock = self.request
+                reply = ntp.answer(data)
+                if reply:
+                    sock.sendto(reply, self.client_address)
+
+        server = socketserver.ThreadingUDPServer((host, port), Handler)
+        server.daemon_threads = True
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        self.servers.append(server)
+        return server.server_address[:2]
+
+    def close(self):
+        for server in self.servers:
+            server.shutdown()
+            server.server_close()
+        self.servers = []
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Simulated Fluke 1586A.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5025, help='TCP port (0: any free port)')
+    parser.add_argument('--pty', action='store_true', help='serve on a pseudo terminal instead of TCP')
+    parser.add_argument('--baud', type=int, default=None, help='emulated serial transfer rate')
+    parser.add_argument('--latency', type=float, default=0., help='reply latency in seconds')
+    parser.add_argument('--files', type=int, default=2, help='number of scan files')
+    parser.add_argument('--rows', type=int, default=1000, help='rows per scan file')
+    parser.add_argument('--channels', type=int, default=4)
+    parser.add_argument('--ntp-port', type=int, default=None, help='also answer NTP requests on this UDP port')
+    parser.add_argument('--ntp-offset', type=float, default=0., help='offset (s) of the simulated internet time')
+    args = parser.parse_args(argv)
+
+    sim = Fluke1586ASimulator(files=args.files, rows=args.rows, channels=args.channels,
+                              baudrate=args.baud, latency=args.latency)
+    url = sim.serve_pty() if args.pty else sim.serve_tcp(args.host, args.port)
+    print('Simulated Fluke 1586A at {0}  (Ctrl-C to stop)'.format(url))
+    ntp = None
+    if args.ntp_port is not None:
+        ntp = NtpSimulator(args.ntp_offset)
+        print('Simulated NTP server at {0}:{1:d}'.format(*ntp.serve_udp(args.host, args.ntp_port)))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    sim.close()
+    if ntp is not None:
+        ntp.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,43 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+from pyfluke1586A import Fluke1586A
+from pyfluke1586A_sim import Fluke1586ASimulator, NtpSimulator
+
+
+@pytest.fixture
+def sim():
+    """Simulated instrument with two scan files of 20 rows, recording the
+    commands it receives in sim.commands."""
+    sim = Fluke1586ASimulator(files=2, rows=20)
+    sim.commands = []
+    handle = sim.handle
+
+    def recording_handle(line):
+        sim.commands.append(line)
+        return handle(line)
+
+    sim.handle = recording_handle
+    yield sim
+    sim.close()
+
+
+@pytest.fixture
+def fluke(sim, tmp_path):
+    """Fluke1586A connected to sim over TCP, downloading to tmp_path."""
+    fluke = Fluke1586A(sim.serve_tcp(), nickname='sim', verbose=False, download_dir=tmp_path / 'downloads')
+    yield fluke
+    fluke.close()
+
+
+@pytest.fixture
+def ntp():
+    """Simulated NTP server, 2.5 s ahead of the PC clock, at ntp.address."""
+    ntp = NtpSimulator(offset=2.5)
+    ntp.address = ntp.serve_udp()
+    yield ntp
+    ntp.close()
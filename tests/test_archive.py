@@ -0,0 +1,167 @@
+"""ScanArchive: chunked archive of downloaded scan files and its pyramid
+levels."""
+
+import numpy as np
+import pytest
+
+import pyfluke1586A_archive
+import pyfluke1586A_data
+from pyfluke1586A_archive import ScanArchive
+from pyfluke1586A_data import ScanData, load_scan
+
+
+def _scan_data(time, scan=None):
+    return ScanData(time, {'101': np.arange(len(time), dtype='float64')},
+                    scan=None if scan is None else np.asarray(scan))
+
+
+def _set_back(n=100, m=50, back=30):
+    """n rows at 1 s, then m rows after the clock was set back by back s."""
+    time = np.datetime64('2020-01-01', 'ms')+np.arange(n)*np.timedelta64(1, 's')
+    after = time[-1]-np.timedelta64(back, 's')+np.arange(1, m+1)*np.timedelta64(1, 's')
+    return np.concatenate([time, after])
+
+
+def test_append_download(sim, fluke, tmp_path):
+    archive = ScanArchive(tmp_path / 'archive')
+    fluke.download_data('SIM_0001', incremental=True, archive=archive)
+    directory = fluke.download_dir / 'SIM_0001'
+    data = archive.read_scan(fluke.instrument_id(), 'SIM_0001')
+    assert len(data) == 20
+    assert np.array_equal(data.time, load_scan(directory, 'SIM_0001').time)
+
+    sim.add_rows('SIM_0001', 5)
+    fluke.download_data('SIM_0001', incremental=True, archive=archive)
+    data = archive.read_scan(fluke.instrument_id(), 'SIM_0001')
+    assert len(data) == 25
+    assert np.array_equal(data.scan, np.arange(1, 26))
+    assert np.array_equal(data['101'], load_scan(directory, 'SIM_0001')['101'])
+    assert archive.append_download(fluke.instrument_id(), directory) == 0
+
+
+@pytest.mark.parametrize('with_scan', [False, True])
+def test_append_after_clock_set_back(tmp_path, with_scan):
+    archive = ScanArchive(tmp_path / 'archive')
+    time = _set_back()
+    scan = np.arange(1, len(time)+1) if with_scan else None
+    assert archive.append('I', 'S', _scan_data(time[:100], None if scan is None else scan[:100])) == 100
+    # The rows after the set-back are older than the last archived row
+    assert archive.append('I', 'S', _scan_data(time, scan)) == 50
+    assert archive.append('I', 'S', _scan_data(time, scan)) == 0
+
+    data = archive.read_scan('I', 'S')
+    assert np.array_equal(data.time, time)
+    assert np.array_equal(data['101'], np.arange(150.))
+    # The rows are merged into one chunk, its time range is the min and max
+    # of its times, not those of its first and last row
+    chunks = archive.manifest('I', 'S')['chunks']
+    assert [c['rows'] for c in chunks] == [150]
+    assert (chunks[0]['start'], chunks[0]['end']) == (str(time.min()), str(time.max()))
+    entry = archive.index('I')['scans']['S']
+    assert (entry['start'], entry['end']) == (str(time.min()), str(time.max()))
+
+    # Range queries find the rows on both sides of the set-back
+    data = archive.read_scan('I', 'S', start=time[80], end=time[85])
+    assert sorted(data['101']) == [80., 81., 82., 83., 84., 110., 111., 112., 113., 114.]
+
+
+def test_overview_after_clock_set_back(tmp_path):
+    archive = ScanArchive(tmp_path / 'archive')
+    time = _set_back(300, 100, 200)
+    archive.append('I', 'S', _scan_data(time[:300]))
+    assert archive.manifest('I', 'S')['pyramid'].get('dir', 'pyramid') == 'pyramid'
+
+    # The new rows fall in closed bins: the levels are rebuilt in a new
+    # directory and the old one is removed
+    archive.append('I', 'S', _scan_data(time))
+    state = archive.manifest('I', 'S')['pyramid']
+    assert state['dir'] == 'pyramid.1'
+    directory = archive._dir('I', 'S')
+    assert (directory / 'pyramid.1').is_dir() and not (directory / 'pyramid').exists()
+
+    ov = archive.overview_scan('I', 'S', ['101'], points=1)
+    assert ov.level == 60
+    assert list(ov.count['101']) == [60, 80, 120, 80, 60]
+    assert ov.max['101'].max() == 399.
+
+    # Sorted rows after the open bin are added to the rebuilt levels
+    later = time[299]+np.arange(1, 11)*np.timedelta64(1, 's')
+    archive.append('I', 'S', _scan_data(np.concatenate([time, later])))
+    assert archive.manifest('I', 'S')['pyramid']['dir'] == 'pyramid.1'
+    ov = archive.overview_scan('I', 'S', ['101'], points=1)
+    assert ov.count['101'].sum() == 410
+    assert np.array_equal(ov.time, np.sort(ov.time))
+
+
+def test_small_appends_merge_chunks(tmp_path, monkeypatch):
+    monkeypatch.setattr(pyfluke1586A_archive, 'ArchiveChunkRows', 10)
+    archive = ScanArchive(tmp_path / 'archive')
+    time = np.datetime64('2020-01-01', 'ms')+np.arange(25)*np.timedelta64(1, 's')
+    for stop in [3, 6, 9, 12, 15, 25]:
+        archive.append('I', 'S', _scan_data(time[:stop], np.arange(1, stop+1)))
+    chunks = archive.manifest('I', 'S')['chunks']
+    assert [c['rows'] for c in chunks] == [10, 10, 5]
+    assert chunks[-1]['start'] == str(time[20]) and chunks[-1]['end'] == str(time[24])
+    # The merged chunks are removed
+    ids = sorted(int(p.stem) for p in (archive._dir('I', 'S') / '101').glob('*.zz'))
+    assert ids == [c['id'] for c in chunks]
+    assert [c[0] for c in archive.index('I')['scans']['S']['chunks']] == ids
+
+    data = archive.read_scan('I', 'S')
+    assert np.array_equal(data.time, time)
+    assert np.array_equal(data.scan, np.arange(1, 26))
+    assert np.array_equal(data['101'], np.arange(25.))
+
+
+def test_append_download_parses_new_rows(sim, fluke, tmp_path, monkeypatch):
+    archive = ScanArchive(tmp_path / 'archive')
+    fluke.download_data('SIM_0001', incremental=True, archive=archive)
+    assert archive.manifest(fluke.instrument_id(), 'SIM_0001')['download']['rows'] == 19
+
+    parsed = []
+    parse_scan_data = pyfluke1586A_data.parse_scan_data
+
+    def counting_parse(payload, conf=None):
+        data = parse_scan_data(payload, conf)
+        parsed.append(len(data))
+        return data
+
+    monkeypatch.setattr(pyfluke1586A_data, 'parse_scan_data', counting_parse)
+    sim.add_rows('SIM_0001', 5)
+    fluke.download_data('SIM_0001', incremental=True, archive=archive)
+    # The last archived row and the new ones
+    assert parsed == [6]
+    data = archive.read_scan(fluke.instrument_id(), 'SIM_0001')
+    assert np.array_equal(data.scan, np.arange(1, 26))
+    assert np.array_equal(data['101'], load_scan(fluke.download_dir / 'SIM_0001', cache=False)['101'])
+
+
+def test_read_across_scan_files(tmp_path, monkeypatch):
+    archive = ScanArchive(tmp_path / 'archive')
+    t0 = np.datetime64('2020-01-01', 'ms')
+    time_a = t0+np.arange(10)*np.timedelta64(10, 's')
+    time_b = t0+np.arange(10)*np.timedelta64(10, 's')+np.timedelta64(5, 's')
+    archive.append('I', 'A', ScanData(time_a, {'101': np.arange(10.), '102': np.arange(10.)+100},
+                                      units={'101': 'C', '102': 'V'}))
+    # B lacks channel 102 and overlaps A in time
+    archive.append('I', 'B', ScanData(time_b, {'101': np.arange(10.)+10}, units={'101': 'C'}))
+    archive.append('I', 'C', ScanData(t0+np.timedelta64(1, 'D')+np.arange(3)*np.timedelta64(1, 's'),
+                                      {'101': np.zeros(3)}))
+
+    opened = []
+    read_scan = archive.read_scan
+    monkeypatch.setattr(archive, 'read_scan', lambda inst, name, *args: opened.append(name) or read_scan(inst, name, *args))
+    data = archive.read('I', ['101', '102'], time_a[2], time_a[5])
+    # C is outside the range and not opened
+    assert opened == ['A', 'B']
+    assert list(data.time) == [time_a[2], time_b[2], time_a[3], time_b[3], time_a[4], time_b[4]]
+    assert list(data['101']) == [2., 12., 3., 13., 4., 14.]
+    assert np.array_equal(data['102'], [102., np.nan, 103., np.nan, 104., np.nan], equal_nan=True)
+    assert data.units == {'101': 'C', '102': 'V'}
+
+    # All channels of all scan files by default
+    data = archive.read('I')
+    assert data.channels == ['101', '102'] and len(data) == 23
+    assert np.all(np.diff(data.time) >= np.timedelta64(0, 'ms'))
+    assert np.isnan(data['102'][-3:]).all()
+    assert len(archive.read('I', ['101'], t0+np.timedelta64(2, 'D'))) == 0
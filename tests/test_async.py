@@ -0,0 +1,70 @@
+"""AsyncFluke1586A against the simulator."""
+
+import time
+import asyncio
+import datetime as dt
+
+from pyfluke1586A_async import AsyncFluke1586A
+
+
+def _run(sim, coroutine, download_dir='./downloads'):
+    """Run coroutine(fluke) on a fluke connected to sim; return its result."""
+    async def main():
+        async with AsyncFluke1586A(sim.serve_tcp(), nickname='sim', timeout=5., download_dir=download_dir) as fluke:
+            return await coroutine(fluke)
+    return asyncio.run(main())
+
+
+def test_queries(sim):
+    async def queries(fluke):
+        return [(await fluke.get_identification())[0], (await fluke.get_version())[0]]
+    assert _run(sim, queries) == [sim.idn.encode(), b'1994.0']
+
+
+def test_setters_do_not_wait(sim):
+    async def setters(fluke):
+        tstart = time.time()
+        replies = [await fluke.set_date(), await fluke.set_time(),
+                   await fluke.initiate_scan(), await fluke.abort_scan()]
+        return replies, time.time()-tstart
+    replies, elapsed = _run(sim, setters)
+    # Without a reply to wait for, each setter would take the 5 s timeout
+    assert elapsed < 1.
+    assert [resp for resp, cmd in replies] == [None]*4
+
+
+def test_sync_datetime(sim):
+    sim.offset = dt.timedelta(seconds=30)
+
+    async def sync(fluke):
+        offset = await fluke.get_offset()
+        assert isinstance(offset, dt.timedelta)
+        return await fluke.sync_datetime()
+    before, after = _run(sim, sync)
+    assert abs(before.total_seconds()-30) <= 1.1
+    assert abs(after.total_seconds()) <= 1.1
+    # Date and time are set in one write
+    setters = [cmd for cmd in sim.commands if not cmd.endswith('?')]
+    assert len(setters) == 1 and setters[0].startswith('SYST:DATE ') and ';:SYST:TIME ' in setters[0]
+
+
+def _expected(sim, name):
+    return sim.data(name).decode().replace('\r\r', '\n')
+
+
+def test_download(sim, tmp_path):
+    async def download(fluke):
+        await fluke.download_data('SIM_0001', size=len(sim.data('SIM_0001')))
+        await fluke.download_data('SIM_0002')
+    _run(sim, download, tmp_path)
+    for name in ['SIM_0001', 'SIM_0002']:
+        assert (tmp_path / name / '{0}_data.csv'.format(name)).read_text() == _expected(sim, name)
+    assert (tmp_path / 'SIM_0001' / 'SIM_0001_conf.csv').read_text() == sim.conf('SIM_0001').decode().replace('\r\r', '\n')
+
+
+def test_download_longer_than_size(sim, tmp_path):
+    # The file grew after its size was read: the reply is not truncated
+    async def download(fluke):
+        await fluke.download_data('SIM_0001', size=len(sim.data('SIM_0001'))-200)
+    _run(sim, download, tmp_path)
+    assert (tmp_path / 'SIM_0001' / 'SIM_0001_data.csv').read_text() == _expected(sim, 'SIM_0001')
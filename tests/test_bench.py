@@ -0,0 +1,19 @@
+"""Benchmark suite, run briefly against the simulator."""
+
+from pyfluke1586A_bench import run_benchmarks, format_results, BenchCommands
+from pyfluke1586A_sim import Fluke1586ASimulator
+
+
+def test_run_benchmarks():
+    sim = Fluke1586ASimulator(files=2, rows=2000)
+    try:
+        results = run_benchmarks(sim.serve_tcp(), repeat=3)
+    finally:
+        sim.close()
+    assert sorted(results['latency']) == sorted(BenchCommands+['get_offset'])
+    assert results['catalog']['files'] == 2
+    assert results['download']['bytes'] > 0
+    # CPU use of the driver thread only: at most one core
+    assert 0. <= results['download']['cpu'] <= 1.1
+    assert results['parse']['rows'] == 2000
+    assert 'Download:' in format_results(results)
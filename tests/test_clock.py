@@ -0,0 +1,121 @@
+"""Clock offsets: get_internet_time_offset and ClockMonitor, against the
+simulated instrument and NTP server."""
+
+import time
+import datetime as dt
+import threading
+
+import pytest
+
+from pyfluke1586A import ClockMonitor, DriftMinSpanSecs, get_internet_time_offset
+
+
+def _wait_for(condition, timeout=5.):
+    deadline = time.time()+timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def _probes(sim):
+    """Number of instrument clock probes (date and time queries) received."""
+    return sum('SYST:TIME?' in cmd for cmd in sim.commands)
+
+
+@pytest.fixture
+def monitor(fluke, ntp):
+    monitor = ClockMonitor(fluke, interval=0.02, pc_ttl=3600., instrument_ttl=3600., samples=1,
+                           ntp_server=ntp.address[0], ntp_port=ntp.address[1])
+    yield monitor
+    monitor.stop()
+
+
+def test_internet_time_offset(ntp):
+    assert get_internet_time_offset(*ntp.address) == pytest.approx(2.5, abs=0.05)
+    assert ntp.requests == 1
+
+
+def test_monitor_caches_samples(sim, ntp, monitor):
+    monitor.start()
+    assert _wait_for(lambda: monitor.pc is not None and monitor.instrument is not None)
+    pc, instrument = monitor.pc, monitor.instrument
+    assert pc.offset == pytest.approx(2.5, abs=0.05)
+    assert abs(instrument.offset) <= 1.1      # the instrument reports whole seconds
+
+    # Within the TTLs, readers get the cached samples and nothing is probed
+    probes = _probes(sim)
+    time.sleep(0.2)
+    assert monitor.pc is pc and monitor.instrument is instrument
+    assert ntp.requests == 1 and _probes(sim) == probes
+
+    # refresh() expires the cached samples
+    ntp.offset = -1.
+    monitor.refresh(pc=True)
+    assert _wait_for(lambda: monitor.pc is not pc and monitor.pc is not None)
+    assert _wait_for(lambda: monitor.instrument is not None and monitor.instrument is not instrument)
+    assert monitor.pc.offset == pytest.approx(-1., abs=0.05)
+    assert ntp.requests == 2
+
+
+def test_monitor_samples_again_after_ttl(sim, ntp, monitor):
+    monitor.pc_ttl = monitor.instrument_ttl = 0.1
+    monitor.start()
+    assert _wait_for(lambda: ntp.requests >= 3 and len(monitor.history) >= 3)
+
+
+def test_monitor_skips_busy_port(sim, fluke, monitor):
+    # Another thread (e.g. a download) holds the port
+    locked, release = threading.Event(), threading.Event()
+
+    def hold():
+        with fluke.lock:
+            locked.set()
+            release.wait()
+
+    holder = threading.Thread(target=hold)
+    holder.start()
+    locked.wait()
+    try:
+        monitor.start()
+        assert _wait_for(lambda: monitor.pc is not None)
+        time.sleep(0.2)
+        assert monitor.instrument is None and monitor.instrument_error is None
+        assert _probes(sim) == 0
+    finally:
+        release.set()
+        holder.join()
+    assert _wait_for(lambda: monitor.instrument is not None)
+
+
+def test_drift_rate(fluke):
+    monitor = ClockMonitor(fluke)
+    assert monitor.drift_rate() is None
+    t0 = time.time()
+    # 0.5 s/day, sampled every hour
+    monitor.history.extend((t0+3600*id, 0.5*id/24) for id in range(10))
+    assert monitor.drift_rate() == pytest.approx(0.5)
+
+    # Too short a span for an estimate
+    monitor.history.clear()
+    monitor.history.extend((t0+id, 0.) for id in range(DriftMinSpanSecs//2))
+    assert monitor.drift_rate() is None
+
+
+def test_sync_if_needed(sim, monitor):
+    sim.offset = dt.timedelta(seconds=30)
+    monitor.start()
+    assert _wait_for(lambda: monitor.instrument is not None)
+    assert monitor.instrument.offset == pytest.approx(30, abs=1.1)
+    assert monitor.sync_if_needed()
+    assert abs(sim.offset.total_seconds()) <= 1.1
+    assert len(monitor.history) <= 1     # cleared by the sync, then sampled again
+
+    assert _wait_for(lambda: monitor.instrument is not None and abs(monitor.instrument.offset) <= 1.1)
+    assert not monitor.sync_if_needed(threshold=2.)
+
+
+def test_sync_if_needed_without_sample(fluke):
+    assert not ClockMonitor(fluke).sync_if_needed()
+    assert not ClockMonitor().sync_if_needed()
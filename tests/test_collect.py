@@ -0,0 +1,49 @@
+"""Scheduled collector against the simulator."""
+
+import json
+
+import pytest
+
+from pyfluke1586A import Fluke1586A
+from pyfluke1586A_collect import Collector, main, parse_interval
+
+
+def test_parse_interval():
+    assert [parse_interval(text) for text in ['90', '30s', '10m', '2h', '1d', 0]] == [90, 30, 600, 7200, 86400, 0]
+
+
+def test_all_intervals_zero(capsys):
+    with pytest.raises(SystemExit) as e:
+        main(['--config', 'fleet.toml', '--every', '0', '--sync-every', '0', '--health-every', '0'])
+    assert e.value.code == 2
+    assert 'nothing to run' in capsys.readouterr().err
+    with pytest.raises(ValueError):
+        Collector([], intervals={'download': 0, 'sync': 0, 'health': 0}).run()
+
+
+def test_collector(sim, tmp_path):
+    url = sim.serve_tcp()
+    collector = Collector([{'nickname': 'sim', 'port': url, 'latency': 0.002}], download_dir=tmp_path,
+                          intervals={'download': 600, 'sync': 0, 'health': 60})
+    try:
+        result = collector.run_task('health')['sim']
+        assert result['ok'] and result['value']['idn'] == sim.idn
+        # The port is opened through the shared sessions
+        fluke = collector.sessions['sim']
+        assert Fluke1586A.session(url) is fluke
+
+        result = collector.run_task('download')['sim']
+        assert result['ok'] and result['value'] == ['SIM_0001', 'SIM_0002']
+        assert (tmp_path / 'sim' / 'SIM_0001' / 'SIM_0001_data.csv').exists()
+        assert collector.sessions['sim'] is fluke
+
+        status = json.loads((tmp_path / 'collector_status.json').read_text())
+        assert status['sim']['health']['ok'] and status['sim']['download']['ok']
+
+        # A dropped session is reopened at the next task
+        collector._drop_session('sim')
+        assert not fluke.serial.is_open
+        assert collector.run_task('health')['sim']['ok']
+        assert collector.sessions['sim'] is not fluke
+    finally:
+        collector.close()
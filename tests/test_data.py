@@ -0,0 +1,112 @@
+"""Parsing, caching and memory mapping of downloaded scan files."""
+
+import numpy as np
+
+from pyfluke1586A_data import (ScanData, NpzAlignment, load_scan, load_scan_rows, map_scan, parse_scan_data,
+                               _npz_layout, _npz_aligned)
+
+
+def _download(sim, fluke, name='SIM_0001'):
+    fluke.download_data(name)
+    return fluke.download_dir / name
+
+
+def test_load_scan(sim, fluke):
+    directory = _download(sim, fluke)
+    scan = load_scan(directory)
+    assert len(scan) == 20
+    assert scan.channels == sim.channels
+    assert list(scan.scan) == list(range(1, 21))
+    assert scan.time[1]-scan.time[0] == np.timedelta64(10, 's')
+    assert scan.units['101'] == 'C'
+    assert scan['101'][0] == 20.007
+    # The cache is used the next time
+    assert (directory / 'SIM_0001_data.npz').exists()
+    cached = load_scan(directory)
+    assert np.array_equal(cached.time, scan.time) and np.array_equal(cached['104'], scan['104'])
+
+
+def test_save_npz_aligned(sim, fluke, tmp_path):
+    scan = parse_scan_data(sim.data('SIM_0001'))
+    p = tmp_path / 'scan.npz'
+    scan.save_npz(p)
+    layout = _npz_layout(p)
+    assert sorted(layout) == sorted(['time', 'meta', 'scan']+['ch{0:d}'.format(id) for id in range(4)])
+    loaded = np.load(p)
+    raw = p.read_bytes()
+    for name, (offset, shape, fortran_order, dtype) in layout.items():
+        assert offset % NpzAlignment == 0
+        # The offsets found from the headers point at the data
+        nbytes = int(np.prod(shape))*dtype.itemsize
+        assert raw[offset:offset+nbytes] == loaded[name].tobytes()
+    loaded.close()
+
+    mapped = ScanData.map_npz(p)
+    assert isinstance(mapped.time, np.memmap) and mapped.time.flags.aligned
+    assert np.array_equal(mapped.time, scan.time) and np.array_equal(mapped.scan, scan.scan)
+    for ch in scan.channels:
+        assert np.array_equal(mapped[ch], scan[ch])
+    assert mapped.units == scan.units
+
+
+def test_map_scan_rewrites_unaligned_cache(sim, fluke, monkeypatch):
+    directory = _download(sim, fluke)
+    scan = parse_scan_data((directory / 'SIM_0001_data.csv').read_text())
+    p_npz = directory / 'SIM_0001_data.npz'
+    # A cache written by np.savez, newer than the csv files
+    arrays = {'time': scan.time, 'scan': scan.scan,
+              'meta': np.array('{"channels": ["101"], "names": {"101": "101"}, "units": {"101": ""}}'),
+              'ch0': scan['101']}
+    np.savez(p_npz, **arrays)
+    assert not _npz_aligned(p_npz)
+
+    # The cache is rewritten before it is mapped
+    map_npz = ScanData.map_npz.__func__
+    mapped_aligned = []
+
+    def checked_map_npz(cls, p):
+        mapped_aligned.append(_npz_aligned(p))
+        return map_npz(cls, p)
+    monkeypatch.setattr(ScanData, 'map_npz', classmethod(checked_map_npz))
+
+    mapped = map_scan(directory)
+    assert mapped_aligned == [True]
+    assert _npz_aligned(p_npz)
+    assert np.array_equal(mapped.time, scan.time) and np.array_equal(mapped['101'], scan['101'])
+
+
+def test_rows_and_between(sim, fluke):
+    scan = map_scan(_download(sim, fluke))
+    part = scan.rows(5, 10)
+    assert len(part) == 5 and list(part.scan) == [6, 7, 8, 9, 10]
+    assert np.shares_memory(part['101'], scan['101'])
+
+    start = np.datetime64('2020-01-01T00:01:00', 'ms')
+    part = scan.between(start, start+np.timedelta64(30, 's'))
+    assert list(part.time) == [start+np.timedelta64(10*id, 's') for id in range(3)]
+    assert list(part.scan) == [7, 8, 9]
+    assert len(scan.between(end=scan.time[0])) == 0
+    assert len(scan.between(start=scan.time[-1])) == 1
+    assert len(scan.between()) == len(scan)
+
+
+def test_load_scan_rows(sim, tmp_path):
+    directory = tmp_path / 'SIM_0001'
+    directory.mkdir()
+    p = directory / 'SIM_0001_data.csv'
+    lines = sim.data('SIM_0001').decode().replace('\r\r', '\n').splitlines(keepends=True)
+    p.write_text(''.join(lines[:11]))
+    data, first_row, mark = load_scan_rows(directory)
+    assert (len(data), first_row, mark['rows']) == (10, 0, 9)
+
+    # Only the rows from the last line of the previous call on are parsed
+    p.write_text(''.join(lines))
+    data, first_row, mark = load_scan_rows(directory, mark=mark)
+    assert (len(data), first_row, mark['rows']) == (11, 9, 19)
+    assert list(data.scan) == list(range(10, 21))
+    assert load_scan_rows(directory, mark=mark)[1:] == (19, mark)
+
+    # A file that does not continue at the mark is loaded from the start
+    p.write_text(''.join(lines[:1]+lines[5:]))
+    data, first_row, _ = load_scan_rows(directory, mark=mark)
+    assert (len(data), first_row) == (16, 0)
@@ -0,0 +1,151 @@
+"""Fluke1586AFleet against several simulators."""
+
+import time
+import socket
+import datetime as dt
+
+import pytest
+
+from pyfluke1586A_fleet import Fluke1586AFleet, scheduling_jitter, format_summary
+from pyfluke1586A_sim import Fluke1586ASimulator
+
+
+@pytest.fixture
+def sims():
+    """Three simulators replying after 0, 10 and 30 ms."""
+    sims = [Fluke1586ASimulator(files=1, rows=10, latency=latency, idn='FLUKE,1586A,SIM{0:d},1.00'.format(id))
+            for id, latency in enumerate([0., 0.01, 0.03])]
+    yield sims
+    for sim in sims:
+        sim.close()
+
+
+@pytest.fixture
+def fleet(sims, tmp_path):
+    fleet = Fluke1586AFleet([{'nickname': 'sim{0:d}'.format(id), 'port': sim.serve_tcp()} for id, sim in enumerate(sims)],
+                            download_dir=tmp_path)
+    fleet.open()
+    yield fleet
+    fleet.close()
+
+
+def test_coordinated_start(sims, fleet):
+    results = fleet.coordinated_start()
+    assert [res.nickname for res in results] == ['sim0', 'sim1', 'sim2']
+    assert all(res.ok for res in results)
+    fire = {res.value['fire'] for res in results}
+    assert len(fire) == 1
+    # On TCP the delay is not taken from the round trip, which includes
+    # the reply latency of the instrument
+    assert [res.value['delay'] for res in results] == [0., 0., 0.]
+    assert results[2].value['rtt'] >= 0.03
+    # The scans started at the same moment
+    started = [sim.scan_started for sim in sims]
+    assert max(started)-min(started) < 0.01
+    assert abs(min(started)-dt.datetime.fromisoformat(fire.pop()).timestamp()) < 0.01
+    assert 0. <= scheduling_jitter(results) < 0.01
+
+    results = fleet.coordinated_abort()
+    assert all(res.ok for res in results)
+    assert [sim.scan_started for sim in sims] == [None]*3
+
+
+def test_coordinated_latency(sims, tmp_path):
+    fleet = Fluke1586AFleet([{'nickname': 'sim0', 'port': sims[0].serve_tcp(), 'latency': 0.02},
+                             {'nickname': 'sim1', 'port': sims[1].serve_tcp()}], download_dir=tmp_path)
+    fleet.open()
+    try:
+        results = fleet.coordinated_start()
+    finally:
+        fleet.close()
+    assert all(res.ok for res in results)
+    assert [res.value['delay'] for res in results] == [0.02, 0.]
+    # sim0 was sent its command 20 ms early
+    assert 0.01 < sims[1].scan_started-sims[0].scan_started < 0.03
+
+
+def test_coordinated_failed_prepare(sims, fleet, monkeypatch):
+    # One instrument fails while being prepared: the others are not held
+    # up at the barrier and still fire together
+    def no_reply(samples=1):
+        raise ValueError('no reply')
+    monkeypatch.setattr(fleet.flukes['sim1'], 'probe_offset', no_reply)
+    tstart = time.time()
+    results = fleet.coordinated_start()
+    assert time.time()-tstart < 5.
+    assert [res.ok for res in results] == [True, False, True]
+    assert sims[1].scan_started is None
+    assert abs(sims[0].scan_started-sims[2].scan_started) < 0.01
+    assert 'FAILED' in format_summary('Coordinated scan start', results)
+
+
+def test_coordinated_sync(sims, fleet):
+    for id, sim in enumerate(sims):
+        sim.offset = dt.timedelta(seconds=10*(id+1))
+    results = fleet.coordinated_sync()
+    assert all(res.ok for res in results)
+    for sim, res in zip(sims, results):
+        assert abs(sim.offset.total_seconds()) < 1.1
+        assert abs(res.value['offset']) < 1.1
+        assert dt.datetime.fromisoformat(res.value['fire']).microsecond == 0
+
+
+def _dead_port():
+    """URL of a TCP port nothing listens on."""
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return 'socket://127.0.0.1:{0:d}'.format(s.getsockname()[1])
+
+
+def test_map_keeps_order(tmp_path):
+    fleet = Fluke1586AFleet([], download_dir=tmp_path)
+
+    def func(nickname, delay):
+        # The first items finish last
+        time.sleep(delay)
+        if nickname == 'c':
+            raise ValueError('failed')
+        return nickname.upper()
+
+    items = [(nickname, 'port', 0.1-0.02*id) for id, nickname in enumerate('abcde')]
+    results = fleet._map(func, items)
+    assert [res.nickname for res in results] == list('abcde')
+    assert [res.value for res in results] == ['A', 'B', None, 'D', 'E']
+    assert [res.ok for res in results] == [True, True, False, True, True]
+    assert isinstance(results[2].error, ValueError)
+    assert fleet._map(func, []) == []
+
+
+def test_dead_port(sims, tmp_path):
+    # A port that cannot be opened does not stop the others
+    fleet = Fluke1586AFleet([{'nickname': 'sim0', 'port': sims[0].serve_tcp()},
+                             {'nickname': 'dead', 'port': _dead_port()},
+                             {'nickname': 'sim2', 'port': sims[2].serve_tcp()}], download_dir=tmp_path)
+    with fleet:
+        results = fleet.open()
+        assert [res.nickname for res in results] == ['sim0', 'dead', 'sim2']
+        assert [res.ok for res in results] == [True, False, True]
+        assert list(fleet.flukes) == ['sim0', 'sim2']
+
+        results = fleet.identify()
+        assert [res.nickname for res in results] == ['sim0', 'sim2']
+        assert [res.value for res in results] == [sims[0].idn, sims[2].idn]
+        summary = format_summary('Identification', results)
+        assert summary.splitlines()[-1].startswith('2 instruments, 0 failed')
+
+
+def test_run(sims, fleet, tmp_path):
+    results = fleet.run('get_scan_file_info', 'SIM_0001')
+    assert [res.nickname for res in results] == ['sim0', 'sim1', 'sim2']
+    assert all(res.ok and res.value['name'] == 'SIM_0001' for res in results)
+
+    results = fleet.download_all()
+    assert all(res.ok for res in results)
+    # Each instrument downloads to its own directory
+    for nickname in fleet.flukes:
+        assert (tmp_path / nickname / 'SIM_0001' / 'SIM_0001_data.csv').exists()
+
+    results = fleet.run(lambda fluke, name: fluke.get_scan_file_info(name), 'NO_SUCH_FILE')
+    summary = format_summary('Scan file info', results)
+    assert [line.split()[2] for line in summary.splitlines()[2:5]] == ['FAILED']*3
+    assert summary.splitlines()[-1].startswith('3 instruments, 3 failed')
@@ -0,0 +1,71 @@
+"""Live acquisition: parse_readings and LiveStream against the simulator."""
+
+import time
+
+import numpy as np
+
+from pyfluke1586A import ClockMonitor
+from pyfluke1586A_live import LiveStream, RingBuffer, parse_readings
+
+
+def test_parse_readings():
+    readings = parse_readings(b'5,2020-01-01 00:00:00.000,20.5\r\r6,2020-01-01 00:00:01.000,20.6\r\r', 1)
+    # The reading number is the index, not a value
+    assert [r.index for r in readings] == [5, 6]
+    assert [list(r.values) for r in readings] == [[20.5], [20.6]]
+    assert readings[1].time == np.datetime64('2020-01-01T00:00:01', 'ms')
+
+    readings = parse_readings(b'2020-01-01 00:00:00.000,20.5\r\r2020-01-01 00:00:01.000,20.6\r\r', 7)
+    assert [r.index for r in readings] == [7, 8]
+    assert parse_readings(b'', 1) == []
+
+
+def test_ring_buffer():
+    buffer = RingBuffer(2, overwrite=True)
+    for id in range(3):
+        assert buffer.put(id)
+    assert [buffer.get(), buffer.get()] == [1, 2]
+    buffer = RingBuffer(1)
+    assert buffer.put(0) and not buffer.put(1, timeout=0.01)
+    buffer.close()
+    assert buffer.get() == 0 and buffer.get() is None
+
+
+def test_live_stream(sim, fluke):
+    sim.scan_interval = 0.02
+    fluke.initiate_scan()
+    readings = []
+    with LiveStream(fluke, 1, poll_interval=0.02) as stream:
+        for reading in stream:
+            readings.append(reading)
+            if len(readings) == 10:
+                break
+    fluke.abort_scan()
+    assert stream.error is None
+    assert [r.index for r in readings] == list(range(1, 11))
+    assert [list(r.values) for r in readings] == [[20.+id/100.] for id in range(1, 11)]
+    assert stream.next_index >= 11
+
+
+def test_live_stream_shares_port_with_clock_monitor(sim, fluke, ntp):
+    sim.scan_interval = 0.01
+    fluke.initiate_scan()
+    monitor = ClockMonitor(fluke, interval=0.01, instrument_ttl=0., samples=1,
+                           ntp_server=ntp.address[0], ntp_port=ntp.address[1])
+    readings = []
+    monitor.start()
+    try:
+        with LiveStream(fluke, 1, poll_interval=0.01) as stream:
+            tstart = time.time()
+            for reading in stream:
+                readings.append(reading)
+                assert monitor.instrument_error is None
+                if time.time()-tstart > 2.:
+                    break
+    finally:
+        monitor.stop()
+    fluke.abort_scan()
+    assert stream.error is None and monitor.instrument_error is None
+    assert [r.index for r in readings] == list(range(1, len(readings)+1))
+    assert len(readings) > 20
+    assert len(monitor.history) > 5
@@ -0,0 +1,54 @@
+"""Per-command metrics of the serial traffic."""
+
+import csv
+import json
+
+from pyfluke1586A import Fluke1586AMetrics, _command_key
+
+
+def test_command_key():
+    assert _command_key('MEM:LOG:READ? "SIM_0001",20') == ('MEM:LOG:READ?', 1)
+    assert _command_key('MEM:LOG:PROP? "A";:MEM:LOG:PROP? "B";:MEM:LOG:PROP? "C"') == ('batch MEM:LOG:PROP?', 3)
+    assert _command_key('SYST:DATE?;:SYST:TIME?;:SYST:DATE?') == ('batch SYST:DATE?;:SYST:TIME?', 3)
+
+
+def test_record():
+    metrics = Fluke1586AMetrics()
+    metrics.record('SYST:DATE?', write=0.0005, first_byte=0.003, last_byte=0.004, bytes_out=11, bytes_in=11)
+    metrics.record('SYST:DATE?', write=0.0005, bytes_out=11, bytes_in=0, timeout=True)
+    entry = metrics.to_dict()['commands']['SYST:DATE?']
+    assert (entry['count'], entry['commands'], entry['bytes_out'], entry['bytes_in']) == (2, 2, 22, 11)
+    assert (entry['timeouts'], entry['truncated']) == (1, 0)
+    assert entry['write']['count'] == 2 and entry['write']['mean'] == 0.0005
+    assert entry['first_byte']['count'] == 1 and entry['first_byte']['min'] == entry['first_byte']['max'] == 0.003
+    histogram = entry['last_byte']['histogram']
+    assert sum(histogram) == 1 and histogram[Fluke1586AMetrics.LatencyBins.index(0.005)] == 1
+
+
+def test_driver_metrics(fluke):
+    metrics = fluke.enable_metrics()
+    fluke.send_message('SYST:VERS?')
+    fluke.send_message('SYST:VERS?')
+    for size in [2, 3, 5]:
+        fluke.send_batch(['SYST:DATE?']*size)
+    commands = metrics.to_dict()['commands']
+    assert set(commands) == {'SYST:VERS?', 'batch SYST:DATE?'}
+    assert commands['SYST:VERS?']['count'] == 2
+    assert commands['SYST:VERS?']['bytes_in'] == 2*len(b'1994.0\r')
+    batch = commands['batch SYST:DATE?']
+    assert (batch['count'], batch['commands'], batch['timeouts']) == (3, 10, 0)
+    assert batch['last_byte']['count'] == 3
+
+
+def test_export(fluke, tmp_path):
+    metrics = fluke.enable_metrics()
+    fluke.send_message('SYST:VERS?')
+    fluke.send_batch(['SYST:DATE?', 'SYST:TIME?'])
+    data = json.loads(metrics.to_json(tmp_path / 'metrics.json'))
+    assert data == json.loads((tmp_path / 'metrics.json').read_text())
+    assert set(data['commands']) == {'SYST:VERS?', 'batch SYST:DATE?;:SYST:TIME?'}
+    metrics.to_csv(tmp_path / 'metrics.csv')
+    with (tmp_path / 'metrics.csv').open() as fh:
+        rows = list(csv.DictReader(fh))
+    assert [row['command'] for row in rows] == ['SYST:VERS?', 'batch SYST:DATE?;:SYST:TIME?']
+    assert [row['commands'] for row in rows] == ['1', '2']
@@ -0,0 +1,105 @@
+"""Batch post-processing of downloaded scan files (pyfluke1586A_process.py)."""
+
+import os
+import csv
+import json
+
+import numpy as np
+
+from pyfluke1586A_data import ScanData
+from pyfluke1586A_process import process_all, process_scan, convert_units, resample
+
+Header = 'Scan,Time,CH101 (F),CH102 (mV),CH103 (C)\n'
+
+
+def _write_scan(root, name, rows=6):
+    directory = root / name
+    directory.mkdir(parents=True)
+    time = np.datetime64('2020-01-01', 's')+np.arange(rows)*np.timedelta64(10, 's')
+    lines = ['{0:d},{1}.000,{2:.1f},{3:.1f},{4:.1f}\n'.format(id+1, str(time[id]).replace('T', ' '), 32.+18.*id, 100.*id, id)
+             for id in range(rows)]
+    (directory / '{0}_data.csv'.format(name)).write_text(Header+''.join(lines))
+    return directory
+
+
+def test_convert_units():
+    scan = ScanData(np.zeros(2, dtype='datetime64[ms]'),
+                    {'101': np.array([32., 212.]), '102': np.array([1., 2.]), '103': np.array([273.15, 0.])},
+                    units={'101': 'F', '102': 'mV', '103': 'K'})
+    convert_units(scan)
+    assert scan.units == {'101': 'C', '102': 'V', '103': 'C'}
+    assert np.allclose(scan['101'], [0., 100.])
+    assert np.allclose(scan['102'], [1e-3, 2e-3])
+    assert np.allclose(scan['103'], [0., -273.15])
+    assert convert_units(scan, convert=False).units['101'] == 'C'
+
+
+def test_resample():
+    time = np.datetime64('2020-01-01T00:00:50', 'ms')+np.arange(4)*np.timedelta64(10, 's')
+    scan = ScanData(time, {'101': np.array([1., 2., np.nan, 4.])})
+    binned = resample(scan, 30)
+    # Bins are aligned to whole multiples of the interval
+    assert list(binned.time) == list(np.array(['2020-01-01T00:00:30', '2020-01-01T00:01:00'], dtype='datetime64[ms]'))
+    assert list(binned['101']) == [1., 3.]
+
+
+def test_process_scan(tmp_path):
+    directory = _write_scan(tmp_path, 'SCAN1')
+    result = process_scan(directory, resample_interval=30)
+    assert result.status == 'done'
+    assert result.stats['101'] == {'name': '101', 'unit': 'C', 'count': 6, 'min': 0., 'max': 50., 'mean': 25.}
+    assert result.stats['102']['unit'] == 'V' and result.stats['102']['max'] == 0.5
+    assert result.stats['103']['unit'] == 'C' and result.stats['103']['max'] == 5.
+    summary = json.loads((directory / 'SCAN1_stats.json').read_text())
+    assert summary['rows'] == 6 and summary['settings'] == {'resample': 30, 'convert': True}
+    assert (directory / 'SCAN1_30s.npz').exists()
+
+
+def test_skip_if_up_to_date(tmp_path):
+    directory = _write_scan(tmp_path, 'SCAN1')
+    assert process_scan(directory).status == 'done'
+    result = process_scan(directory)
+    assert result.status == 'skipped'
+    assert result.stats['101']['unit'] == 'C'
+    assert process_scan(directory, force=True).status == 'done'
+
+    # Outputs older than the csv file are made again
+    p_stats = directory / 'SCAN1_stats.json'
+    os.utime(p_stats, (p_stats.stat().st_atime, p_stats.stat().st_mtime-10))
+    assert process_scan(directory).status == 'done'
+    assert process_scan(directory).status == 'skipped'
+
+
+def test_settings_change_invalidates(tmp_path):
+    directory = _write_scan(tmp_path, 'SCAN1')
+    assert process_scan(directory).status == 'done'
+    result = process_scan(directory, convert=False)
+    assert result.status == 'done'
+    assert result.stats['101']['unit'] == 'F' and result.stats['101']['max'] == 122.
+    assert process_scan(directory, convert=False).status == 'skipped'
+    # A resampled output is missing for the new interval
+    assert process_scan(directory, resample_interval=60, convert=False).status == 'done'
+    assert process_scan(directory, resample_interval=60, convert=False).status == 'skipped'
+    assert process_scan(directory, resample_interval=30, convert=False).status == 'done'
+
+
+def test_process_all_order(tmp_path):
+    # Created in reverse order, with more rows in the first files so they
+    # finish last
+    names = ['SCAN{0:d}'.format(id) for id in range(6)]
+    for id, name in reversed(list(enumerate(names))):
+        _write_scan(tmp_path / 'downloads', name, rows=2000*(6-id))
+    (tmp_path / 'downloads' / 'SCAN3' / 'SCAN3_data.csv').write_text(Header+'1,not a time,1,2,3\n')
+
+    results = process_all(tmp_path / 'downloads', workers=3)
+    assert [res.name for res in results] == names
+    assert [res.status for res in results] == ['done']*3+['failed']+['done']*2
+    assert results[3].error.startswith('ValueError')
+    assert [res.stats['101']['count'] for res in results if res.stats] == [12000, 10000, 8000, 4000, 2000]
+
+    with (tmp_path / 'downloads' / 'summary.csv').open() as fh:
+        rows = list(csv.DictReader(fh))
+    assert [row['name'] for row in rows] == [name for name in names for ch in range(1 if name == 'SCAN3' else 3)]
+
+    results = process_all(tmp_path / 'downloads', workers=3)
+    assert [res.status for res in results] == ['skipped']*3+['failed']+['skipped']*2
@@ -0,0 +1,53 @@
+"""SCPI command registry and reply decoding."""
+
+import numpy as np
+
+from pyfluke1586A import parse_reading_table, format_command, _is_query, _convert_reply
+
+
+def test_format_command():
+    assert format_command('SYST:DATE', [2021, 5, 6]) == 'SYST:DATE 2021,05,06\r'
+    assert format_command('MEM:LOG:READ?', ['SIM_0001', 20]) == 'MEM:LOG:READ? "SIM_0001",20\r'
+    assert format_command('mem:log:nfil?') == 'MEM:LOG:NFIL?\r'
+    assert format_command('UNKNOWN', [1, 2]) == 'UNKNOWN 1,2\r'
+    assert _is_query('SYST:DATE?') and not _is_query('SYST:DATE') and not _is_query('INIT')
+    assert _convert_reply('SYST:TIME?', b'12,34,56') == [12, 34, 56]
+
+
+def test_parse_reading_table():
+    table = parse_reading_table(b'1,2020-01-01 00:00:00.000,20.5\r\r2,2020-01-01 00:00:01.000,20.6\r\r')
+    assert list(table.index) == [1, 2]
+    assert list(table.time) == list(np.array(['2020-01-01T00:00:00', '2020-01-01T00:00:01'], dtype='datetime64[ms]'))
+    assert table.values.shape == (2, 1)
+    assert list(table.values[:, 0]) == [20.5, 20.6]
+
+
+def test_parse_reading_table_ragged():
+    # The second line lacks a field: padded with NaN, not shifted into the next line
+    table = parse_reading_table(b'1,2020-01-01 00:00:00.000,20.5,21.5\r\r'
+                                b'2,2020-01-01 00:00:01.000,20.6\r\r'
+                                b'3,2020-01-01 00:00:02.000,20.7,21.7\r\r')
+    assert list(table.index) == [1, 2, 3]
+    assert list(table.values[:, 0]) == [20.5, 20.6, 20.7]
+    assert table.values[0, 1] == 21.5 and np.isnan(table.values[1, 1]) and table.values[2, 1] == 21.7
+
+
+def test_parse_reading_table_checks_every_line():
+    # The last column is only a number in the first line, it is not a value
+    table = parse_reading_table(b'1,2020-01-01 00:00:00.000,20.5,0\r\r'
+                                b'2,2020-01-01 00:00:01.000,20.6,HI\r\r')
+    assert table.values.shape == (2, 1)
+    assert list(table.values[:, 0]) == [20.5, 20.6]
+
+
+def test_parse_reading_table_without_index():
+    table = parse_reading_table(b'2020-01-01 00:00:00.000,20.5\r\r2020-01-01 00:00:01.000,20.6\r\r')
+    assert table.index is None
+    assert list(table.values[:, 0]) == [20.5, 20.6]
+
+    table = parse_reading_table(b'20.5,21.5\r\r20.6,21.6\r\r')
+    assert table.index is None and table.time is None
+    assert table.values.shape == (2, 2)
+
+    table = parse_reading_table(b'')
+    assert table.index is None and table.time is None and table.values.shape == (0, 0)
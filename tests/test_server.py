@@ -0,0 +1,117 @@
+"""Fluke1586AServer: instruments shared between clients over HTTP."""
+
+import json
+import time
+import threading
+import urllib.error
+import urllib.request
+
+import pytest
+
+from pyfluke1586A_server import Fluke1586AServer, Fluke1586AClient
+
+
+@pytest.fixture
+def server(fluke):
+    server = Fluke1586AServer([fluke], ('127.0.0.1', 0))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.close()
+
+
+def _get(url):
+    try:
+        with urllib.request.urlopen(url) as resp:
+            return resp.status, json.loads(resp.read())
+    except urllib.error.HTTPError as e:
+        return e.code, json.loads(e.read())
+
+
+def _wait_for(condition, timeout=5.):
+    deadline = time.time()+timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def test_operations(sim, fluke, server):
+    assert _get(server.url) == (200, {'sim': fluke.com_port})
+    client = Fluke1586AClient(server.url, 'sim')
+    assert client.call('identify') == sim.idn
+    assert client.call('query', command='SYST:VERS?') == '1994.0'
+    assert [f['name'] for f in client.call('catalog')] == ['SIM_0001', 'SIM_0002']
+    assert client.call('write', command='SYST:DATE 2021,05,06') is None
+    assert client.call('query', command='SYST:DATE?;:SYST:VERS?') == '2021,05,06;1994.0'
+
+
+def test_errors(server):
+    assert _get(server.url+'/nope/identify')[0] == 404
+    assert _get(server.url+'/sim/bogus')[0] == 404
+    # Setters are not allowed as GET
+    assert _get(server.url+'/sim/write?command=INIT')[0] == 405
+    assert _get(server.url+'/sim/query?command=SYST:DATE%202021,05,06')[0] == 405
+    assert _get(server.url+'/sim/query?command=INIT;:SYST:DATE%3F')[0] == 405
+    # Bad parameters are reported, not a dropped connection
+    status, reply = _get(server.url+'/sim/live?slot=x')
+    assert status == 400 and not reply['ok']
+    assert _get(server.url+'/sim/identify?unknown=1')[0] == 400
+    with pytest.raises(RuntimeError):
+        Fluke1586AClient(server.url, 'sim').call('bogus')
+
+
+def test_identical_queries_coalesced(sim, fluke, server):
+    worker = server.workers['sim']
+    replies = []
+    # Hold the port, so all calls are waiting at the same time
+    with fluke.lock:
+        threads = [threading.Thread(target=lambda id=id: replies.append(
+                   Fluke1586AClient(server.url, 'sim', client=str(id)).call('identify'))) for id in range(10)]
+        for thread in threads:
+            thread.start()
+        assert _wait_for(lambda: worker.coalesced == 9)
+    for thread in threads:
+        thread.join()
+    assert replies == [sim.idn]*10
+    assert sim.commands.count('*idn?') == 1
+    assert _get(server.url+'/sim/stats') == (200, {'executed': 1, 'coalesced': 9, 'queued': 0})
+
+
+def test_round_robin(sim, fluke, server):
+    worker = server.workers['sim']
+    with fluke.lock:
+        jobs = [worker.submit('a', 'write', {'command': 'A1'})]
+        # The worker has taken A1 and waits for the port
+        assert _wait_for(lambda: not worker.queues)
+        jobs += [worker.submit('a', 'write', {'command': 'A{0:d}'.format(id)}) for id in range(2, 6)]
+        jobs += [worker.submit('b', 'write', {'command': 'B1'})]
+    for job in jobs:
+        assert job.done.wait(5.)
+    # b is not starved by the queue of a
+    assert _wait_for(lambda: len(sim.commands) == 6)
+    assert sim.commands == ['A1', 'A2', 'B1', 'A3', 'A4', 'A5']
+
+
+def test_live_fan_out(sim, server):
+    sim.scan_interval = 0.01
+    Fluke1586AClient(server.url, 'sim').call('initiate')
+    got = {}
+
+    def subscribe(id):
+        for reading in Fluke1586AClient(server.url, 'sim').live(slot=1):
+            got.setdefault(id, []).append(reading['index'])
+            if len(got[id]) == 10:
+                break
+
+    threads = [threading.Thread(target=subscribe, args=(id,)) for id in range(3)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(10.)
+    assert sorted(got) == [0, 1, 2]
+    for indexes in got.values():
+        assert indexes == list(range(indexes[0], indexes[0]+10))
+    # One feed polls the instrument for all subscribers
+    assert list(server.workers['sim'].feeds) == [1]
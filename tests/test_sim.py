@@ -0,0 +1,165 @@
+"""Driver tests against the simulator (pyfluke1586A_sim.py) on a TCP port,
+or a pseudo terminal for the serial line settings."""
+
+import os
+import time
+
+import pytest
+import serial
+
+from pyfluke1586A import Fluke1586A
+
+needs_pty = pytest.mark.skipif(not hasattr(os, 'openpty'), reason='needs a pseudo terminal')
+
+
+def _wait_for(condition, timeout=5.):
+    deadline = time.time()+timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+def _expected(sim, name):
+    """The scan file name as stored by download_data."""
+    return sim.data(name).decode().replace('\r\r', '\n')
+
+
+def test_download(sim, fluke):
+    fluke.download_data('SIM_0001')
+    directory = fluke.download_dir / 'SIM_0001'
+    assert (directory / 'SIM_0001_data.csv').read_text() == _expected(sim, 'SIM_0001')
+    assert (directory / 'SIM_0001_conf.csv').read_text() == sim.conf('SIM_0001').decode().replace('\r\r', '\n')
+
+
+def test_download_all(sim, fluke):
+    files = fluke.download_all()
+    assert [info['name'] for info in files] == ['SIM_0001', 'SIM_0002']
+    for name in ['SIM_0001', 'SIM_0002']:
+        assert (fluke.download_dir / name / '{0}_data.csv'.format(name)).read_text() == _expected(sim, name)
+
+
+def test_incremental_download(sim, fluke):
+    p = fluke.download_dir / 'SIM_0001' / 'SIM_0001_data.csv'
+    fluke.download_data('SIM_0001', incremental=True)
+    assert p.read_text() == _expected(sim, 'SIM_0001')
+
+    sim.add_rows('SIM_0001', 5)
+    del sim.commands[:]
+    fluke.download_data('SIM_0001', incremental=True)
+    assert p.read_text() == _expected(sim, 'SIM_0001')
+    assert p.read_text().count('\n') == 1+25
+    # Only the rows from the last known row on were requested
+    assert 'MEM:LOG:READ? "SIM_0001",20' in sim.commands
+
+
+def test_incremental_download_local_file_changed(sim, fluke):
+    p = fluke.download_dir / 'SIM_0001' / 'SIM_0001_data.csv'
+    fluke.download_data('SIM_0001', incremental=True)
+    p.write_text(p.read_text()[:-10])
+    sim.add_rows('SIM_0001', 5)
+    del sim.commands[:]
+    fluke.download_data('SIM_0001', incremental=True)
+    assert p.read_text() == _expected(sim, 'SIM_0001')
+    assert 'MEM:LOG:READ? "SIM_0001"' in sim.commands
+
+
+def test_catalog(sim, fluke):
+    catalog = fluke.get_catalog()
+    assert catalog.names() == ['SIM_0001', 'SIM_0002']
+    assert catalog['SIM_0002']['slot'] == 2
+    assert int(catalog['SIM_0001']['size']) == len(sim.data('SIM_0001'))
+    assert fluke.list_scan_files() == list(catalog)
+
+    # Unchanged number of files: the cached catalog is returned
+    del sim.commands[:]
+    assert fluke.get_catalog() is catalog
+    assert sim.commands == ['MEM:LOG:NFIL?']
+
+    # A new file: only its properties are fetched
+    sim.add_rows('SIM_0003', 5)
+    del sim.commands[:]
+    catalog = fluke.get_catalog()
+    assert catalog.names() == ['SIM_0001', 'SIM_0002', 'SIM_0003']
+    props = [cmd for cmd in sim.commands if 'MEM:LOG:PROP?' in cmd]
+    assert props == ['MEM:LOG:PROP? "SIM_0003"']
+
+
+def test_send_batch(sim, fluke):
+    replies = fluke.send_batch(['*idn?', ('SYST:DATE', [2021, 5, 6]), 'SYST:VERS?', 'SYST:DATE?', 'MEM:LOG:NFIL?'])
+    assert replies == [sim.idn, None, '1994.0', [2021, 5, 6], 2]
+    # One round trip
+    assert len(sim.commands) == 1
+
+    replies = fluke.send_batch(['*idn?', 'SYST:VERS?'], convert=False)
+    assert replies == [sim.idn.encode(), b'1994.0']
+
+
+def test_send_batch_setters_only(sim, fluke):
+    assert fluke.send_batch([('SYST:DATE', [2021, 5, 6]), 'ABOR']) == [None, None]
+    assert fluke.query('SYST:DATE?') == [2021, 5, 6]
+
+
+def _deaf_at(sim, rates):
+    """Make sim ignore all but baud rate commands while set to one of rates."""
+    handle, state = sim.handle, {'rate': None}
+
+    def deaf_handle(line):
+        if line.startswith('SYST:COMM:SER:BAUD'):
+            state['rate'] = int(line.split()[1])
+        elif state['rate'] in rates:
+            return None
+        return handle(line)
+
+    sim.handle = deaf_handle
+
+
+@needs_pty
+def test_set_baudrate(sim):
+    fluke = Fluke1586A(sim.serve_pty(), verbose=False, timeout=0.5)
+    try:
+        assert fluke.set_baudrate(19200)
+        assert fluke.serial.baudrate == 19200
+        assert fluke.query('*idn?') == sim.idn
+    finally:
+        fluke.close()
+
+
+@needs_pty
+def test_set_baudrate_falls_back(sim):
+    _deaf_at(sim, [115200])
+    fluke = Fluke1586A(sim.serve_pty(), verbose=False, timeout=0.5)
+    try:
+        assert not fluke.set_baudrate(115200)
+        assert fluke.serial.baudrate == 9600
+        # The instrument was told to go back to the old rate
+        bauds = [cmd for cmd in sim.commands if cmd.startswith('SYST:COMM:SER:BAUD')]
+        assert bauds == ['SYST:COMM:SER:BAUD 115200', 'SYST:COMM:SER:BAUD 9600']
+        assert fluke.query('*idn?') == sim.idn
+    finally:
+        fluke.close()
+
+
+@needs_pty
+def test_set_baudrate_no_response(sim):
+    _deaf_at(sim, [9600, 115200])
+    fluke = Fluke1586A(sim.serve_pty(), verbose=False, timeout=0.5)
+    try:
+        with pytest.raises(serial.SerialException):
+            fluke.set_baudrate(115200)
+    finally:
+        fluke.close()
+
+
+def test_initiate_and_abort_do_not_wait(sim, fluke):
+    fluke.timeout = 5.
+    tstart = time.time()
+    assert fluke.initiate_scan()[0] is None
+    # Neither has a reply, waiting for one would take the timeout
+    assert time.time()-tstart < 1.
+    assert _wait_for(lambda: sim.scan_started is not None)
+    tstart = time.time()
+    assert fluke.abort_scan()[0] is None
+    assert time.time()-tstart < 1.
+    assert _wait_for(lambda: sim.scan_started is None)